@@ -1,27 +1,44 @@
 import os
+import json
 import uuid
+import base64
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, send_from_directory, jsonify, abort
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort, get_template_attribute
+from sqlalchemy import or_, exists
+from sqlalchemy.orm import joinedload, selectinload, raiseload
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from flask_wtf.csrf import generate_csrf
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash
+from werkzeug.exceptions import HTTPException
 import mimetypes
 from config import config
-from models import db, User, File, Folder, FileShare, ActivityLog
+from storage import (
+    ingest_stream, hash_file, resolve_path, acquire_blob, store_blob, release_blob, unlink_blob_file,
+    reserve_quota, release_quota, QuotaBudget, QuotaReservation, FileTooLargeError, UPLOAD_FORM_OVERHEAD
+)
+from models import db, User, File, Folder, FileShare, FileContent, ActivityLog, UploadSession, UploadChunk, Job
+from jobs import enqueue, WorkerPool
+from folders import (
+    init_folder_tree, get_ancestors, is_in_subtree, update_subtree, delete_folder_tree, adjust_folder_totals
+)
+from reaper import enqueue_reap
+from upload_sessions import session_expires_at, is_session_expired, schedule_upload_session_gc
+from listing import list_folder_page, LISTING_PAGE_SIZE
+from query_budget import query_budget, init_query_budget
+from search_index import get_search_backend, search_items, count_facets
+from search_filters import form_filters, has_filters, filter_args
+from migrations import prepare_database
+from content_index import enqueue_content_index
+from thumbnails import PIL_AVAILABLE, generate_renditions, renditions_exist
+from serving import send_stored_file, file_etag
+import thumbnails
 from forms import (
     LoginForm, RegistrationForm, UserCreateForm, UserEditForm, FileUploadForm, 
     FolderCreateForm, FileShareForm, SearchForm, SettingsForm, AdminSettingsForm
 )
 
-# Импорт для работы с изображениями
-try:
-    from PIL import Image, ImageOps
-    PIL_AVAILABLE = True
-except ImportError:
-    PIL_AVAILABLE = False
-    print("WARNING: PIL/Pillow не установлен. Миниатюры будут отключены.")
-
 def create_app(config_name='default'):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
@@ -29,6 +46,9 @@ def create_app(config_name='default'):
     
     # Initialize extensions
     db.init_app(app)
+    with app.app_context():
+        init_query_budget(app, db.engine)
+        search_backend = get_search_backend()
     
     # Create upload folder
     upload_folder = os.path.abspath(app.config['UPLOAD_FOLDER'])
@@ -38,9 +58,12 @@ def create_app(config_name='default'):
     thumbnails_folder = os.path.abspath(os.path.join(upload_folder, 'thumbnails'))
     os.makedirs(thumbnails_folder, exist_ok=True)
     
+    # Create folder for uploads in progress (same volume, so blobs are moved atomically)
+    temp_folder = os.path.abspath(os.path.join(upload_folder, 'tmp'))
+    os.makedirs(temp_folder, exist_ok=True)
+    
     print(f"DEBUG: Папка загрузок создана/найдена: {upload_folder}")
     print(f"DEBUG: Папка миниатюр создана/найдена: {thumbnails_folder}")
-    print(f"DEBUG: Содержимое папки: {os.listdir(upload_folder) if os.path.exists(upload_folder) else 'папка не существует'}")
     
     # Initialize Flask-Login
     login_manager = LoginManager()
@@ -52,80 +75,174 @@ def create_app(config_name='default'):
     def load_user(user_id):
         return User.query.get(int(user_id))
     
-    def generate_thumbnail(image_path, thumbnail_path, size=(150, 150)):
-        """Генерирует миниатюру изображения"""
-        if not PIL_AVAILABLE:
-            return False
-            
-        try:
-            with Image.open(image_path) as img:
-                # Конвертируем в RGB если изображение в RGBA
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    img = img.convert('RGB')
-                
-                # Создаем миниатюру с сохранением пропорций
-                img.thumbnail(size, Image.Resampling.LANCZOS)
-                
-                # Создаем новое изображение с белым фоном
-                thumbnail = Image.new('RGB', size, (255, 255, 255))
-                
-                # Вычисляем позицию для центрирования
-                x = (size[0] - img.width) // 2
-                y = (size[1] - img.height) // 2
-                
-                # Вставляем миниатюру по центру
-                thumbnail.paste(img, (x, y))
-                
-                # Сохраняем миниатюру
-                thumbnail.save(thumbnail_path, 'JPEG', quality=85, optimize=True)
-                return True
-        except Exception as e:
-            print(f"Ошибка при создании миниатюры {image_path}: {e}")
-            return False
-    
-    def get_thumbnail_path(file_path):
+    def get_thumbnail_path(file_path, rendition=thumbnails.DEFAULT_RENDITION, fmt='jpeg'):
         """Возвращает путь к миниатюре файла"""
-        if not PIL_AVAILABLE:
+        return thumbnails.get_thumbnail_path(app.config['UPLOAD_FOLDER'], file_path, rendition, fmt)
+    
+    # Часто запрашиваемые миниатюры отдаются из памяти, без обращения к диску
+    thumbnail_cache = thumbnails.ThumbnailCache(app.config['THUMBNAIL_CACHE_SIZE'])
+    
+    def load_thumbnail(file, rendition, fmt):
+        """Байты миниатюры из кеша или с диска, None - если миниатюра еще не создана"""
+        cache_key = (file.id, file_etag(file), rendition, fmt)
+        data = thumbnail_cache.get(cache_key)
+        if data is not None:
+            thumbnail_cache.count('memory_hits')
+            if thumbnail_cache.should_touch(cache_key):
+                # Очистка на диске вытесняет по atime - отмечаем и обращения из памяти
+                thumbnails.touch_thumbnail(get_thumbnail_path(file.file_path, rendition, fmt))
+            return data
+        
+        thumbnail_path = get_thumbnail_path(file.file_path, rendition, fmt)
+        if not os.path.exists(thumbnail_path):
+            # Миниатюры еще нет или ее вытеснила очистка - будет создана заново
+            thumbnail_cache.count('misses')
             return None
-            
-        # Создаем имя файла миниатюры
-        filename = os.path.basename(file_path)
-        name, ext = os.path.splitext(filename)
-        thumbnail_filename = f"{name}_thumb.jpg"
-        
-        # Путь к папке миниатюр
-        thumbnails_folder = os.path.abspath(os.path.join(app.config['UPLOAD_FOLDER'], 'thumbnails'))
-        
-        return os.path.join(thumbnails_folder, thumbnail_filename)
+        with open(thumbnail_path, 'rb') as f:
+            data = f.read()
+        thumbnails.touch_thumbnail(thumbnail_path)
+        thumbnail_cache.count('disk_hits')
+        thumbnail_cache.put(cache_key, data)
+        return data
     
+    @app.template_global()
+    def thumbnail_url(file, rendition=thumbnails.DEFAULT_RENDITION, fmt='jpeg'):
+        """Адрес миниатюры с версией файла: при изменении файла меняется и адрес"""
+        return f"/thumbnail/{file.id}?size={rendition}&format={fmt}&v={file_etag(file)}"
+
+    def get_full_path(file):
+        """Возвращает полный путь к содержимому файла на диске (любой раскладки)"""
+        return resolve_path(app.config['UPLOAD_FOLDER'], file.file_path)
+
+    def register_uploaded_file(filename, blob, folder_id, is_public):
+        """Создает запись File, ссылающуюся на блоб (без flush и commit)"""
+        db_file = File(
+            filename=blob.file_path,
+            original_filename=filename,
+            file_path=blob.file_path,  # В БД сохраняем только путь внутри UPLOAD_FOLDER
+            file_size=blob.size,
+            content_hash=blob.content_hash,
+            blob_id=blob.id,
+            mime_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            folder_id=folder_id,
+            user_id=current_user.id,
+            is_public=is_public
+        )
+
+        if is_public:
+            db_file.public_url = f"{uuid.uuid4().hex}"
+
+        db.session.add(db_file)
+        return db_file
+
+    def record_uploaded_files(db_files):
+        """Добавляет журнал и фоновые задачи для загруженных файлов в текущую транзакцию.
+
+        Записи File вставляются одним flush, id для журнала и задач берутся
+        из результата вставки, без повторного запроса.
+        """
+        db.session.flush()
+
+        db.session.add_all([
+            build_activity_log(current_user.id, 'upload', 'file', db_file.id)
+            for db_file in db_files
+        ])
+        
+        # Итоги папок: один UPDATE на папку назначения
+        folder_totals = {}
+        for db_file in db_files:
+            size, count = folder_totals.get(db_file.folder_id, (0, 0))
+            folder_totals[db_file.folder_id] = (size + db_file.file_size, count + 1)
+        for folder_id, (size, count) in folder_totals.items():
+            adjust_folder_totals(folder_id, size, count)
+
+        # Миниатюры и сведения об изображении (размеры, цвет-заглушка) извлекает
+        # фоновая задача; для известного контента миниатюры уже есть
+        for db_file in db_files:
+            if db_file.mime_type.startswith('image/') and PIL_AVAILABLE:
+                enqueue('thumbnail', file_id=db_file.id)
+            # Текст документов для поиска по содержимому
+            enqueue_content_index(db_file)
+
+    def ingest_upload(file, budget):
+        """Записывает загружаемый файл во временную папку (выполняется в пуле потоков)"""
+        # После подсчета хеша файл переносится в хранилище блобов
+        temp_path = os.path.join(temp_folder, uuid.uuid4().hex)
+        
+        # Один проход по потоку: запись на диск, размер и SHA-256
+        result = ingest_stream(
+            getattr(file, 'stream', file),
+            temp_path,
+            max_size=app.config['MAX_CONTENT_LENGTH'],
+            budget=budget
+        )
+        return temp_path, result
+
+    def release_file_data(file):
+        """Освобождает содержимое удаляемого файла.
+
+        Возвращает (путь на диске, путь блоба, хеш) для remove_released_data
+        или None, если на содержимое еще ссылаются другие файлы.
+        """
+        if file.blob_id is None:
+            # Старый формат: у каждого файла собственная копия на диске
+            return get_full_path(file), None, None
+
+        blob = file.blob
+        content_hash = blob.content_hash
+        blob_path = release_blob(blob)
+        if blob_path is None:
+            return None
+        return resolve_path(app.config['UPLOAD_FOLDER'], blob_path), blob_path, content_hash
+
+    def remove_released_data(released):
+        """Удаляет с диска содержимое, освобожденное release_file_data (после commit)"""
+        for full_file_path, blob_path, content_hash in released:
+            try:
+                if content_hash is not None:
+                    if unlink_blob_file(full_file_path, blob_path, content_hash):
+                        print(f"Удален блоб: {full_file_path}")
+                        thumbnails.remove_renditions(app.config['UPLOAD_FOLDER'], full_file_path)
+                elif os.path.exists(full_file_path):
+                    os.remove(full_file_path)
+                    print(f"Файл удален физически: {full_file_path}")
+                    thumbnails.remove_renditions(app.config['UPLOAD_FOLDER'], full_file_path)
+            except OSError as e:
+                print(f"Не удалось удалить {full_file_path}: {e}")
+
     # Routes
     @app.route('/')
     @login_required
+    @query_budget(5)  # пользователь, папка, ее предки, страница папок и файлов
     def index():
         # Get user's files and folders
         current_folder_id = request.args.get('folder', 0, type=int)
+        sort = request.args.get('sort', 'name')
+        order = request.args.get('order', 'asc')
         
-        if current_folder_id == 0:
-            folders = Folder.query.filter_by(user_id=current_user.id, parent_id=None).all()
-            files = File.query.filter_by(user_id=current_user.id, folder_id=None).all()
-        else:
+        if current_folder_id != 0:
             current_folder = Folder.query.get_or_404(current_folder_id)
             if current_folder.user_id != current_user.id:
                 abort(403)
-            folders = Folder.query.filter_by(user_id=current_user.id, parent_id=current_folder_id).all()
-            files = File.query.filter_by(user_id=current_user.id, folder_id=current_folder_id).all()
         
-        # Get breadcrumb
+        # Только первая страница, остальные догружает шаблон через /api/folder/<id>/items
+        try:
+            page = list_folder_page(current_user.id, current_folder_id or None, sort, order)
+        except ValueError:
+            sort, order = 'name', 'asc'
+            page = list_folder_page(current_user.id, current_folder_id or None, sort, order)
+        
+        # Get breadcrumb (все предки одним запросом по tree_path)
         breadcrumb = []
         if current_folder_id != 0:
-            folder = Folder.query.get(current_folder_id)
-            while folder:
-                breadcrumb.insert(0, folder)
-                folder = folder.parent
+            breadcrumb = get_ancestors(current_folder)
         
         return render_template('index.html', 
-                            folders=folders, 
-                            files=files, 
+                            folders=page.folders, 
+                            files=page.files, 
+                            next_cursor=page.next_cursor,
+                            sort=sort,
+                            order=order,
                             current_folder_id=current_folder_id,
                             breadcrumb=breadcrumb,
                             csrf_token=generate_csrf())
@@ -304,13 +421,20 @@ def create_app(config_name='default'):
     
     @app.route('/admin/users/<int:user_id>/storage')
     @login_required
+    @query_budget(5)  # администратор, пользователь, папки, их файлы, файлы с папками
     def admin_user_storage(user_id):
         if not current_user.is_admin:
             abort(403)
         
         user = User.query.get_or_404(user_id)
-        files = File.query.filter_by(user_id=user_id).all()
-        folders = Folder.query.filter_by(user_id=user_id).all()
+        # Шаблон обходит folder.files и file.folder - загружаем их заранее,
+        # любые другие ленивые загрузки запрещены
+        folders = Folder.query.filter_by(user_id=user_id).options(
+            selectinload(Folder.files), raiseload('*')
+        ).all()
+        files = File.query.filter_by(user_id=user_id).options(
+            joinedload(File.folder), raiseload('*')
+        ).all()
         
         return render_template('admin/user_storage.html', user=user, files=files, folders=folders)
     
@@ -344,6 +468,28 @@ def create_app(config_name='default'):
     @app.route('/upload', methods=['GET', 'POST'])
     @login_required
     def upload_file():
+        # Место резервируется по Content-Length до разбора формы, поэтому
+        # тело запроса, которое заведомо не поместится в хранилище, даже не читается.
+        # Content-Length включает границы multipart, заголовки частей и поле CSRF:
+        # резервируется не больше свободного места, точный объем файлов проверяет QuotaBudget
+        reservation = QuotaReservation(current_user.id)
+        if request.method == 'POST':
+            content_length = request.content_length or 0
+            free = max(current_user.storage_limit - current_user.storage_used, 0)
+            if content_length > free + UPLOAD_FORM_OVERHEAD or not reservation.reserve(min(content_length, free)):
+                flash('Недостаточно места в хранилище для всех файлов', 'error')
+                return redirect(url_for('upload_file'))
+        
+        try:
+            return process_upload(reservation)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            # Неиспользованный резерв возвращается пользователю
+            reservation.release()
+    
+    def process_upload(reservation):
         form = FileUploadForm()
         
         # Populate folder choices
@@ -352,8 +498,6 @@ def create_app(config_name='default'):
         folders.extend([(f.id, f.name) for f in user_folders])
         form.folder_id.choices = folders
         
-        print(f"DEBUG: Форма отправлена, валидна: {form.validate_on_submit()}")
-        
         # Проверяем, что папка uploads существует и доступна для записи
         upload_folder = os.path.abspath(app.config['UPLOAD_FOLDER'])
         print(f"DEBUG: Папка загрузок: {upload_folder}")
@@ -378,144 +522,75 @@ def create_app(config_name='default'):
                 uploaded_count = 0
                 failed_count = 0
                 total_size = 0
+                stored_blobs = []
+                # Новые файлы блобов: удаляются, если транзакция не зафиксируется
+                created_paths = []
                 
-                # Проверяем общий размер всех файлов
-                for file in files:
-                    if hasattr(file, 'content_length') and file.content_length:
-                        total_size += file.content_length
-                    else:
-                        # Если content_length недоступен, читаем файл для определения размера
-                        if hasattr(file, 'seek'):
-                            file.seek(0, 2)  # Seek to end
-                            total_size += file.tell()
-                            file.seek(0)  # Reset to beginning
-                        else:
-                            # Если файл не поддерживает seek, используем len() для bytes
-                            if hasattr(file, 'read'):
-                                temp_content = file.read()
-                                total_size += len(temp_content)
-                                # Сбрасываем позицию чтения, если возможно
-                                if hasattr(file, 'seek'):
-                                    file.seek(0)
-                            else:
-                                total_size += len(file)
-                
-                # Проверяем лимит хранилища
-                if current_user.storage_used + total_size > current_user.storage_limit:
-                    flash('Недостаточно места в хранилище для всех файлов', 'error')
-                    return render_template('upload.html', form=form)
+                # Свободное место проверяется по мере записи, общее для всех потоков.
+                # Без Content-Length резерва нет, и запись ограничена свободным местом
+                budget = QuotaBudget(reservation.size or current_user.storage_limit - current_user.storage_used)
                 
-                # Обрабатываем каждый файл
-                for file in files:
-                    print(f"DEBUG: Обрабатываю файл: {file.filename if hasattr(file, 'filename') else 'без имени'}")
-                    try:
+                # Проверяем имена и параллельно записываем файлы на диск
+                entries = []
+                workers = max(1, min(app.config['UPLOAD_WORKERS'], len(files)))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    for file in files:
+                        print(f"DEBUG: Обрабатываю файл: {file.filename if hasattr(file, 'filename') else 'без имени'}")
                         # Проверяем, что файл имеет имя
                         if not file.filename:
-                            flash('Обнаружен файл без имени', 'error')
-                            failed_count += 1
+                            entries.append((file, None, 'Обнаружен файл без имени'))
                             continue
-                            
+                        
                         filename = secure_filename(file.filename)
                         if not filename:
-                            flash('Недопустимое имя файла', 'error')
-                            failed_count += 1
+                            entries.append((file, None, 'Недопустимое имя файла'))
                             continue
-                            
-                        unique_filename = f"{uuid.uuid4().hex}_{filename}"
-                        # Сохраняем только имя файла в БД, но физически сохраняем в папку uploads
-                        file_path = unique_filename
-                        full_file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
                         
-                        # Проверяем размер файла
-                        file_content = None
-                        if hasattr(file, 'content_length') and file.content_length:
-                            file_size = file.content_length
-                        else:
-                            if hasattr(file, 'seek'):
-                                file.seek(0, 2)  # Seek to end
-                                file_size = file.tell()
-                                file.seek(0)  # Reset to beginning
-                            else:
-                                # Если файл не поддерживает seek, используем len() для bytes
-                                if hasattr(file, 'read'):
-                                    file_content = file.read()
-                                    file_size = len(file_content)
-                                    # Сбрасываем позицию чтения, если возможно
-                                    if hasattr(file, 'seek'):
-                                        file.seek(0)
-                                else:
-                                    file_size = len(file)
-                        
-                        # Добавляем отладочную информацию о размере файла
-                        print(f"DEBUG: Размер файла {filename}: {file_size} байт")
-                        print(f"DEBUG: Полный путь для сохранения: {full_file_path}")
-                        
-                        if file_size > app.config['MAX_CONTENT_LENGTH']:
-                            flash(f'Файл "{filename}" слишком большой ({file_size / (1024*1024):.1f} МБ)', 'error')
+                        entries.append((file, filename, executor.submit(ingest_upload, file, budget)))
+                
+                # Записанный объем должен уместиться в резерв (или быть дорезервирован)
+                ingested_size = sum(
+                    outcome.result()[1].size
+                    for file, filename, outcome in entries
+                    if filename is not None and outcome.exception() is None
+                )
+                
+                # Прерываем загрузку целиком и убираем уже записанные файлы
+                if budget.exceeded or not reservation.ensure(ingested_size):
+                    for file, filename, outcome in entries:
+                        if filename is not None and outcome.exception() is None:
+                            temp_path, result = outcome.result()
+                            if os.path.exists(temp_path):
+                                os.remove(temp_path)
+                    flash('Недостаточно места в хранилище для всех файлов', 'error')
+                    return render_template('upload.html', form=form)
+                
+                # Обрабатываем результаты в исходном порядке файлов
+                for file, filename, outcome in entries:
+                    try:
+                        if filename is None:
+                            flash(outcome, 'error')
                             failed_count += 1
                             continue
                         
-                        # Сохраняем файл в папку uploads
-                        print(f"DEBUG: Сохраняю файл по пути: {full_file_path}")
-                        if hasattr(file, 'save'):
-                            file.save(full_file_path)
-                            print(f"DEBUG: Файл сохранен через метод save()")
-                        else:
-                            # Если у файла нет метода save, записываем содержимое напрямую
-                            with open(full_file_path, 'wb') as f:
-                                if hasattr(file, 'read'):
-                                    # Если мы уже читали файл для определения размера, используем сохраненное содержимое
-                                    if file_content is not None:
-                                        f.write(file_content)
-                                    else:
-                                        f.write(file.read())
-                                else:
-                                    f.write(file)
-                            print(f"DEBUG: Файл сохранен через прямой запись")
-                        
-                        # Проверяем размер сохраненного файла
-                        actual_file_size = os.path.getsize(full_file_path)
-                        print(f"DEBUG: Фактический размер сохраненного файла {filename}: {actual_file_size} байт")
-                        print(f"DEBUG: Файл существует после сохранения: {os.path.exists(full_file_path)}")
+                        temp_path, result = outcome.result()
+                        print(f"DEBUG: Файл {filename} сохранен: {result.size} байт, sha256 {result.sha256}")
                         
-                        # Показываем содержимое папки после сохранения
-                        try:
-                            folder_contents = os.listdir(upload_folder)
-                            print(f"DEBUG: Содержимое папки {upload_folder} после сохранения: {folder_contents}")
-                        except Exception as e:
-                            print(f"DEBUG: Не удалось получить содержимое папки: {e}")
-                        
-                        # Используем фактический размер файла для базы данных
-                        file_size = actual_file_size
-                        
-                        # Создаем запись в базе данных
-                        db_file = File(
-                            filename=unique_filename,
-                            original_filename=filename,
-                            file_path=file_path,  # В БД сохраняем только имя файла
-                            file_size=file_size,
-                            mime_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
-                            folder_id=form.folder_id.data if form.folder_id.data != 0 else None,
-                            user_id=current_user.id,
-                            is_public=form.is_public.data
-                        )
+                        # Одинаковое содержимое хранится на диске один раз
+                        blob, created = store_blob(upload_folder, temp_path, result.sha256, result.size)
+                        if created:
+                            created_paths.append(os.path.join(upload_folder, blob.file_path))
+                        total_size += result.size
                         
-                        if form.is_public.data:
-                            db_file.public_url = f"{uuid.uuid4().hex}"
-                        
-                        db.session.add(db_file)
+                        # Записи в базе данных создаются одним пакетом после цикла
+                        stored_blobs.append((filename, blob))
                         uploaded_count += 1
-                        
-                        # Генерируем миниатюру для изображений
-                        if db_file.mime_type.startswith('image/'):
-                            try:
-                                thumbnail_path = get_thumbnail_path(file_path)
-                                if thumbnail_path and PIL_AVAILABLE:
-                                    generate_thumbnail(full_file_path, thumbnail_path)
-                                    print(f"DEBUG: Миниатюра создана для {filename}")
-                            except Exception as thumb_error:
-                                print(f"DEBUG: Ошибка при создании миниатюры для {filename}: {thumb_error}")
-                        
+
+                    except FileTooLargeError as e:
+                        flash(f'Файл "{filename}" слишком большой ({e.args[0] / (1024*1024):.1f} МБ)', 'error')
+                        failed_count += 1
+                        continue
+
                     except Exception as e:
                         print(f"DEBUG: Ошибка при загрузке файла: {str(e)}")
                         error_msg = f'Ошибка при загрузке файла "{file.filename if hasattr(file, "filename") else "неизвестный"}": {str(e)}'
@@ -523,20 +598,28 @@ def create_app(config_name='default'):
                         failed_count += 1
                         continue
                 
-                # Обновляем использованное место в хранилище
-                current_user.storage_used += total_size
-                db.session.commit()
-                
-                # Логируем активность для каждого загруженного файла
-                # Получаем ID всех загруженных файлов из базы данных
-                # Используем более точный способ получения последних загруженных файлов
-                uploaded_files = File.query.filter_by(
-                    user_id=current_user.id,
-                    folder_id=form.folder_id.data if form.folder_id.data != 0 else None
-                ).order_by(File.id.desc()).limit(uploaded_count).all()
-                
-                for db_file in uploaded_files:
-                    log_activity(current_user.id, 'upload', 'file', db_file.id)
+                # Файлы, журнал и задачи записываются одной транзакцией
+                try:
+                    uploaded_files = [
+                        register_uploaded_file(
+                            filename,
+                            blob,
+                            form.folder_id.data if form.folder_id.data != 0 else None,
+                            form.is_public.data
+                        )
+                        for filename, blob in stored_blobs
+                    ]
+                    if uploaded_files:
+                        record_uploaded_files(uploaded_files)
+                    
+                    # Резерв превращается в использованное место, остаток возвращается
+                    reservation.settle(total_size)
+                except Exception:
+                    # Записи блобов откатываются вместе с транзакцией - их файлы не нужны
+                    for created_path in created_paths:
+                        if os.path.exists(created_path):
+                            os.remove(created_path)
+                    raise
                 
                 # Показываем результат
                 print(f"DEBUG: Результат загрузки - успешно: {uploaded_count}, неудачно: {failed_count}")
@@ -555,9 +638,298 @@ def create_app(config_name='default'):
                 return render_template('upload.html', form=form)
         else:
             print(f"DEBUG: Ошибки валидации формы: {form.errors}")
-        
+
         return render_template('upload.html', form=form)
-    
+
+    def get_upload_session_or_404(session_id, lock=False):
+        # lock - строка сессии блокируется до commit, чтобы ее не завершила задача истечения
+        query = UploadSession.query.filter_by(id=session_id)
+        if lock:
+            query = query.with_for_update()
+        upload_session = query.first_or_404()
+        if upload_session.user_id != current_user.id:
+            abort(403)
+        return upload_session
+
+    def upload_session_status(upload_session):
+        received = sorted(chunk.chunk_index for chunk in upload_session.chunks)
+        return {
+            'success': True,
+            'session_id': upload_session.id,
+            'status': upload_session.status,
+            'filename': upload_session.original_filename,
+            'total_size': upload_session.total_size,
+            'chunk_size': upload_session.chunk_size,
+            'chunk_count': upload_session.get_chunk_count(),
+            'received_chunks': received,
+            'expires_at': upload_session.expires_at.isoformat() if upload_session.expires_at else None
+        }
+
+    @app.route('/api/upload', methods=['POST'])
+    @login_required
+    def create_upload_session():
+        """API endpoint для создания сессии загрузки по частям"""
+        data = request.get_json(silent=True) or request.form
+
+        filename = secure_filename(data.get('filename') or '')
+        if not filename:
+            return jsonify({'success': False, 'error': 'Недопустимое имя файла'}), 400
+
+        try:
+            total_size = int(data.get('size'))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Не указан размер файла'}), 400
+
+        if total_size < 0:
+            return jsonify({'success': False, 'error': 'Недопустимый размер файла'}), 400
+
+        if total_size > app.config['MAX_CONTENT_LENGTH']:
+            return jsonify({
+                'success': False,
+                'error': f'Файл "{filename}" слишком большой ({total_size / (1024*1024):.1f} МБ)'
+            }), 413
+
+        try:
+            folder_id = int(data.get('folder_id') or 0)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Некорректная папка'}), 400
+        if folder_id != 0:
+            folder = Folder.query.get_or_404(folder_id)
+            if folder.user_id != current_user.id:
+                abort(403)
+
+        is_public = str(data.get('is_public', '')).lower() in ('1', 'true', 'on', 'yes')
+
+        # Мгновенная загрузка: клиент передал хеш содержимого, которое у него уже есть
+        # на сервере; хеш чужого содержимого ведет к обычной загрузке по частям
+        content_hash = (data.get('sha256') or '').lower()
+        if content_hash:
+            try:
+                blob = acquire_blob(content_hash, total_size, owner_id=current_user.id)
+                if blob is not None:
+                    if not reserve_quota(current_user.id, blob.size):
+                        db.session.rollback()
+                        return jsonify({'success': False, 'error': 'Недостаточно места в хранилище'}), 413
+
+                    db_file = register_uploaded_file(filename, blob, folder_id if folder_id != 0 else None, is_public)
+                    record_uploaded_files([db_file])
+                    db.session.commit()
+
+                    return jsonify({
+                        'success': True,
+                        'status': 'complete',
+                        'file_id': db_file.id,
+                        'filename': db_file.original_filename,
+                        'file_size': db_file.file_size
+                    }), 201
+            except Exception as e:
+                db.session.rollback()
+                return jsonify({
+                    'success': False,
+                    'error': str(e)
+                }), 500
+
+        chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+        session_id = uuid.uuid4().hex
+        # Части пишутся по смещению прямо в файл на том же томе, что и хранилище блобов
+        file_path = f"tmp/{session_id}"
+        full_file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_path)
+
+        # Место резервируется на все время сессии и возвращается при отмене
+        if not reserve_quota(current_user.id, total_size):
+            db.session.rollback()
+            return jsonify({'success': False, 'error': 'Недостаточно места в хранилище'}), 413
+
+        try:
+            with open(full_file_path, 'wb') as f:
+                f.truncate(total_size)
+
+            upload_session = UploadSession(
+                id=session_id,
+                user_id=current_user.id,
+                folder_id=folder_id if folder_id != 0 else None,
+                original_filename=filename,
+                file_path=file_path,
+                total_size=total_size,
+                chunk_size=chunk_size,
+                is_public=is_public,
+                expires_at=session_expires_at()
+            )
+            db.session.add(upload_session)
+            db.session.commit()
+
+            return jsonify(upload_session_status(upload_session)), 201
+
+        except Exception as e:
+            db.session.rollback()
+            if os.path.exists(full_file_path):
+                os.remove(full_file_path)
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 500
+
+    @app.route('/api/upload/<session_id>', methods=['GET'])
+    @login_required
+    def get_upload_session(session_id):
+        """API endpoint для получения состояния сессии (для возобновления загрузки)"""
+        upload_session = get_upload_session_or_404(session_id)
+        return jsonify(upload_session_status(upload_session))
+
+    @app.route('/api/upload/<session_id>/<int:chunk_index>', methods=['PUT'])
+    @login_required
+    def upload_chunk(session_id, chunk_index):
+        """API endpoint для загрузки одной части файла"""
+        upload_session = get_upload_session_or_404(session_id)
+
+        if upload_session.status == 'expired' or is_session_expired(upload_session):
+            return jsonify({'success': False, 'error': 'Срок сессии загрузки истек'}), 410
+
+        if upload_session.status != 'active':
+            return jsonify({'success': False, 'error': 'Сессия загрузки уже завершена'}), 409
+
+        if chunk_index < 0 or chunk_index >= upload_session.get_chunk_count():
+            return jsonify({'success': False, 'error': 'Недопустимый номер части'}), 400
+
+        expected_length = upload_session.get_chunk_length(chunk_index)
+        if request.content_length is not None and request.content_length != expected_length:
+            return jsonify({
+                'success': False,
+                'error': f'Ожидалось {expected_length} байт, получено {request.content_length}'
+            }), 400
+
+        full_file_path = os.path.join(app.config['UPLOAD_FOLDER'], upload_session.file_path)
+
+        try:
+            # Пишем часть прямо в конечный файл, не буферизуя тело запроса
+            written = 0
+            with open(full_file_path, 'r+b') as f:
+                f.seek(chunk_index * upload_session.chunk_size)
+                while True:
+                    block = request.stream.read(min(65536, expected_length - written + 1))
+                    if not block:
+                        break
+                    written += len(block)
+                    if written > expected_length:
+                        break
+                    f.write(block)
+
+            if written != expected_length:
+                return jsonify({
+                    'success': False,
+                    'error': f'Ожидалось {expected_length} байт, получено {written}'
+                }), 400
+
+            chunk = UploadChunk.query.filter_by(session_id=upload_session.id, chunk_index=chunk_index).first()
+            if chunk is None:
+                db.session.add(UploadChunk(session_id=upload_session.id, chunk_index=chunk_index, size=written))
+            # Каждая часть продлевает сессию
+            upload_session.updated_at = datetime.utcnow()
+            upload_session.expires_at = session_expires_at(upload_session.updated_at)
+            db.session.commit()
+
+            return jsonify({
+                'success': True,
+                'chunk_index': chunk_index,
+                'received': UploadChunk.query.filter_by(session_id=upload_session.id).count(),
+                'chunk_count': upload_session.get_chunk_count()
+            })
+
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 500
+
+    @app.route('/api/upload/<session_id>/complete', methods=['POST'])
+    @login_required
+    def complete_upload_session(session_id):
+        """API endpoint для завершения сессии: проверка квоты, запись в БД, миниатюра"""
+        upload_session = get_upload_session_or_404(session_id, lock=True)
+
+        if upload_session.status == 'expired':
+            return jsonify({'success': False, 'error': 'Срок сессии загрузки истек'}), 410
+
+        if upload_session.status != 'active':
+            return jsonify({'success': False, 'error': 'Сессия загрузки уже завершена'}), 409
+
+        received = {chunk.chunk_index for chunk in upload_session.chunks}
+        missing = [i for i in range(upload_session.get_chunk_count()) if i not in received]
+        if missing:
+            return jsonify({
+                'success': False,
+                'error': 'Получены не все части файла',
+                'missing_chunks': missing
+            }), 409
+
+        full_file_path = os.path.join(app.config['UPLOAD_FOLDER'], upload_session.file_path)
+        created_path = None
+
+        try:
+            result = hash_file(full_file_path)
+            blob, created = store_blob(os.path.abspath(app.config['UPLOAD_FOLDER']), full_file_path, result.sha256, result.size)
+            if created:
+                created_path = os.path.join(app.config['UPLOAD_FOLDER'], blob.file_path)
+
+            db_file = register_uploaded_file(
+                upload_session.original_filename,
+                blob,
+                upload_session.folder_id,
+                upload_session.is_public
+            )
+            record_uploaded_files([db_file])
+            # Место было зарезервировано при создании сессии
+            upload_session.status = 'complete'
+            for chunk in list(upload_session.chunks):
+                db.session.delete(chunk)
+            db.session.commit()
+
+            return jsonify({
+                'success': True,
+                'file_id': db_file.id,
+                'filename': db_file.original_filename,
+                'file_size': db_file.file_size
+            })
+
+        except Exception as e:
+            db.session.rollback()
+            if created_path and os.path.exists(created_path):
+                os.remove(created_path)
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 500
+
+    @app.route('/api/upload/<session_id>', methods=['DELETE'])
+    @login_required
+    def abort_upload_session(session_id):
+        """API endpoint для отмены сессии загрузки"""
+        upload_session = get_upload_session_or_404(session_id, lock=True)
+
+        if upload_session.status != 'active':
+            return jsonify({'success': False, 'error': 'Сессия загрузки уже завершена'}), 409
+
+        try:
+            full_file_path = os.path.join(app.config['UPLOAD_FOLDER'], upload_session.file_path)
+            if os.path.exists(full_file_path):
+                os.remove(full_file_path)
+
+            upload_session.status = 'aborted'
+            for chunk in list(upload_session.chunks):
+                db.session.delete(chunk)
+            release_quota(upload_session.user_id, upload_session.total_size)
+            db.session.commit()
+
+            return jsonify({'success': True, 'session_id': upload_session.id})
+
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 500
+
     @app.route('/folder/create', methods=['GET', 'POST'])
     @login_required
     def create_folder():
@@ -578,6 +950,9 @@ def create_app(config_name='default'):
             )
             
             db.session.add(folder)
+            db.session.flush()
+            init_folder_tree(folder)
+            adjust_folder_totals(folder.parent_id, folders=1)
             db.session.commit()
             
             log_activity(current_user.id, 'create_folder', 'folder', folder.id)
@@ -599,77 +974,24 @@ def create_app(config_name='default'):
             abort(403)
         
         try:
-            # Check if folder has files or subfolders
-            files_in_folder = File.query.filter_by(folder_id=folder.id).all()
-            subfolders = Folder.query.filter_by(parent_id=folder.id).all()
-            
-            print(f"Проверка содержимого папки {folder_id}: файлов {len(files_in_folder)}, подпапок {len(subfolders)}")
-            
-            total_size_to_remove = 0
-            deleted_files_count = 0
-            deleted_subfolders_count = 0
-            
-            # Recursively delete subfolders and their contents
-            def delete_subfolder_recursive(subfolder_id):
-                nonlocal total_size_to_remove, deleted_files_count, deleted_subfolders_count
-                
-                # Get files in this subfolder
-                subfolder_files = File.query.filter_by(folder_id=subfolder_id).all()
-                for file in subfolder_files:
-                    # Remove file from storage
-                    if file.file_path.startswith('uploads\\') or file.file_path.startswith('uploads/'):
-                        # Старый формат: file_path уже содержит полный путь
-                        full_file_path = file.file_path
-                    else:
-                        # Новый формат: формируем полный путь
-                        full_file_path = os.path.join(app.config['UPLOAD_FOLDER'], file.file_path)
-                    
-                    if os.path.exists(full_file_path):
-                        os.remove(full_file_path)
-                        print(f"Удален файл подпапки: {full_file_path}")
-                    total_size_to_remove += file.file_size
-                    deleted_files_count += 1
-                    # Delete file record
-                    db.session.delete(file)
-                
-                # Get subfolders in this subfolder
-                sub_subfolders = Folder.query.filter_by(parent_id=subfolder_id).all()
-                for sub_subfolder in sub_subfolders:
-                    delete_subfolder_recursive(sub_subfolder.id)
-                    db.session.delete(sub_subfolder)
-                    deleted_subfolders_count += 1
+            folder_name = folder.name
+            parent_id = folder.parent_id
             
-            # Delete subfolders first
-            for subfolder in subfolders:
-                delete_subfolder_recursive(subfolder.id)
-                db.session.delete(subfolder)
-                deleted_subfolders_count += 1
+            # Вложенные папки и файлы удаляются массовыми запросами по tree_path
+            deletion = delete_folder_tree(folder)
+            adjust_folder_totals(parent_id, -deletion.size, -deletion.files, -deletion.folders)
+            deleted_files_count = deletion.files
+            deleted_subfolders_count = deletion.folders - 1
+            print(f"Удаление папки {folder_id}: файлов {deleted_files_count}, подпапок {deleted_subfolders_count}")
             
-            # Delete files in the main folder
-            for file in files_in_folder:
-                # Remove file from storage
-                if file.file_path.startswith('uploads\\') or file.file_path.startswith('uploads/'):
-                    # Старый формат: file_path уже содержит полный путь
-                    full_file_path = file.file_path
-                else:
-                    # Новый формат: формируем полный путь
-                    full_file_path = os.path.join(app.config['UPLOAD_FOLDER'], file.file_path)
-                
-                if os.path.exists(full_file_path):
-                    os.remove(full_file_path)
-                    print(f"Удален файл: {full_file_path}")
-                total_size_to_remove += file.file_size
-                deleted_files_count += 1
-                # Delete file record
-                db.session.delete(file)
+            # Update user storage (SQL-side decrement, safe with concurrent uploads)
+            release_quota(current_user.id, deletion.size)
+            print(f"Хранилище пользователя уменьшено на {deletion.size} байт")
             
-            # Update user storage
-            old_storage = current_user.storage_used
-            current_user.storage_used -= total_size_to_remove
-            print(f"Хранилище пользователя обновлено: {old_storage} -> {current_user.storage_used} байт")
+            # Файлы с диска удалит фоновая задача (в той же транзакции, что и удаление записей)
+            if deletion.files:
+                enqueue_reap(deletion.legacy_paths)
             
-            # Delete main folder record
-            db.session.delete(folder)
             db.session.commit()
             print(f"Папка {folder_id} и все содержимое успешно удалены из базы данных")
             
@@ -682,13 +1004,13 @@ def create_app(config_name='default'):
             
             # Формируем сообщение об успешном удалении
             if deleted_files_count > 0 and deleted_subfolders_count > 0:
-                flash(f'Папка "{folder.name}" и все содержимое удалены. Удалено файлов: {deleted_files_count}, подпапок: {deleted_subfolders_count}', 'success')
+                flash(f'Папка "{folder_name}" и все содержимое удалены. Удалено файлов: {deleted_files_count}, подпапок: {deleted_subfolders_count}', 'success')
             elif deleted_files_count > 0:
-                flash(f'Папка "{folder.name}" и все файлы удалены. Удалено файлов: {deleted_files_count}', 'success')
+                flash(f'Папка "{folder_name}" и все файлы удалены. Удалено файлов: {deleted_files_count}', 'success')
             elif deleted_subfolders_count > 0:
-                flash(f'Папка "{folder.name}" и все подпапки удалены. Удалено подпапок: {deleted_subfolders_count}', 'success')
+                flash(f'Папка "{folder_name}" и все подпапки удалены. Удалено подпапок: {deleted_subfolders_count}', 'success')
             else:
-                flash(f'Пустая папка "{folder.name}" удалена', 'success')
+                flash(f'Пустая папка "{folder_name}" удалена', 'success')
             
         except Exception as e:
             db.session.rollback()
@@ -715,54 +1037,27 @@ def create_app(config_name='default'):
         try:
             log_activity(current_user.id, 'download', 'file', file_id)
             
-            # Используем send_from_directory для более надежной работы с путями
-            directory = os.path.abspath(app.config['UPLOAD_FOLDER'])
-            
-            # Обрабатываем разные форматы путей в БД
-            if file.file_path.startswith('uploads\\') or file.file_path.startswith('uploads/'):
-                # Старый формат: убираем 'uploads\' или 'uploads/' из начала
-                filename = file.file_path.replace('uploads\\', '').replace('uploads/', '')
-            else:
-                # Новый формат: file_path содержит только имя файла
-                filename = file.file_path
+            # Путь из БД любого формата и любой раскладки
+            full_path = get_full_path(file)
             
-            print(f"DEBUG: Директория: {directory}")
             print(f"DEBUG: Исходный file_path в БД: {file.file_path}")
-            print(f"DEBUG: Обработанное имя файла: {filename}")
-            print(f"DEBUG: Полный путь: {os.path.join(directory, filename)}")
-            print(f"DEBUG: Файл существует: {os.path.exists(os.path.join(directory, filename))}")
-            
-            # Проверяем, что директория существует
-            if not os.path.exists(directory):
-                print(f"DEBUG: Директория {directory} не существует!")
-                flash(f'Папка загрузок не найдена: {directory}', 'error')
-                return redirect(url_for('index'))
+            print(f"DEBUG: Отправляю файл: {full_path}")
             
-            # Проверяем, что файл существует
-            full_path = os.path.join(directory, filename)
-            if not os.path.exists(full_path):
-                print(f"DEBUG: Файл {full_path} не существует!")
-                flash(f'Файл не найден на сервере: {filename}', 'error')
-                return redirect(url_for('index'))
-            
-            # Проверяем, что файл читается
-            try:
-                with open(full_path, 'rb') as test_file:
-                    test_file.read(1)  # Пробуем прочитать 1 байт
-                print(f"DEBUG: Файл {full_path} читается успешно")
-            except Exception as read_error:
-                print(f"DEBUG: Ошибка чтения файла {full_path}: {read_error}")
-                flash(f'Файл не может быть прочитан: {filename}', 'error')
-                return redirect(url_for('index'))
-            
-            # Используем send_file с полным путем, так как мы уже проверили существование файла
-            print(f"DEBUG: Отправляю файл через send_file: {full_path}")
-            return send_file(
+            return send_stored_file(
                 full_path,
+                file.mime_type,
                 as_attachment=True,
                 download_name=file.original_filename,
-                mimetype=file.mime_type
+                etag=file_etag(file),
+                last_modified=file.updated_at
             )
+        except HTTPException:
+            # 304, 416 и т.п. от условных и Range-запросов
+            raise
+        except FileNotFoundError:
+            print(f"DEBUG: Файл {full_path} не существует!")
+            flash(f'Файл не найден на сервере: {file.original_filename}', 'error')
+            return redirect(url_for('index'))
         except Exception as e:
             print(f"DEBUG: Ошибка при скачивании: {str(e)}")
             flash(f'Ошибка при скачивании файла: {str(e)}', 'error')
@@ -787,32 +1082,19 @@ def create_app(config_name='default'):
         try:
             log_activity(current_user.id, 'view', 'file', file_id)
             
-            directory = os.path.abspath(app.config['UPLOAD_FOLDER'])
-            
-            # Обрабатываем разные форматы путей в БД
-            if file.file_path.startswith('uploads\\') or file.file_path.startswith('uploads/'):
-                filename = file.file_path.replace('uploads\\', '').replace('uploads/', '')
-            else:
-                filename = file.file_path
-            
-            full_path = os.path.join(directory, filename)
-            
-            if not os.path.exists(full_path):
-                abort(404)
-            
-            # Проверяем, что файл читается
-            try:
-                with open(full_path, 'rb') as test_file:
-                    test_file.read(1)
-            except Exception:
-                abort(404)
+            full_path = get_full_path(file)
             
             # Отправляем файл для просмотра (без скачивания)
-            return send_file(
+            return send_stored_file(
                 full_path,
+                file.mime_type,
                 as_attachment=False,  # Важно: False для просмотра
-                mimetype=file.mime_type
+                etag=file_etag(file),
+                last_modified=file.updated_at
             )
+        except HTTPException:
+            # 304, 416 и т.п. от условных и Range-запросов
+            raise
         except Exception as e:
             print(f"DEBUG: Ошибка при просмотре файла: {str(e)}")
             abort(404)
@@ -836,99 +1118,195 @@ def create_app(config_name='default'):
         if not file.mime_type.startswith('image/'):
             abort(404)
         
+        # Размер и формат миниатюры (srcset в шаблонах запрашивает несколько размеров)
+        rendition = request.args.get('size', thumbnails.DEFAULT_RENDITION)
+        fmt = request.args.get('format', 'jpeg')
+        if rendition not in thumbnails.RENDITIONS or fmt not in thumbnails.THUMBNAIL_FORMATS:
+            abort(404)
+        if fmt not in thumbnails.get_thumbnail_formats():
+            # Pillow собран без WebP - отдаем JPEG
+            fmt = 'jpeg'
+        
+        if not PIL_AVAILABLE:
+            abort(404)
+        
+        version = file_etag(file)
+        
         try:
-            directory = os.path.abspath(app.config['UPLOAD_FOLDER'])
-            
-            # Обрабатываем разные форматы путей в БД
-            if file.file_path.startswith('uploads\\') or file.file_path.startswith('uploads/'):
-                filename = file.file_path.replace('uploads\\', '').replace('uploads/', '')
-            else:
-                filename = file.file_path
-            
-            full_path = os.path.join(directory, filename)
-            thumbnail_path = get_thumbnail_path(filename)
-            
-            if not os.path.exists(full_path):
-                abort(404)
+            data = load_thumbnail(file, rendition, fmt)
             
             # Если миниатюра не существует, создаем ее
-            if not os.path.exists(thumbnail_path):
-                if PIL_AVAILABLE:
-                    success = generate_thumbnail(full_path, thumbnail_path)
-                    if not success:
-                        # Если не удалось создать миниатюру, возвращаем оригинал
-                        return send_file(full_path, mimetype=file.mime_type)
-                else:
-                    # Если PIL недоступен, возвращаем оригинал
-                    return send_file(full_path, mimetype=file.mime_type)
+            if data is None:
+                # Миниатюру еще создает фоновая задача - не занимаем запрос ресайзом
+                if get_pending_jobs(file.id):
+                    return jsonify({'success': False, 'processing': True}), 202
+                
+                # Оригинал вместо миниатюры не отдаем: шаблон покажет значок файла
+                if not generate_renditions(get_full_path(file), app.config['UPLOAD_FOLDER'], file.file_path):
+                    abort(404)
+                data = load_thumbnail(file, rendition, fmt)
             
             # Отправляем миниатюру
-            return send_file(thumbnail_path, mimetype='image/jpeg')
+            response = app.response_class(data, mimetype=thumbnails.THUMBNAIL_FORMATS[fmt][1])
+            response.set_etag(f"{version}-{rendition}-{fmt}")
+            response.cache_control.private = True
+            if request.args.get('v') == version:
+                # Версионный адрес (thumbnail_url) не меняет содержимого - браузер не перепроверяет его
+                response.cache_control.max_age = 365 * 24 * 3600
+                response.cache_control.immutable = True
+            else:
+                response.cache_control.no_cache = True
+            return response.make_conditional(request)
             
+        except HTTPException:
+            raise
         except Exception as e:
             print(f"Ошибка при получении миниатюры: {str(e)}")
-            # В случае ошибки возвращаем оригинал
-            try:
-                return send_file(full_path, mimetype=file.mime_type)
-            except:
-                abort(404)
+            abort(404)
+    
+    @app.route('/api/thumbnails')
+    @login_required
+    def get_thumbnails_batch():
+        """Миниатюры нескольких изображений одним ответом (base64).
+
+        Параметры: ids - список id через запятую или folder - id папки (0 - корень),
+        size и format - как у /thumbnail. Права проверяются одним запросом.
+        Изображения, для которых миниатюр еще нет, перечисляются в missing -
+        их страница загружает по отдельности.
+        """
+        rendition = request.args.get('size', 'list')
+        fmt = request.args.get('format', 'webp')
+        if rendition not in thumbnails.RENDITIONS or fmt not in thumbnails.THUMBNAIL_FORMATS:
+            return jsonify({'success': False, 'error': 'Неизвестный размер или формат миниатюры'}), 400
+        if fmt not in thumbnails.get_thumbnail_formats():
+            # Pillow собран без WebP - отдаем JPEG
+            fmt = 'jpeg'
+        
+        if not PIL_AVAILABLE:
+            return jsonify({'success': False, 'error': 'PIL/Pillow не установлен'}), 404
+        
+        try:
+            query = File.query.filter(File.mime_type.like('image/%'))
+            if request.args.get('ids'):
+                try:
+                    ids = [int(file_id) for file_id in request.args['ids'].split(',')]
+                except ValueError:
+                    return jsonify({'success': False, 'error': 'Некорректный список файлов'}), 400
+                if len(ids) > thumbnails.MAX_BATCH_THUMBNAILS:
+                    return jsonify({'success': False, 'error': f'Не больше {thumbnails.MAX_BATCH_THUMBNAILS} миниатюр за запрос'}), 400
+                
+                # Свои файлы и файлы, к которым открыт доступ (EXISTS - без дублей
+                # при нескольких записях доступа к одному файлу)
+                query = query.filter(
+                    File.id.in_(ids),
+                    or_(
+                        File.user_id == current_user.id,
+                        exists().where(FileShare.file_id == File.id, FileShare.shared_with == current_user.id)
+                    )
+                )
+            else:
+                folder_id = request.args.get('folder', 0, type=int) or None
+                query = query.filter(
+                    File.user_id == current_user.id,
+                    File.folder_id == folder_id
+                ).order_by(File.id).limit(thumbnails.MAX_BATCH_THUMBNAILS)
+            
+            mime = thumbnails.THUMBNAIL_FORMATS[fmt][1]
+            result = {}
+            missing = []
+            for file in query.all():
+                data = load_thumbnail(file, rendition, fmt)
+                if data is None:
+                    missing.append(file.id)
+                    continue
+                result[file.id] = f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+            
+            return jsonify({
+                'success': True,
+                'thumbnails': result,
+                'missing': missing
+            })
+            
+        except Exception as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 500
+    
+    def get_pending_jobs(file_id):
+        """Незавершенные фоновые задачи файла"""
+        return Job.query.filter(
+            Job.file_id == file_id,
+            Job.status.in_(('queued', 'running'))
+        ).all()
+    
+    @app.route('/api/file/<int:file_id>/status')
+    @login_required
+    def get_file_status(file_id):
+        """API endpoint для получения состояния фоновой обработки файла"""
+        file = File.query.get_or_404(file_id)
+        
+        # Проверяем права доступа
+        if file.user_id != current_user.id:
+            share = FileShare.query.filter_by(
+                file_id=file_id, 
+                shared_with=current_user.id
+            ).first()
+            if not share:
+                abort(403)
+        
+        jobs = Job.query.filter_by(file_id=file.id).order_by(Job.id).all()
+        
+        return jsonify({
+            'success': True,
+            'file_id': file.id,
+            'processing': any(job.status in ('queued', 'running') for job in jobs),
+            'thumbnail_ready': bool(
+                file.mime_type.startswith('image/') and PIL_AVAILABLE
+                and renditions_exist(app.config['UPLOAD_FOLDER'], file.file_path)
+            ),
+            'jobs': [job.to_dict() for job in jobs]
+        })
+    
+    def start_bulk_thumbnails(user_id):
+        """Ставит в очередь массовую генерацию миниатюр.
+
+        Если такая задача для тех же файлов уже ждет или выполняется,
+        возвращается она - повторное нажатие кнопки не запускает вторую.
+        """
+        active_jobs = Job.query.filter(
+            Job.kind == 'thumbnail_bulk',
+            Job.status.in_(('queued', 'running'))
+        ).all()
+        for job in active_jobs:
+            if json.loads(job.payload or '{}').get('user_id') == user_id:
+                return job
+
+        job = enqueue('thumbnail_bulk', {'user_id': user_id, 'requested_by': current_user.id}, max_attempts=1)
+        db.session.commit()
+        return job
     
     @app.route('/admin/generate-thumbnails', methods=['POST'])
     @login_required
     def generate_all_thumbnails():
-        """Маршрут для массовой генерации миниатюр всех изображений"""
+        """Маршрут для массовой генерации миниатюр изображений всех пользователей"""
         # Проверяем права администратора
         if not current_user.is_admin:
             abort(403)
         
+        if not PIL_AVAILABLE:
+            return jsonify({'success': False, 'error': 'PIL/Pillow не установлен'}), 400
+        
         try:
-            # Получаем все изображения пользователя
-            images = File.query.filter(
-                File.user_id == current_user.id,
-                File.mime_type.like('image/%')
-            ).all()
-            
-            generated_count = 0
-            failed_count = 0
-            
-            for image in images:
-                try:
-                    directory = os.path.abspath(app.config['UPLOAD_FOLDER'])
-                    
-                    # Обрабатываем разные форматы путей в БД
-                    if image.file_path.startswith('uploads\\') or image.file_path.startswith('uploads/'):
-                        filename = image.file_path.replace('uploads\\', '').replace('uploads/', '')
-                    else:
-                        filename = image.file_path
-                    
-                    full_path = os.path.join(directory, filename)
-                    thumbnail_path = get_thumbnail_path(filename)
-                    
-                    if os.path.exists(full_path) and PIL_AVAILABLE:
-                        if not os.path.exists(thumbnail_path):
-                            success = generate_thumbnail(full_path, thumbnail_path)
-                            if success:
-                                generated_count += 1
-                            else:
-                                failed_count += 1
-                        else:
-                            # Миниатюра уже существует
-                            generated_count += 1
-                    else:
-                        failed_count += 1
-                        
-                except Exception as e:
-                    print(f"Ошибка при создании миниатюры для {image.original_filename}: {e}")
-                    failed_count += 1
-            
+            job = start_bulk_thumbnails(None)
             return jsonify({
                 'success': True,
-                'generated': generated_count,
-                'failed': failed_count,
-                'message': f'Создано миниатюр: {generated_count}, ошибок: {failed_count}'
+                'job_id': job.id,
+                'message': 'Создание миниатюр запущено'
             })
             
         except Exception as e:
+            db.session.rollback()
             return jsonify({
                 'success': False,
                 'error': str(e)
@@ -938,59 +1316,84 @@ def create_app(config_name='default'):
     @login_required
     def generate_user_thumbnails():
         """Маршрут для генерации миниатюр изображений пользователя"""
+        if not PIL_AVAILABLE:
+            return jsonify({'success': False, 'error': 'PIL/Pillow не установлен'}), 400
+        
         try:
-            # Получаем все изображения пользователя
-            images = File.query.filter(
-                File.user_id == current_user.id,
-                File.mime_type.like('image/%')
-            ).all()
-            
-            generated_count = 0
-            failed_count = 0
-            
-            for image in images:
-                try:
-                    directory = os.path.abspath(app.config['UPLOAD_FOLDER'])
-                    
-                    # Обрабатываем разные форматы путей в БД
-                    if image.file_path.startswith('uploads\\') or image.file_path.startswith('uploads/'):
-                        filename = image.file_path.replace('uploads\\', '').replace('uploads/', '')
-                    else:
-                        filename = image.file_path
-                    
-                    full_path = os.path.join(directory, filename)
-                    thumbnail_path = get_thumbnail_path(filename)
-                    
-                    if os.path.exists(full_path) and PIL_AVAILABLE:
-                        if not os.path.exists(thumbnail_path):
-                            success = generate_thumbnail(full_path, thumbnail_path)
-                            if success:
-                                generated_count += 1
-                            else:
-                                failed_count += 1
-                        else:
-                            # Миниатюра уже существует
-                            generated_count += 1
-                    else:
-                        failed_count += 1
-                        
-                except Exception as e:
-                    print(f"Ошибка при создании миниатюры для {image.original_filename}: {e}")
-                    failed_count += 1
-            
+            job = start_bulk_thumbnails(current_user.id)
             return jsonify({
                 'success': True,
-                'generated': generated_count,
-                'failed': failed_count,
-                'message': f'Создано миниатюр: {generated_count}, ошибок: {failed_count}'
+                'job_id': job.id,
+                'message': 'Создание миниатюр запущено'
             })
             
         except Exception as e:
+            db.session.rollback()
             return jsonify({
                 'success': False,
                 'error': str(e)
             }), 500
     
+    @app.route('/admin/thumbnail-stats')
+    @login_required
+    def thumbnail_stats():
+        """Статистика кеша миниатюр: память этого процесса и результат последней очистки диска"""
+        if not current_user.is_admin:
+            abort(403)
+        
+        last_gc = Job.query.filter_by(kind='thumbnail_gc', status='done').order_by(Job.id.desc()).first()
+        return jsonify({
+            'success': True,
+            'cache': thumbnail_cache.stats(),
+            'disk_limit': app.config['THUMBNAIL_DISK_LIMIT'],
+            'disk': json.loads(last_gc.payload or '{}').get('result') if last_gc else None
+        })
+    
+    @app.route('/admin/thumbnail-gc', methods=['POST'])
+    @login_required
+    def run_thumbnail_gc():
+        """Запускает очистку миниатюр в фоне"""
+        if not current_user.is_admin:
+            abort(403)
+        
+        try:
+            queued = Job.query.filter_by(kind='thumbnail_gc', status='queued').first()
+            if queued is not None:
+                # Периодическая очистка уже ждет - выполняем ее сейчас
+                queued.run_after = datetime.utcnow()
+                job = queued
+            else:
+                job = thumbnails.schedule_thumbnail_gc(delay=0)
+            db.session.commit()
+            return jsonify({
+                'success': True,
+                'job_id': job.id,
+                'message': 'Очистка миниатюр запущена'
+            })
+        
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 500
+    
+    @app.route('/api/jobs/<int:job_id>')
+    @login_required
+    def job_status(job_id):
+        """Состояние фоновой задачи и ее прогресс (для массовых операций)"""
+        job = Job.query.get_or_404(job_id)
+        payload = json.loads(job.payload or '{}')
+        
+        if not current_user.is_admin and payload.get('requested_by') != current_user.id:
+            abort(403)
+        
+        return jsonify({
+            'success': True,
+            'job': job.to_dict(),
+            'progress': payload.get('progress')
+        })
+    
     @app.route('/file/<int:file_id>/delete', methods=['POST'])
     @login_required
     def delete_file(file_id):
@@ -1004,30 +1407,23 @@ def create_app(config_name='default'):
             abort(403)
         
         try:
-            # Remove file from storage
-            if file.file_path.startswith('uploads\\') or file.file_path.startswith('uploads/'):
-                # Старый формат: file_path уже содержит полный путь
-                full_file_path = file.file_path
-            else:
-                # Новый формат: формируем полный путь
-                full_file_path = os.path.join(app.config['UPLOAD_FOLDER'], file.file_path)
-            
-            if os.path.exists(full_file_path):
-                os.remove(full_file_path)
-                print(f"Файл удален физически: {full_file_path}")
-            else:
-                print(f"Файл не найден физически: {full_file_path}")
+            # Release file content: shared blobs stay on disk while referenced
+            data = release_file_data(file)
             
-            # Update user storage
-            old_storage = current_user.storage_used
-            current_user.storage_used -= file.file_size
-            print(f"Хранилище пользователя обновлено: {old_storage} -> {current_user.storage_used} байт")
+            # Update user storage (SQL-side decrement, safe with concurrent uploads)
+            release_quota(current_user.id, file.file_size)
+            print(f"Хранилище пользователя уменьшено на {file.file_size} байт")
+            adjust_folder_totals(file.folder_id, -file.file_size, -1)
             
-            # Delete file record
+            # Delete file record (with its indexed text)
+            FileContent.query.filter_by(file_id=file.id).delete()
             db.session.delete(file)
             db.session.commit()
             print(f"Файл {file_id} успешно удален из базы данных")
             
+            if data:
+                remove_released_data([data])
+            
             # Log activity
             try:
                 log_activity(current_user.id, 'delete', 'file', file_id)
@@ -1044,31 +1440,43 @@ def create_app(config_name='default'):
         
         return redirect(url_for('index'))
     
-    @app.route('/search', methods=['GET', 'POST'])
+    @app.route('/search')
     @login_required
+    @query_budget(8)  # пользователь, фасеты, поиск по индексу (без индекса - вдвое больше), найденные файлы и папки
     def search():
-        form = SearchForm()
-        results = []
-        
-        if form.validate_on_submit():
-            query = form.query.data.lower()
-            search_type = form.search_type.data
-            
-            if search_type in ['all', 'files']:
-                files = File.query.filter(
-                    File.user_id == current_user.id,
-                    File.original_filename.ilike(f'%{query}%')
-                ).all()
-                results.extend([('file', f) for f in files])
-            
-            if search_type in ['all', 'folders']:
-                folders = Folder.query.filter(
-                    Folder.user_id == current_user.id,
-                    Folder.name.ilike(f'%{query}%')
-                ).all()
-                results.extend([('folder', f) for f in folders])
-        
-        return render_template('search.html', form=form, results=results)
+        form = SearchForm(request.args)
+        if not form.validate():
+            # Параметры подделанной или устаревшей ссылки сбрасываются к значениям по умолчанию
+            for name in form.errors:
+                form[name].data = form[name].default
+                form[name].raw_data = None
+        query = (form.q.data or '').strip()
+        search_type = form.type.data
+        page = form.page.data or 1
+        # Фильтры по типу, размеру, дате и доступу (search_filters.py)
+        filters = form_filters(form)
+        
+        # Поиск по индексу имен или содержимого (search_index.py), с ранжированием и постранично;
+        # без слов запроса - файлы под фильтрами, новые первыми
+        results, has_next, snippets = [], False, {}
+        if query or has_filters(filters):
+            results, has_next, snippets = search_items(search_backend, current_user.id, query, search_type, page, filters=filters)
+        
+        # Счетчики всех значений фильтров - одним запросом
+        facets = count_facets(search_backend, current_user.id, query, search_type, filters)
+        
+        return render_template('search.html',
+                            form=form,
+                            query=query,
+                            search_type=search_type,
+                            filters=filters,
+                            filter_args=filter_args(filters),
+                            searched=bool(query) or has_filters(filters),
+                            facets=facets,
+                            results=results,
+                            snippets=snippets,
+                            page=page,
+                            has_next=has_next)
     
     @app.route('/settings', methods=['GET', 'POST'])
     @login_required
@@ -1138,20 +1546,17 @@ DEBUG={app.config['DEBUG']}
     def public_file(public_url):
         file = File.query.filter_by(public_url=public_url, is_public=True).first_or_404()
         
-        # Обрабатываем разные форматы путей в БД
-        if file.file_path.startswith('uploads\\') or file.file_path.startswith('uploads/'):
-            # Старый формат: убираем 'uploads\' или 'uploads/' из начала
-            filename = file.file_path.replace('uploads\\', '').replace('uploads/', '')
-        else:
-            # Новый формат: file_path содержит только имя файла
-            filename = file.file_path
-        
-        return send_from_directory(
-            os.path.abspath(app.config['UPLOAD_FOLDER']),
-            filename,
-            as_attachment=True, 
-            download_name=file.original_filename
-        )
+        try:
+            return send_stored_file(
+                get_full_path(file),
+                file.mime_type,
+                as_attachment=True, 
+                download_name=file.original_filename,
+                etag=file_etag(file),
+                last_modified=file.updated_at
+            )
+        except FileNotFoundError:
+            abort(404)
     
     @app.route('/folder/<int:folder_id>/move', methods=['POST'])
     @login_required
@@ -1161,6 +1566,7 @@ DEBUG={app.config['DEBUG']}
             abort(403)
         
         target_folder_id = request.form.get('target_folder_id', type=int)
+        target_folder = None
         
         # Проверяем, что целевая папка существует и принадлежит пользователю
         if target_folder_id != 0:
@@ -1173,17 +1579,19 @@ DEBUG={app.config['DEBUG']}
                 flash('Нельзя переместить папку в саму себя', 'error')
                 return redirect(url_for('index', folder=request.args.get('folder', 0, type=int)))
             
-            # Проверяем, что целевая папка не является подпапкой текущей
-            current = target_folder
-            while current.parent_id:
-                if current.parent_id == folder_id:
-                    flash('Нельзя переместить папку в её подпапку', 'error')
-                    return redirect(url_for('index', folder=request.args.get('folder', 0, type=int)))
-                current = current.parent
-        
-        # Перемещаем папку
+            # Проверяем, что целевая папка не является подпапкой текущей (по tree_path, без обхода предков)
+            if is_in_subtree(folder, target_folder):
+                flash('Нельзя переместить папку в её подпапку', 'error')
+                return redirect(url_for('index', folder=request.args.get('folder', 0, type=int)))
+        
+        # Перемещаем папку вместе с путями всех вложенных папок
         old_parent_id = folder.parent_id
-        folder.parent_id = target_folder_id if target_folder_id != 0 else None
+        update_subtree(folder, target_folder, folder.name)
+        if folder.parent_id != old_parent_id:
+            # Итоги переносятся от старых предков к новым
+            moved = (folder.total_size, folder.file_count, folder.folder_count + 1)
+            adjust_folder_totals(old_parent_id, *(-value for value in moved))
+            adjust_folder_totals(folder.parent_id, *moved)
         db.session.commit()
         
         log_activity(current_user.id, 'move_folder', 'folder', folder.id)
@@ -1209,6 +1617,9 @@ DEBUG={app.config['DEBUG']}
         # Перемещаем файл
         old_folder_id = file.folder_id
         file.folder_id = target_folder_id if target_folder_id != 0 else None
+        if file.folder_id != old_folder_id:
+            adjust_folder_totals(old_folder_id, -file.file_size, -1)
+            adjust_folder_totals(file.folder_id, file.file_size, 1)
         db.session.commit()
         
         log_activity(current_user.id, 'move_file', 'file', file.id)
@@ -1272,7 +1683,7 @@ DEBUG={app.config['DEBUG']}
         
         try:
             old_name = folder.name
-            folder.name = new_name
+            update_subtree(folder, folder.parent, new_name)
             folder.updated_at = datetime.utcnow()
             db.session.commit()
             
@@ -1343,19 +1754,16 @@ DEBUG={app.config['DEBUG']}
             abort(403)
         
         try:
-            # Подсчитываем файлы в папке
-            files_count = File.query.filter_by(folder_id=folder.id).count()
-            
-            # Подсчитываем подпапки в папке
-            subfolders_count = Folder.query.filter_by(parent_id=folder.id).count()
-            
+            # Итоги по всему поддереву хранятся в самой папке
             return jsonify({
                 'success': True,
                 'folder_id': folder_id,
                 'folder_name': folder.name,
-                'files_count': files_count,
-                'subfolders_count': subfolders_count,
-                'total_items': files_count + subfolders_count
+                'files_count': folder.file_count,
+                'subfolders_count': folder.folder_count,
+                'total_items': folder.file_count + folder.folder_count,
+                'total_size': folder.total_size,
+                'total_size_formatted': folder.get_total_size_formatted()
             })
             
         except Exception as e:
@@ -1364,9 +1772,54 @@ DEBUG={app.config['DEBUG']}
                 'error': str(e)
             }), 500
     
-    def log_activity(user_id, action, resource_type, resource_id):
-        """Log user activity"""
-        log = ActivityLog(
+    @app.route('/api/folder/<int:folder_id>/items')
+    @login_required
+    @query_budget(4)  # пользователь, папка, страница папок и файлов
+    def get_folder_items(folder_id):
+        """Страница содержимого папки (0 - корень) с сортировкой и курсором.
+        
+        Параметры: sort (name, size, date, type), order (asc, desc), cursor -
+        next_cursor предыдущей страницы, limit. С render=html в ответ добавляется
+        разметка страницы для обоих представлений списка.
+        """
+        if folder_id != 0:
+            folder = Folder.query.get_or_404(folder_id)
+            if folder.user_id != current_user.id:
+                abort(403)
+        
+        try:
+            page = list_folder_page(
+                current_user.id,
+                folder_id or None,
+                request.args.get('sort', 'name'),
+                request.args.get('order', 'asc'),
+                request.args.get('cursor') or None,
+                request.args.get('limit', LISTING_PAGE_SIZE, type=int)
+            )
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        try:
+            result = {
+                'success': True,
+                'folders': [folder.to_dict() for folder in page.folders],
+                'files': [file.to_dict() for file in page.files],
+                'next_cursor': page.next_cursor
+            }
+            if request.args.get('render') == 'html':
+                result['tile_html'] = get_template_attribute('_listing.html', 'tile_items')(page.folders, page.files)
+                result['table_html'] = get_template_attribute('_listing.html', 'table_rows')(page.folders, page.files)
+            return jsonify(result)
+            
+        except Exception as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 500
+    
+    def build_activity_log(user_id, action, resource_type, resource_id):
+        """Create activity log entry without committing"""
+        return ActivityLog(
             user_id=user_id,
             action=action,
             resource_type=resource_type,
@@ -1374,7 +1827,10 @@ DEBUG={app.config['DEBUG']}
             ip_address=request.remote_addr,
             user_agent=request.user_agent.string
         )
-        db.session.add(log)
+    
+    def log_activity(user_id, action, resource_type, resource_id):
+        """Log user activity"""
+        db.session.add(build_activity_log(user_id, action, resource_type, resource_id))
         db.session.commit()
     
     # Error handlers
@@ -1396,9 +1852,9 @@ DEBUG={app.config['DEBUG']}
 if __name__ == '__main__':
     app = create_app()
     
-    # Create database tables
+    # Create database tables, apply migrations, rebuild folder paths (как run.py)
     with app.app_context():
-        db.create_all()
+        prepare_database()
         
         # Create admin user if none exists
         admin = User.query.filter_by(is_admin=True).first()
@@ -1414,6 +1870,16 @@ if __name__ == '__main__':
             db.session.commit()
             print("Admin user created: username=admin, password=admin123")
     
+    # Periodic cleanup jobs (thumbnails, abandoned upload sessions)
+    with app.app_context():
+        thumbnails.schedule_thumbnail_gc()
+        schedule_upload_session_gc()
+        db.session.commit()
+    
+    # Start background job workers inside the web process
+    if app.config['JOBS_INPROCESS']:
+        WorkerPool(app).start()
+    
     # Get port from environment or use default
     port = int(os.environ.get('PORT', 5000))
     
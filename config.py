@@ -8,6 +8,34 @@ class Config:
     UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or 'uploads'
     MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 1073741824))  # 1GB по умолчанию
     STORAGE_LIMIT_DEFAULT = int(os.environ.get('STORAGE_LIMIT_DEFAULT', 1073741824))  # 1GB по умолчанию
+    UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 8388608))  # 8MB по умолчанию
+    UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))  # потоков записи файлов одной загрузки
+    UPLOAD_SESSION_TTL = int(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600))  # секунды без новых частей до истечения сессии загрузки
+    UPLOAD_SESSION_GC_INTERVAL = int(os.environ.get('UPLOAD_SESSION_GC_INTERVAL', 3600))  # секунды между проверками просроченных сессий, 0 - не проверять
+    
+    # Отдача файлов: direct (через Flask), x-accel (nginx X-Accel-Redirect), x-sendfile (Apache/lighttpd)
+    FILE_SERVING_MODE = os.environ.get('FILE_SERVING_MODE', 'direct').lower()
+    X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX') or '/protected/'  # internal location nginx, указывающий на UPLOAD_FOLDER
+    
+    # Background job queue
+    JOBS_INPROCESS = os.environ.get('JOBS_INPROCESS', 'true').lower() in ('1', 'true', 'yes')  # обработчики в веб-процессе
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1.0))  # секунды
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+    JOB_RETRY_DELAY = int(os.environ.get('JOB_RETRY_DELAY', 5))  # секунды, удваивается с каждой попыткой
+    JOB_RETRY_MAX_DELAY = int(os.environ.get('JOB_RETRY_MAX_DELAY', 3600))  # секунды
+    JOB_LOCK_TIMEOUT = int(os.environ.get('JOB_LOCK_TIMEOUT', 600))  # секунды до возврата зависшей задачи
+    THUMBNAIL_PROCESSES = int(os.environ.get('THUMBNAIL_PROCESSES', 0))  # процессов массовой генерации миниатюр, 0 - по числу ядер
+    THUMBNAIL_CACHE_SIZE = int(os.environ.get('THUMBNAIL_CACHE_SIZE', 64 * 1024 * 1024))  # байт миниатюр в памяти процесса
+    THUMBNAIL_DISK_LIMIT = int(os.environ.get('THUMBNAIL_DISK_LIMIT', 2 * 1024 * 1024 * 1024))  # байт миниатюр на диске, 0 - без ограничения
+    THUMBNAIL_GC_INTERVAL = int(os.environ.get('THUMBNAIL_GC_INTERVAL', 3600))  # секунды между очистками миниатюр, 0 - только вручную
+    CONTENT_INDEX_MAX_BYTES = int(os.environ.get('CONTENT_INDEX_MAX_BYTES', 8 * 1024 * 1024))  # байт файла (распакованного XML для OOXML), читаемых для индекса содержимого
+    CONTENT_INDEX_MAX_CHARS = int(os.environ.get('CONTENT_INDEX_MAX_CHARS', 200000))  # символов текста, сохраняемых для поиска по содержимому
+    
+    # Проверка бюджета SQL-запросов маршрутов (query_budget.py): по умолчанию - в режиме отладки и тестирования
+    QUERY_BUDGET_CHECK = {'1': True, 'true': True, 'yes': True, '0': False, 'false': False, 'no': False}.get(
+        os.environ.get('QUERY_BUDGET_CHECK', '').lower()
+    )
     
     # Database configurations
     DATABASE_TYPE = os.environ.get('DATABASE_TYPE', 'sqlite').lower()
@@ -0,0 +1,179 @@
+"""
+Cloud Storage Server - индекс содержимого файлов
+
+Фоновая задача content_index извлекает текст из загруженных текстовых
+файлов (text/*, JSON, XML) и документов Office Open XML (docx, xlsx, pptx -
+zip-архивы с XML, читаются стандартной библиотекой) и сохраняет его в
+FileContent. Поиск по этому тексту выполняет тот же индекс, что и поиск по
+именам (search_index.py).
+
+Чтение ограничено CONTENT_INDEX_MAX_BYTES байт файла (для OOXML - байт
+распакованного XML), сохраняется не больше CONTENT_INDEX_MAX_CHARS символов.
+"""
+
+import re
+import codecs
+import zipfile
+import xml.etree.ElementTree as ET
+from flask import current_app
+from sqlalchemy import exists
+from models import db, File, FileContent, Job
+from jobs import job_handler, enqueue
+from storage import resolve_path
+
+# Типы, кроме text/*, содержимое которых - обычный текст
+TEXT_MIME_TYPES = {'application/json', 'application/xml', 'application/javascript'}
+
+# Документы OOXML: части архива с текстом
+OOXML_PARTS = {
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
+        re.compile(r'word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$'),
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet':
+        re.compile(r'xl/sharedStrings\.xml$'),
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation':
+        re.compile(r'ppt/(slides/slide|notesSlides/notesSlide)\d+\.xml$'),
+}
+
+# Размер блока чтения
+READ_BLOCK_SIZE = 64 * 1024
+
+def is_indexable(mime_type):
+    """Извлекается ли текст из файлов этого типа"""
+    return mime_type.startswith('text/') or mime_type in TEXT_MIME_TYPES or mime_type in OOXML_PARTS
+
+def decode_text(data):
+    """Декодирует начало текстового файла: UTF-8 (в том числе обрезанный посреди символа), иначе cp1251"""
+    if data.startswith(codecs.BOM_UTF8):
+        data = data[len(codecs.BOM_UTF8):]
+    try:
+        return codecs.getincrementaldecoder('utf-8')().decode(data, final=False)
+    except UnicodeDecodeError:
+        return data.decode('cp1251', errors='replace')
+
+def extract_plain_text(path, max_bytes):
+    """Текст из начала файла; двоичные файлы (с нулевыми байтами) дают пустую строку"""
+    with open(path, 'rb') as f:
+        data = f.read(max_bytes)
+    if b'\x00' in data[:READ_BLOCK_SIZE]:
+        return ''
+    return decode_text(data)
+
+def extract_xml_text(stream, max_bytes, parts):
+    """Добавляет в parts текст элементов <t> (w:t, a:t, t) из XML-потока.
+
+    Абзацы (<p>) разделяются переводом строки. Возвращает число прочитанных байт.
+    """
+    parser = ET.XMLPullParser(events=('end',))
+    read = 0
+    while read < max_bytes:
+        block = stream.read(min(READ_BLOCK_SIZE, max_bytes - read))
+        if not block:
+            break
+        read += len(block)
+        parser.feed(block)
+        for _, element in parser.read_events():
+            tag = element.tag.rsplit('}', 1)[-1]
+            if tag == 't' and element.text:
+                parts.append(element.text)
+            elif tag == 'p':
+                parts.append('\n')
+            # Обработанные элементы не нужны - память не растет с размером документа
+            element.clear()
+    return read
+
+def extract_ooxml_text(path, mime_type, max_bytes):
+    """Текст документа OOXML; не больше max_bytes распакованного XML на весь документ"""
+    pattern = OOXML_PARTS[mime_type]
+    parts = []
+    with zipfile.ZipFile(path) as archive:
+        names = sorted(
+            (name for name in archive.namelist() if pattern.match(name)),
+            key=lambda name: [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+        )
+        budget = max_bytes
+        for name in names:
+            if budget <= 0:
+                break
+            with archive.open(name) as stream:
+                budget -= extract_xml_text(stream, budget, parts)
+            parts.append('\n')
+    return ''.join(parts)
+
+def extract_text(path, mime_type, max_bytes, max_chars):
+    """Текст файла для индекса: (text, truncated)"""
+    if mime_type in OOXML_PARTS:
+        text = extract_ooxml_text(path, mime_type, max_bytes)
+    else:
+        text = extract_plain_text(path, max_bytes)
+
+    # PostgreSQL не хранит нулевые символы в text; лишние пробелы не нужны индексу
+    text = re.sub(r'[ \t\r\f\v\x00]+', ' ', text)
+    text = re.sub(r'\n\s*\n+', '\n', text).strip()
+    truncated = len(text) > max_chars
+    return text[:max_chars], truncated
+
+def save_file_content(file_id, text, truncated):
+    """Сохраняет текст файла (commit делает вызывающий код)"""
+    content = db.session.get(FileContent, file_id)
+    if content is None:
+        db.session.add(FileContent(file_id=file_id, content=text, truncated=truncated))
+    else:
+        content.content = text
+        content.truncated = truncated
+
+@job_handler('content_index')
+def content_index_job(job, payload):
+    """Фоновое извлечение текста загруженного файла"""
+    file = db.session.get(File, job.file_id)
+    if file is None or not is_indexable(file.mime_type):
+        # Файл удален до обработки задачи
+        return
+
+    # То же содержимое уже проиндексировано у другого файла - копируем текст
+    if file.content_hash is not None:
+        indexed = db.session.query(FileContent).join(File, File.id == FileContent.file_id).filter(
+            File.content_hash == file.content_hash, File.id != file.id
+        ).first()
+        if indexed is not None:
+            save_file_content(file.id, indexed.content, indexed.truncated)
+            return
+
+    config = current_app.config
+    path = resolve_path(config['UPLOAD_FOLDER'], file.file_path)
+    try:
+        text, truncated = extract_text(path, file.mime_type, config['CONTENT_INDEX_MAX_BYTES'], config['CONTENT_INDEX_MAX_CHARS'])
+    except (zipfile.BadZipFile, ET.ParseError) as e:
+        # Повторять бессмысленно: документ поврежден; пустой текст - чтобы не индексировать снова
+        job.last_error = str(e)
+        text, truncated = '', False
+    save_file_content(file.id, text, truncated)
+
+def enqueue_content_index(db_file):
+    """Ставит извлечение текста загруженного файла в очередь (в текущей транзакции)"""
+    if is_indexable(db_file.mime_type):
+        enqueue('content_index', file_id=db_file.id)
+
+def backfill_content_index(batch_size=500):
+    """Ставит в очередь индексацию файлов, загруженных до появления индекса содержимого.
+
+    Пропускает уже проиндексированные файлы и файлы с задачей в очереди.
+    Возвращает число поставленных задач.
+    """
+    indexable = File.mime_type.like('text/%') | File.mime_type.in_(TEXT_MIME_TYPES | set(OOXML_PARTS))
+    query = File.query.filter(
+        indexable,
+        ~exists().where(FileContent.file_id == File.id),
+        ~exists().where(Job.file_id == File.id, Job.kind == 'content_index', Job.status.in_(('queued', 'running')))
+    )
+    queued = 0
+    last_id = 0
+    while True:
+        file_ids = [file_id for (file_id,) in query.with_entities(File.id).filter(File.id > last_id).order_by(File.id).limit(batch_size)]
+        if not file_ids:
+            break
+        last_id = file_ids[-1]
+        for file_id in file_ids:
+            enqueue('content_index', file_id=file_id)
+        db.session.commit()
+        queued += len(file_ids)
+    return queued
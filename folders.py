@@ -0,0 +1,236 @@
+"""
+Cloud Storage Server - дерево папок
+
+Каждая папка хранит материализованный путь из id предков (tree_path,
+например /3/17/42/) и путь из имен (path, например Документы/2024/Счета).
+Предки, потомки и проверка перемещения в собственную подпапку выполняются
+одним запросом независимо от глубины; при переименовании и перемещении
+пути всего поддерева обновляются одним UPDATE, удаление дерева - несколько
+массовых запросов. Итоги поддерева (объем, число файлов и папок) хранятся
+в самой папке и обновляются вместе с содержимым.
+"""
+
+from collections import namedtuple
+from sqlalchemy import and_, func, literal, select, String
+from models import db, Folder, File, FileShare, FileContent, Blob, UploadSession
+
+# Разделитель в tree_path и path
+TREE_SEPARATOR = '/'
+
+FolderDeletion = namedtuple('FolderDeletion', ['folders', 'files', 'size', 'legacy_paths'])
+
+class FolderTreeNotBuiltError(Exception):
+    """У папки не заполнен tree_path: БД обновлена, но пути папок не пересчитаны"""
+
+def require_tree_path(folder):
+    """tree_path папки; без него запросы по поддереву молча ничего не находят, поэтому - ошибка"""
+    if folder.tree_path is None:
+        raise FolderTreeNotBuiltError(
+            f'У папки {folder.id} не заполнен tree_path - выполните python run.py --rebuild-folder-tree'
+        )
+    return folder.tree_path
+
+def build_tree_path(parent, folder_id):
+    """tree_path папки с указанным родителем (None - корень)"""
+    prefix = require_tree_path(parent) if parent is not None else TREE_SEPARATOR
+    return f"{prefix}{folder_id}{TREE_SEPARATOR}"
+
+def build_path(parent, name):
+    """Путь из имен папки с указанным родителем"""
+    if parent is None:
+        return name
+    return f"{parent.path}{TREE_SEPARATOR}{name}"
+
+def init_folder_tree(folder):
+    """Заполняет tree_path и path новой папки (после flush, когда известен id)"""
+    parent = db.session.get(Folder, folder.parent_id) if folder.parent_id else None
+    folder.tree_path = build_tree_path(parent, folder.id)
+    folder.path = build_path(parent, folder.name)
+
+def get_ancestor_ids(folder):
+    """id предков папки от корня, включая саму папку (без запросов к БД)"""
+    return [int(part) for part in require_tree_path(folder).strip(TREE_SEPARATOR).split(TREE_SEPARATOR)]
+
+def get_ancestors(folder):
+    """Предки папки от корня, включая саму папку, одним запросом (для папки в корне - без запросов)"""
+    ids = get_ancestor_ids(folder)[:-1]
+    if not ids:
+        return [folder]
+    by_id = {ancestor.id: ancestor for ancestor in Folder.query.filter(Folder.id.in_(ids))}
+    return [by_id[folder_id] for folder_id in ids if folder_id in by_id] + [folder]
+
+def subtree_condition(folder):
+    """Условие "сама папка и все вложенные в нее" по tree_path.
+
+    Поддерево - диапазон [tree_path, tree_path без последнего '/' + '0'):
+    '0' идет сразу за '/'. Диапазон обслуживает индекс ix_folders_user_tree_path;
+    LIKE по префиксу в SQLite индекс не использует (LIKE там без учета
+    регистра, а индекс - BINARY). В PostgreSQL индекс создан с
+    varchar_pattern_ops и обслуживает именно LIKE, а сравнение строк следует
+    правилам сортировки БД - там остается LIKE.
+    """
+    tree_path = require_tree_path(folder)
+    if db.engine.dialect.name == 'postgresql':
+        in_tree = Folder.tree_path.like(f"{tree_path}%")
+    else:
+        in_tree = and_(Folder.tree_path >= tree_path, Folder.tree_path < tree_path[:-1] + '0')
+    return and_(Folder.user_id == folder.user_id, in_tree)
+
+def descendants_query(folder, include_self=False):
+    """Запрос всех вложенных папок любой глубины"""
+    query = Folder.query.filter(subtree_condition(folder))
+    if not include_self:
+        query = query.filter(Folder.id != folder.id)
+    return query
+
+def is_in_subtree(folder, candidate):
+    """Является ли candidate самой папкой folder или вложенной в нее"""
+    return require_tree_path(candidate).startswith(require_tree_path(folder))
+
+def update_subtree(folder, parent, name):
+    """Переносит папку под parent и/или переименовывает ее вместе со всем поддеревом.
+
+    tree_path и path самой папки и всех вложенных папок меняются одним UPDATE
+    заменой префикса. Commit делает вызывающий код.
+    """
+    old_tree_path, old_path = require_tree_path(folder), folder.path
+    new_tree_path = build_tree_path(parent, folder.id)
+    new_path = build_path(parent, name)
+
+    Folder.query.filter(subtree_condition(folder)).update({
+        Folder.tree_path: literal(new_tree_path, String) + func.substr(Folder.tree_path, len(old_tree_path) + 1, type_=String),
+        Folder.path: literal(new_path, String) + func.substr(Folder.path, len(old_path) + 1, type_=String)
+    }, synchronize_session=False)
+
+    folder.parent_id = parent.id if parent is not None else None
+    folder.name = name
+    folder.tree_path = new_tree_path
+    folder.path = new_path
+
+def rebuild_folder_tree():
+    """Пересчитывает tree_path и path всех папок по parent_id.
+
+    Нужен для папок, созданных до появления tree_path, и для исправления
+    рассогласований. Возвращает число папок с измененными путями.
+    """
+    rows = db.session.query(Folder.id, Folder.parent_id, Folder.name, Folder.tree_path, Folder.path).all()
+    children = {}
+    for row in rows:
+        children.setdefault(row.parent_id, []).append(row)
+
+    updates = []
+    # Обход от корневых папок; папки, недостижимые от корня (цикл), не трогаем
+    level = [(row, TREE_SEPARATOR, None) for row in children.get(None, [])]
+    while level:
+        next_level = []
+        for row, parent_tree_path, parent_path in level:
+            tree_path = f"{parent_tree_path}{row.id}{TREE_SEPARATOR}"
+            path = row.name if parent_path is None else f"{parent_path}{TREE_SEPARATOR}{row.name}"
+            if row.tree_path != tree_path or row.path != path:
+                updates.append({'id': row.id, 'tree_path': tree_path, 'path': path})
+            next_level.extend((child, tree_path, path) for child in children.get(row.id, []))
+        level = next_level
+
+    if updates:
+        db.session.bulk_update_mappings(Folder, updates)
+    db.session.commit()
+    return len(updates)
+
+def adjust_folder_totals(folder_id, size=0, files=0, folders=0):
+    """Изменяет итоги папки и всех ее предков одним UPDATE (commit делает вызывающий код).
+
+    folder_id - папка, в которой изменилось содержимое (None - корень, итогов нет).
+    """
+    if folder_id is None or not (size or files or folders):
+        return
+
+    folder = db.session.get(Folder, folder_id)
+    if folder is None or folder.tree_path is None:
+        return
+
+    Folder.query.filter(Folder.id.in_(get_ancestor_ids(folder))).update({
+        Folder.total_size: Folder.total_size + size,
+        Folder.file_count: Folder.file_count + files,
+        Folder.folder_count: Folder.folder_count + folders
+    }, synchronize_session=False)
+
+def reconcile_folder_totals():
+    """Пересчитывает итоги всех папок по файлам в БД.
+
+    Прямое содержимое папок считается одним запросом с GROUP BY, итоги
+    поддеревьев складываются по tree_path. Возвращает число папок, итоги
+    которых расходились с фактическими.
+    """
+    direct = {
+        folder_id: (count, size) for folder_id, count, size in
+        db.session.query(File.folder_id, func.count(File.id), func.coalesce(func.sum(File.file_size), 0))
+        .filter(File.folder_id.isnot(None))
+        .group_by(File.folder_id)
+    }
+
+    rows = db.session.query(
+        Folder.id, Folder.tree_path, Folder.total_size, Folder.file_count, Folder.folder_count
+    ).filter(Folder.tree_path.isnot(None)).all()
+    totals = {row.id: [0, 0, 0] for row in rows}
+    for row in rows:
+        count, size = direct.get(row.id, (0, 0))
+        for ancestor_id in get_ancestor_ids(row):
+            ancestor = totals.get(ancestor_id)
+            if ancestor is None:
+                continue
+            ancestor[0] += size
+            ancestor[1] += count
+            if ancestor_id != row.id:
+                ancestor[2] += 1
+
+    updates = [
+        {'id': row.id, 'total_size': totals[row.id][0], 'file_count': totals[row.id][1], 'folder_count': totals[row.id][2]}
+        for row in rows
+        if (row.total_size, row.file_count, row.folder_count) != tuple(totals[row.id])
+    ]
+    if updates:
+        db.session.bulk_update_mappings(Folder, updates)
+    db.session.commit()
+    return len(updates)
+
+def delete_folder_tree(folder):
+    """Удаляет папку со всеми вложенными папками и файлами набором запросов.
+
+    Число запросов не зависит от глубины и размера дерева: вложенные папки
+    выбираются по tree_path, строки удаляются массово, счетчики ссылок
+    блобов уменьшаются одним UPDATE. Файлы с диска не удаляются - блобы без
+    ссылок и пути файлов старого формата (legacy_paths) удаляет фоновая
+    задача (reaper.py). Квоту и commit обрабатывает вызывающий код.
+    """
+    in_tree = subtree_condition(folder)
+    folder_ids = select(Folder.id).where(in_tree)
+    file_in_tree = File.folder_id.in_(folder_ids)
+
+    files_count, total_size = db.session.query(
+        func.count(File.id), func.coalesce(func.sum(File.file_size), 0)
+    ).filter(file_in_tree).one()
+    legacy_paths = [
+        file_path for (file_path,) in
+        db.session.query(File.file_path).filter(file_in_tree, File.blob_id.is_(None))
+    ]
+
+    # Каждый блоб теряет столько ссылок, сколько его файлов в удаляемом дереве
+    references = select(func.count(File.id)).where(File.blob_id == Blob.id, file_in_tree).correlate(Blob).scalar_subquery()
+    Blob.query.filter(Blob.id.in_(select(File.blob_id).where(file_in_tree))).update(
+        {Blob.refcount: Blob.refcount - references}, synchronize_session=False
+    )
+
+    FileShare.query.filter(FileShare.file_id.in_(select(File.id).where(file_in_tree))).delete(synchronize_session=False)
+    FileContent.query.filter(FileContent.file_id.in_(select(File.id).where(file_in_tree))).delete(synchronize_session=False)
+    File.query.filter(file_in_tree).delete(synchronize_session=False)
+
+    # Незавершенные загрузки в удаляемые папки завершатся в корень
+    UploadSession.query.filter(UploadSession.folder_id.in_(folder_ids)).update(
+        {UploadSession.folder_id: None}, synchronize_session=False
+    )
+
+    # Сначала разрываем связи родитель-потомок: MySQL проверяет внешние ключи построчно
+    Folder.query.filter(in_tree).update({Folder.parent_id: None}, synchronize_session=False)
+    folders_count = Folder.query.filter(in_tree).delete(synchronize_session=False)
+
+    return FolderDeletion(folders_count, files_count, total_size, legacy_paths)
@@ -1,7 +1,8 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, BooleanField, SubmitField, FileField, MultipleFileField, SelectField, TextAreaField, IntegerField
-from wtforms.validators import DataRequired, Email, Length, EqualTo, ValidationError, NumberRange
+from wtforms import StringField, PasswordField, BooleanField, SubmitField, FileField, MultipleFileField, SelectField, TextAreaField, IntegerField, DateField
+from wtforms.validators import DataRequired, Email, Length, EqualTo, ValidationError, NumberRange, Optional
 from models import User
+from search_filters import MIME_FAMILIES, SIZE_RANGES, DATE_RANGES, SHARE_STATUSES
 
 class LoginForm(FlaskForm):
     username = StringField('Имя пользователя', validators=[DataRequired()])
@@ -91,13 +92,29 @@ class FileShareForm(FlaskForm):
     expires_at = StringField('Истекает (YYYY-MM-DD)', validators=[])
     submit = SubmitField('Поделиться')
 
+def filter_choices(values):
+    return [('', 'Любой')] + [(value, label) for value, (label, *_) in values.items()]
+
 class SearchForm(FlaskForm):
-    query = StringField('Поиск', validators=[DataRequired()])
-    search_type = SelectField('Тип', choices=[
+    """Параметры поиска из строки запроса (GET-форма, без CSRF)"""
+    class Meta:
+        csrf = False
+
+    # Без слов запроса поиск возвращает все файлы под выбранными фильтрами
+    q = StringField('Поиск', validators=[Optional(), Length(max=200)])
+    type = SelectField('Тип', default='all', choices=[
         ('all', 'Все'),
-        ('files', 'Файлы'),
-        ('folders', 'Папки')
+        ('files', 'Только файлы'),
+        ('folders', 'Только папки'),
+        ('content', 'По содержимому')
     ])
+    page = IntegerField('Страница', default=1, validators=[Optional(), NumberRange(min=1)])
+    family = SelectField('Тип файла', default='', choices=filter_choices(MIME_FAMILIES), validators=[Optional()])
+    size = SelectField('Размер', default='', choices=filter_choices(SIZE_RANGES), validators=[Optional()])
+    date = SelectField('Загружен', default='', choices=filter_choices(DATE_RANGES), validators=[Optional()])
+    date_from = DateField('Загружен с', validators=[Optional()])
+    date_to = DateField('Загружен по', validators=[Optional()])
+    status = SelectField('Доступ', default='', choices=filter_choices(SHARE_STATUSES), validators=[Optional()])
     submit = SubmitField('Найти')
 
 class SettingsForm(FlaskForm):
@@ -0,0 +1,153 @@
+"""
+Cloud Storage Server - фоновая очередь задач
+
+Задачи хранятся в таблице jobs, поэтому переживают перезапуск сервера.
+Пул обработчиков может работать внутри веб-процесса или отдельно
+(python run.py --worker). Захват задачи выполняется условным UPDATE,
+так что несколько процессов не выполнят одну задачу дважды.
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from models import db, Job
+
+# Обработчики задач: kind -> function(job, payload)
+HANDLERS = {}
+
+class JobHandlerError(Exception):
+    """Для задачи не зарегистрирован обработчик"""
+
+def job_handler(kind):
+    """Декоратор регистрации обработчика задач указанного типа"""
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+def enqueue(kind, payload=None, file_id=None, max_attempts=None, delay=0):
+    """Добавляет задачу в очередь в текущей транзакции (commit делает вызывающий код)"""
+    job = Job(
+        kind=kind,
+        payload=json.dumps(payload or {}),
+        file_id=file_id,
+        max_attempts=max_attempts or current_app.config['JOB_MAX_ATTEMPTS'],
+        run_after=datetime.utcnow() + timedelta(seconds=delay)
+    )
+    db.session.add(job)
+    return job
+
+def get_retry_delay(attempts, base_delay, max_delay):
+    """Экспоненциальная задержка перед повторной попыткой"""
+    return min(base_delay * (2 ** max(attempts - 1, 0)), max_delay)
+
+def requeue_stale_jobs(lock_timeout):
+    """Возвращает в очередь задачи, захваченные упавшими обработчиками"""
+    stale_before = datetime.utcnow() - timedelta(seconds=lock_timeout)
+    count = Job.query.filter(
+        Job.status == 'running',
+        Job.locked_at < stale_before
+    ).update({Job.status: 'queued', Job.locked_by: None}, synchronize_session=False)
+    db.session.commit()
+    return count
+
+def claim_next_job(worker_id, batch_size=10):
+    """Атомарно захватывает следующую готовую к выполнению задачу"""
+    now = datetime.utcnow()
+    candidates = [job_id for (job_id,) in db.session.query(Job.id).filter(
+        Job.status == 'queued',
+        Job.run_after <= now
+    ).order_by(Job.run_after, Job.id).limit(batch_size).all()]
+
+    for job_id in candidates:
+        claimed = Job.query.filter_by(id=job_id, status='queued').update({
+            Job.status: 'running',
+            Job.locked_by: worker_id,
+            Job.locked_at: now,
+            Job.attempts: Job.attempts + 1
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+
+    return None
+
+def run_job(job, base_delay, max_delay):
+    """Выполняет захваченную задачу и сохраняет результат или планирует повтор"""
+    handler = HANDLERS.get(job.kind)
+
+    try:
+        if handler is None:
+            raise JobHandlerError(f'Нет обработчика для задачи "{job.kind}"')
+        job.last_error = None
+        handler(job, json.loads(job.payload or '{}'))
+        job.status = 'done'
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(Job, job.id)
+        if job is None:
+            return
+        job.last_error = str(e)
+        if job.attempts >= job.max_attempts or isinstance(e, JobHandlerError):
+            job.status = 'failed'
+        else:
+            job.status = 'queued'
+            job.run_after = datetime.utcnow() + timedelta(seconds=get_retry_delay(job.attempts, base_delay, max_delay))
+        print(f"Ошибка задачи {job.id} ({job.kind}), попытка {job.attempts}: {e}")
+
+    job.locked_by = None
+    job.locked_at = None
+    db.session.commit()
+
+class WorkerPool:
+    """Пул потоков, выполняющих задачи из очереди"""
+
+    def __init__(self, app, size=None):
+        self.app = app
+        self.size = size or app.config['JOB_WORKERS']
+        self.poll_interval = app.config['JOB_POLL_INTERVAL']
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def start(self):
+        with self.app.app_context():
+            requeue_stale_jobs(self.app.config['JOB_LOCK_TIMEOUT'])
+
+        for index in range(self.size):
+            worker_id = f"{socket.gethostname()}:{os.getpid()}:{index}"
+            thread = threading.Thread(target=self._run, args=(worker_id,), name=f"job-worker-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def join(self):
+        """Блокирует текущий поток до остановки пула (для отдельного процесса обработчиков)"""
+        try:
+            while any(thread.is_alive() for thread in self.threads):
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def _run(self, worker_id):
+        base_delay = self.app.config['JOB_RETRY_DELAY']
+        max_delay = self.app.config['JOB_RETRY_MAX_DELAY']
+
+        while not self.stopping.is_set():
+            try:
+                with self.app.app_context():
+                    job = claim_next_job(worker_id)
+                    if job is not None:
+                        run_job(job, base_delay, max_delay)
+                        continue
+            except Exception as e:
+                print(f"Ошибка обработчика очереди {worker_id}: {e}")
+            self.stopping.wait(self.poll_interval)
@@ -0,0 +1,115 @@
+"""
+Cloud Storage Server - постраничный список содержимого папки
+
+Список сортируется по имени, размеру, дате или типу и разбивается на
+страницы по ключу (keyset): курсор хранит значение столбца сортировки и id
+последнего элемента, следующая страница выбирается условием "после курсора"
+по составному индексу (user_id, папка, столбец, id). Стоимость страницы не
+зависит от ее номера и размера папки. Сначала идут папки, затем файлы.
+"""
+
+import base64
+import json
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import raiseload
+from models import Folder, File
+
+# Размер страницы по умолчанию и наибольший допустимый
+LISTING_PAGE_SIZE = 100
+MAX_LISTING_PAGE_SIZE = 500
+
+SORT_ORDERS = ('asc', 'desc')
+
+# Столбцы сортировки; у папок нет типа, они сортируются по имени
+FOLDER_SORT_COLUMNS = {
+    'name': Folder.name,
+    'size': Folder.total_size,
+    'date': Folder.created_at,
+    'type': Folder.name
+}
+FILE_SORT_COLUMNS = {
+    'name': File.original_filename,
+    'size': File.file_size,
+    'date': File.created_at,
+    'type': File.mime_type
+}
+
+ListingPage = namedtuple('ListingPage', ['folders', 'files', 'next_cursor'])
+
+def encode_cursor(kind, sort, item, column):
+    """Курсор после элемента item (kind - 'folder' или 'file')"""
+    value = getattr(item, column.key)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([kind, sort, value, item.id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, sort):
+    """Разбирает курсор; ValueError, если он поврежден или от другой сортировки"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        kind, cursor_sort, value, item_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        raise ValueError('Некорректный курсор')
+    if kind not in ('folder', 'file') or cursor_sort != sort or not isinstance(item_id, int):
+        raise ValueError('Некорректный курсор')
+    if sort == 'date':
+        value = datetime.fromisoformat(value)
+    return kind, value, item_id
+
+def after_cursor(column, id_column, value, item_id, descending):
+    """Условие "строка идет после (value, item_id)" в порядке сортировки.
+
+    Записано через OR/AND, а не сравнением кортежей: так индекс
+    используется во всех поддерживаемых СУБД.
+    """
+    if descending:
+        return or_(column < value, and_(column == value, id_column < item_id))
+    return or_(column > value, and_(column == value, id_column > item_id))
+
+def order_by(column, id_column, descending):
+    if descending:
+        return column.desc(), id_column.desc()
+    return column.asc(), id_column.asc()
+
+def list_folder_page(user_id, folder_id, sort='name', order='asc', cursor=None, limit=LISTING_PAGE_SIZE):
+    """Страница содержимого папки folder_id (None - корень) после курсора.
+
+    Возвращает ListingPage; next_cursor равен None на последней странице.
+    Выполняет не больше двух запросов, каждый - не больше limit + 1 строк;
+    ленивая загрузка связей у элементов страницы запрещена (raiseload).
+    """
+    if sort not in FILE_SORT_COLUMNS or order not in SORT_ORDERS:
+        raise ValueError('Некорректная сортировка')
+    descending = order == 'desc'
+    limit = max(1, min(limit, MAX_LISTING_PAGE_SIZE))
+    kind, value, item_id = decode_cursor(cursor, sort) if cursor else ('folder', None, None)
+
+    folders = []
+    if kind == 'folder':
+        column = FOLDER_SORT_COLUMNS[sort]
+        query = Folder.query.filter(Folder.user_id == user_id, Folder.parent_id == folder_id).options(raiseload('*'))
+        if item_id is not None:
+            query = query.filter(after_cursor(column, Folder.id, value, item_id, descending))
+        folders = query.order_by(*order_by(column, Folder.id, descending)).limit(limit + 1).all()
+        if len(folders) > limit:
+            folders = folders[:limit]
+            return ListingPage(folders, [], encode_cursor('folder', sort, folders[-1], column))
+        # Папки закончились - страницу дополняют файлы с начала
+        limit -= len(folders)
+        item_id = None
+        if limit == 0:
+            return ListingPage(folders, [], encode_cursor('folder', sort, folders[-1], column))
+
+    column = FILE_SORT_COLUMNS[sort]
+    query = File.query.filter(File.user_id == user_id, File.folder_id == folder_id).options(raiseload('*'))
+    if item_id is not None:
+        query = query.filter(after_cursor(column, File.id, value, item_id, descending))
+    files = query.order_by(*order_by(column, File.id, descending)).limit(limit + 1).all()
+    next_cursor = None
+    if len(files) > limit:
+        files = files[:limit]
+        next_cursor = encode_cursor('file', sort, files[-1], column)
+    return ListingPage(folders, files, next_cursor)
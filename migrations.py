@@ -0,0 +1,220 @@
+"""
+Cloud Storage Server - миграции схемы БД
+
+db.create_all() создает только отсутствующие таблицы, поэтому новые колонки
+и индексы существующих таблиц добавляются здесь: схема БД сравнивается с
+models.py, недостающие колонки добавляются ALTER TABLE, индексы строятся
+без блокировки записи, где СУБД это позволяет (CONCURRENTLY в PostgreSQL,
+ALGORITHM=INPLACE, LOCK=NONE в MySQL/MariaDB).
+
+prepare_database() выполняет все это при запуске сервера (run.py и
+python app.py), чтобы код не работал с устаревшей схемой.
+
+explain_hot_queries() показывает планы самых частых запросов и отмечает
+полный просмотр таблицы - так пропавший или неиспользуемый индекс виден сразу.
+"""
+
+import re
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import inspect, select, text
+from sqlalchemy.schema import CreateIndex
+from models import db, File, Folder, FileShare, ActivityLog, Blob, Job
+from folders import rebuild_folder_tree, reconcile_folder_totals, subtree_condition
+from search_index import get_search_backend
+
+QueryPlan = namedtuple('QueryPlan', ['name', 'plan', 'full_scan'])
+
+def get_dialect():
+    """Имя СУБД: sqlite, postgresql или mysql (MariaDB - тоже mysql)"""
+    name = db.engine.dialect.name
+    return 'mysql' if name == 'mariadb' else name
+
+def find_missing_columns():
+    """Колонки моделей, которых нет в существующих таблицах: [(table, column)]"""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        missing.extend((table, column) for column in table.columns if column.name not in existing)
+    return missing
+
+def find_missing_indexes():
+    """Индексы моделей, которых нет в существующих таблицах: [index]"""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in table.indexes if index.name not in existing)
+    return sorted(missing, key=lambda index: index.name)
+
+def add_column(table, column):
+    """ALTER TABLE ... ADD COLUMN по описанию колонки в модели"""
+    dialect = db.engine.dialect
+    preparer = dialect.identifier_preparer
+    ddl = (f"ALTER TABLE {preparer.format_table(table)} "
+           f"ADD COLUMN {preparer.format_column(column)} {column.type.compile(dialect=dialect)}")
+    if column.server_default is not None:
+        ddl += f" DEFAULT '{column.server_default.arg}'"
+    if not column.nullable:
+        # NOT NULL без значения по умолчанию не добавить в непустую таблицу
+        if column.server_default is None:
+            raise ValueError(f'Колонка {table.name}.{column.name} NOT NULL без server_default')
+        ddl += ' NOT NULL'
+    with db.engine.begin() as connection:
+        connection.execute(text(ddl))
+
+def create_index(index):
+    """Строит индекс, не блокируя запись в таблицу, где это возможно"""
+    dialect = get_dialect()
+    ddl = str(CreateIndex(index).compile(dialect=db.engine.dialect))
+
+    if dialect == 'postgresql':
+        # CONCURRENTLY нельзя выполнять внутри транзакции
+        ddl = ddl.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            try:
+                connection.execute(text(ddl))
+            except Exception:
+                # Прерванная сборка оставляет нерабочий (INVALID) индекс - удаляем его
+                connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {index.name}'))
+                raise
+        return
+
+    if dialect == 'mysql':
+        ddl += ' ALGORITHM=INPLACE LOCK=NONE'
+    with db.engine.begin() as connection:
+        connection.execute(text(ddl))
+
+def apply_migrations(indexes=True):
+    """Добавляет недостающие колонки и (если indexes) индексы.
+
+    Возвращает (число колонок, число индексов). Повторный запуск ничего не
+    меняет. Сессию перед вызовом нужно закоммитить: DDL выполняется в
+    отдельных соединениях.
+    """
+    columns = find_missing_columns()
+    for table, column in columns:
+        print(f"Добавление колонки {table.name}.{column.name}...")
+        add_column(table, column)
+
+    created = []
+    if indexes:
+        created = find_missing_indexes()
+        for index in created:
+            print(f"Создание индекса {index.name} ({index.table.name})...")
+            create_index(index)
+
+    return len(columns), len(created)
+
+def prepare_database(migrate=False, rebuild_tree=False, reconcile=False):
+    """Приводит БД к моделям при запуске; вызывается всеми точками входа.
+
+    Создает таблицы и новые колонки; индексы (долго на больших таблицах) -
+    только если migrate. Поисковый индекс SQLite создается сразу, PostgreSQL
+    и MySQL - по migrate. Пути папок без tree_path (БД до его появления)
+    пересчитываются всегда, после этого - и итоги папок.
+    """
+    print("Создание таблиц базы данных...")
+    db.create_all()
+
+    added_columns, created_indexes = apply_migrations(indexes=migrate)
+    if added_columns or created_indexes:
+        print(f"✓ Миграции применены: колонок {added_columns}, индексов {created_indexes}")
+    elif migrate:
+        print("✓ Схема БД актуальна")
+    missing_indexes = find_missing_indexes()
+    if missing_indexes:
+        print(f"⚠ Не созданы индексы: {', '.join(index.name for index in missing_indexes)} "
+              f"- выполните python run.py --migrate")
+
+    search_backend = get_search_backend()
+    if migrate or search_backend.setup_on_start:
+        if search_backend.setup():
+            print(f"✓ Поисковый индекс создан ({search_backend.name})")
+    elif not search_backend.is_ready():
+        print(f"⚠ Поисковый индекс ({search_backend.name}) не создан, поиск работает через LIKE "
+              f"- выполните python run.py --migrate")
+
+    # Папки, созданные до появления tree_path
+    rebuilt = 0
+    if rebuild_tree or Folder.query.filter(Folder.tree_path.is_(None)).first():
+        rebuilt = rebuild_folder_tree()
+        print(f"✓ Пути папок пересчитаны: {rebuilt}")
+
+    # Итоги считаются по tree_path, поэтому после пересчета путей тоже пересчитываются
+    if reconcile or rebuild_tree or rebuilt:
+        reconciled = reconcile_folder_totals()
+        print(f"✓ Итоги папок исправлены: {reconciled}")
+
+def get_hot_queries():
+    """Самые частые запросы приложения с типичными параметрами: [(name, statement)]"""
+    now = datetime.utcnow()
+    return [
+        ('Список файлов папки', select(File).where(File.user_id == 1, File.folder_id == 1)
+            .order_by(File.original_filename, File.id).limit(101)),
+        ('Список файлов корня по дате', select(File).where(File.user_id == 1, File.folder_id.is_(None))
+            .order_by(File.created_at.desc(), File.id.desc()).limit(101)),
+        ('Список папок', select(Folder).where(Folder.user_id == 1, Folder.parent_id == 1)
+            .order_by(Folder.name, Folder.id).limit(101)),
+        ('Доступ к чужому файлу', select(FileShare).where(FileShare.file_id == 1, FileShare.shared_with == 1)),
+        ('Журнал пользователя', select(ActivityLog).where(ActivityLog.user_id == 1)
+            .order_by(ActivityLog.created_at.desc()).limit(50)),
+        ('Видео пользователя (фильтр поиска)', select(File.id).where(File.user_id == 1, File.mime_type.like('video/%'))),
+        ('Большие файлы пользователя', select(File.id).where(File.user_id == 1, File.file_size >= 1024 * 1024 * 1024)),
+        ('Файлы пользователя за месяц', select(File.id).where(File.user_id == 1, File.created_at >= now)
+            .order_by(File.created_at.desc(), File.id.desc()).limit(51)),
+        # Условие то же, что у перемещения и удаления дерева
+        ('Поддерево папки', select(Folder.id).where(subtree_condition(Folder(id=1, user_id=1, tree_path='/1/')))),
+        ('Файлы папки (удаление дерева)', select(File.id).where(File.folder_id.in_([1, 2, 3]))),
+        ('Ссылки на блоб', select(File.id).where(File.blob_id == 1)),
+        ('Блоб по хешу', select(Blob).where(Blob.content_hash == '0' * 64)),
+        ('Следующая фоновая задача', select(Job).where(Job.status == 'queued', Job.run_after <= now)
+            .order_by(Job.run_after).limit(1)),
+    ]
+
+def is_sqlite_full_scan(line):
+    """Шаг плана SQLite читает всю таблицу или индекс.
+
+    Любой SCAN - полный просмотр, в том числе "SCAN folders USING COVERING
+    INDEX ..." (весь индекс без ключа поиска). SEARCH допустим только по
+    индексу или INTEGER PRIMARY KEY, но не по AUTOMATIC INDEX, который
+    строится при каждом выполнении запроса.
+    """
+    if line.startswith('SCAN '):
+        return True
+    return line.startswith('SEARCH ') and not re.search(r' USING (COVERING )?INDEX | USING INTEGER PRIMARY KEY', line)
+
+def explain(statement):
+    """План запроса в виде строк и признак полного просмотра таблицы"""
+    dialect = get_dialect()
+    sql = str(statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+
+    with db.engine.connect() as connection:
+        if dialect == 'sqlite':
+            rows = connection.execute(text(f'EXPLAIN QUERY PLAN {sql}')).all()
+            plan = [row[-1] for row in rows]
+            full_scan = any(is_sqlite_full_scan(line) for line in plan)
+        elif dialect == 'postgresql':
+            plan = [row[0] for row in connection.execute(text(f'EXPLAIN {sql}'))]
+            full_scan = any('Seq Scan' in line for line in plan)
+        else:
+            result = connection.execute(text(f'EXPLAIN {sql}'))
+            keys = list(result.keys())
+            rows = [dict(zip(keys, row)) for row in result]
+            plan = [
+                f"{row.get('table')}: type={row.get('type')} key={row.get('key')} rows={row.get('rows')} {row.get('Extra') or ''}".strip()
+                for row in rows
+            ]
+            full_scan = any(row.get('type') == 'ALL' for row in rows)
+    return plan, full_scan
+
+def explain_hot_queries():
+    """Планы всех частых запросов: [QueryPlan]"""
+    return [QueryPlan(name, *explain(statement)) for name, statement in get_hot_queries()]
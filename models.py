@@ -1,11 +1,22 @@
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.mysql import MEDIUMTEXT
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-import os
 
 db = SQLAlchemy()
 
+def format_file_size(size):
+    """Return size in human readable format"""
+    if size < 1024:
+        return f"{size} B"
+    elif size < 1024 * 1024:
+        return f"{round(size / 1024, 2)} KB"
+    elif size < 1024 * 1024 * 1024:
+        return f"{round(size / (1024 * 1024), 2)} MB"
+    else:
+        return f"{round(size / (1024 * 1024 * 1024), 2)} GB"
+
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
     
@@ -43,10 +54,27 @@ class User(UserMixin, db.Model):
 
 class Folder(db.Model):
     __tablename__ = 'folders'
+    # Постраничный список содержимого папки по каждой сортировке (listing.py);
+    # parent_id - проверка внешнего ключа при удалении папок
+    __table_args__ = (
+        # Поиск поддерева пользователя - диапазон tree_path (в PostgreSQL - LIKE 'префикс%',
+        # для этого нужен varchar_pattern_ops), см. folders.subtree_condition
+        db.Index('ix_folders_user_tree_path', 'user_id', 'tree_path', postgresql_ops={'tree_path': 'varchar_pattern_ops'}),
+        db.Index('ix_folders_parent_id', 'parent_id'),
+        db.Index('ix_folders_listing_name', 'user_id', 'parent_id', 'name', 'id'),
+        db.Index('ix_folders_listing_size', 'user_id', 'parent_id', 'total_size', 'id'),
+        db.Index('ix_folders_listing_date', 'user_id', 'parent_id', 'created_at', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), nullable=False)
-    path = db.Column(db.String(1000), nullable=False)
+    path = db.Column(db.String(1000), nullable=False)  # путь из имен: Документы/2024
+    # Материализованный путь из id предков и самой папки: /3/17/42/ (см. folders.py)
+    tree_path = db.Column(db.String(750), nullable=True)
+    # Итоги по всему поддереву, поддерживаются folders.adjust_folder_totals
+    total_size = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')  # bytes
+    file_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    folder_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     parent_id = db.Column(db.Integer, db.ForeignKey('folders.id'), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -57,12 +85,53 @@ class Folder(db.Model):
     files = db.relationship('File', backref='folder', lazy=True)
     
     def get_full_path(self):
-        if self.parent:
-            return os.path.join(self.parent.get_full_path(), self.name)
-        return self.name
+        # path поддерживается при переименовании и перемещении (folders.update_subtree)
+        return self.path
+    
+    def get_total_size_formatted(self):
+        return format_file_size(self.total_size or 0)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'total_size': self.total_size,
+            'total_size_formatted': self.get_total_size_formatted(),
+            'file_count': self.file_count,
+            'folder_count': self.folder_count,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+class Blob(db.Model):
+    """Содержимое файла, хранимое на диске один раз (адресация по SHA-256)"""
+    __tablename__ = 'blobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), unique=True, nullable=False)  # SHA-256
+    file_path = db.Column(db.String(1000), nullable=False)  # путь внутри UPLOAD_FOLDER
+    size = db.Column(db.BigInteger, nullable=False)  # bytes
+    refcount = db.Column(db.Integer, nullable=False, default=0)  # число ссылающихся File
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Relationships
+    files = db.relationship('File', backref='blob', lazy=True)
 
 class File(db.Model):
     __tablename__ = 'files'
+    # Постраничный список содержимого папки по каждой сортировке (listing.py);
+    # folder_id - удаление дерева папок, blob_id - счетчики ссылок блобов;
+    # user_id + тип/размер/дата - фильтры и фасеты поиска по всем папкам (search_filters.py)
+    __table_args__ = (
+        db.Index('ix_files_folder_id', 'folder_id'),
+        db.Index('ix_files_blob_id', 'blob_id'),
+        db.Index('ix_files_listing_name', 'user_id', 'folder_id', 'original_filename', 'id'),
+        db.Index('ix_files_listing_size', 'user_id', 'folder_id', 'file_size', 'id'),
+        db.Index('ix_files_listing_date', 'user_id', 'folder_id', 'created_at', 'id'),
+        db.Index('ix_files_listing_type', 'user_id', 'folder_id', 'mime_type', 'id'),
+        db.Index('ix_files_user_mime', 'user_id', 'mime_type'),
+        db.Index('ix_files_user_size', 'user_id', 'file_size'),
+        db.Index('ix_files_user_created', 'user_id', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
@@ -70,29 +139,56 @@ class File(db.Model):
     file_path = db.Column(db.String(1000), nullable=False)
     file_size = db.Column(db.BigInteger, nullable=False)  # bytes
     mime_type = db.Column(db.String(100), nullable=False)
+    content_hash = db.Column(db.String(64), nullable=True)  # SHA-256 содержимого
+    blob_id = db.Column(db.Integer, db.ForeignKey('blobs.id'), nullable=True)  # None для файлов старого формата
     folder_id = db.Column(db.Integer, db.ForeignKey('folders.id'), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     is_public = db.Column(db.Boolean, default=False)
     public_url = db.Column(db.String(255), unique=True, nullable=True)
+    # Сведения об изображении, извлекаются фоновой задачей (None - еще не извлечены)
+    image_width = db.Column(db.Integer, nullable=True)  # с учетом EXIF-поворота
+    image_height = db.Column(db.Integer, nullable=True)
+    image_orientation = db.Column(db.SmallInteger, nullable=True)  # EXIF Orientation, 1-8
+    placeholder_color = db.Column(db.String(7), nullable=True)  # преобладающий цвет, #rrggbb
     
     def get_file_size_mb(self):
         return round(self.file_size / (1024 * 1024), 2)
     
     def get_file_size_formatted(self):
         """Return file size in human readable format"""
-        if self.file_size < 1024:
-            return f"{self.file_size} B"
-        elif self.file_size < 1024 * 1024:
-            return f"{round(self.file_size / 1024, 2)} KB"
-        elif self.file_size < 1024 * 1024 * 1024:
-            return f"{round(self.file_size / (1024 * 1024), 2)} MB"
-        else:
-            return f"{round(self.file_size / (1024 * 1024 * 1024), 2)} GB"
+        return format_file_size(self.file_size)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.original_filename,
+            'file_size': self.file_size,
+            'file_size_formatted': self.get_file_size_formatted(),
+            'mime_type': self.mime_type,
+            'is_public': self.is_public,
+            'public_url': self.public_url,
+            'image_width': self.image_width,
+            'image_height': self.image_height,
+            'placeholder_color': self.placeholder_color,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+class FileContent(db.Model):
+    """Текст файла для поиска по содержимому (извлекает фоновая задача, см. content_index.py)"""
+    __tablename__ = 'file_contents'
+
+    file_id = db.Column(db.Integer, db.ForeignKey('files.id'), primary_key=True)
+    # TEXT в MySQL ограничен 64 КБ
+    content = db.Column(db.Text().with_variant(MEDIUMTEXT(), 'mysql', 'mariadb'), nullable=False)
+    truncated = db.Column(db.Boolean, nullable=False, default=False)  # текст обрезан по CONTENT_INDEX_MAX_*
+    indexed_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class FileShare(db.Model):
     __tablename__ = 'file_shares'
+    # Проверка доступа к чужому файлу при каждом скачивании и просмотре
+    __table_args__ = (db.Index('ix_file_shares_file_shared_with', 'file_id', 'shared_with'),)
     
     id = db.Column(db.Integer, primary_key=True)
     file_id = db.Column(db.Integer, db.ForeignKey('files.id'), nullable=False)
@@ -107,8 +203,82 @@ class FileShare(db.Model):
     shared_by_user = db.relationship('User', foreign_keys=[shared_by])
     shared_with_user = db.relationship('User', foreign_keys=[shared_with])
 
+class UploadSession(db.Model):
+    """Сессия возобновляемой загрузки файла по частям"""
+    __tablename__ = 'upload_sessions'
+    # Поиск просроченных сессий (upload_sessions.py)
+    __table_args__ = (db.Index('ix_upload_sessions_status_expires', 'status', 'expires_at'),)
+
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    folder_id = db.Column(db.Integer, db.ForeignKey('folders.id'), nullable=True)
+    original_filename = db.Column(db.String(255), nullable=False)
+    file_path = db.Column(db.String(1000), nullable=False)  # путь внутри UPLOAD_FOLDER
+    total_size = db.Column(db.BigInteger, nullable=False)  # bytes
+    chunk_size = db.Column(db.Integer, nullable=False)  # bytes
+    is_public = db.Column(db.Boolean, default=False)
+    status = db.Column(db.String(20), default='active')  # active, complete, aborted, expired
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=True)  # продлевается каждой частью на UPLOAD_SESSION_TTL
+
+    # Relationships
+    chunks = db.relationship('UploadChunk', backref='session', lazy=True, cascade='all, delete-orphan')
+
+    def get_chunk_count(self):
+        if self.total_size == 0:
+            return 1
+        return (self.total_size + self.chunk_size - 1) // self.chunk_size
+
+    def get_chunk_length(self, index):
+        """Ожидаемый размер части с номером index"""
+        if index == self.get_chunk_count() - 1:
+            return self.total_size - index * self.chunk_size
+        return self.chunk_size
+
+class UploadChunk(db.Model):
+    __tablename__ = 'upload_chunks'
+    __table_args__ = (db.UniqueConstraint('session_id', 'chunk_index'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(32), db.ForeignKey('upload_sessions.id'), nullable=False)
+    chunk_index = db.Column(db.Integer, nullable=False)
+    size = db.Column(db.Integer, nullable=False)  # bytes
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Job(db.Model):
+    """Задача фоновой очереди (миниатюры, извлечение метаданных и т.п.)"""
+    __tablename__ = 'jobs'
+    __table_args__ = (db.Index('ix_jobs_status_run_after', 'status', 'run_after'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # thumbnail, ...
+    payload = db.Column(db.Text, nullable=True)  # JSON
+    file_id = db.Column(db.Integer, nullable=True, index=True)  # файл, к которому относится задача
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100), nullable=True)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'last_error': self.last_error
+        }
+
 class ActivityLog(db.Model):
     __tablename__ = 'activity_logs'
+    # Журнал пользователя от новых записей к старым
+    __table_args__ = (db.Index('ix_activity_logs_user_created', 'user_id', 'created_at'),)
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
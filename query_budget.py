@@ -0,0 +1,55 @@
+"""
+Cloud Storage Server - бюджет SQL-запросов на запрос к серверу
+
+Маршрут объявляет, сколько SQL-запросов он может выполнить
+(@query_budget(5)), с учетом загрузки текущего пользователя. В режиме
+отладки и тестирования запросы каждого HTTP-запроса считаются, число
+отдается в заголовке X-Query-Count, а превышение бюджета завершает запрос
+ошибкой QueryBudgetExceeded - так незаметная ленивая загрузка в шаблоне
+(N+1) видна сразу.
+"""
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+class QueryBudgetExceeded(AssertionError):
+    """Маршрут выполнил больше SQL-запросов, чем объявил"""
+
+def query_budget(limit):
+    """Объявляет наибольшее число SQL-запросов маршрута"""
+    def decorator(view):
+        view.query_budget = limit
+        return view
+    return decorator
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    # Запросы фоновых потоков (задачи, загрузки) к HTTP-запросу не относятся
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+def init_query_budget(app, engine):
+    """Включает подсчет запросов и проверку бюджетов маршрутов.
+
+    По умолчанию работает в режиме отладки и тестирования; QUERY_BUDGET_CHECK
+    включает или выключает проверку явно.
+    """
+    enabled = app.config.get('QUERY_BUDGET_CHECK')
+    if enabled is None:
+        enabled = app.debug or app.testing
+    if not enabled:
+        return
+
+    event.listen(engine, 'before_cursor_execute', count_query)
+
+    @app.after_request
+    def check_query_budget(response):
+        count = g.get('query_count', 0)
+        response.headers['X-Query-Count'] = str(count)
+
+        view = app.view_functions.get(request.endpoint)
+        limit = getattr(view, 'query_budget', None)
+        if limit is not None and count > limit:
+            raise QueryBudgetExceeded(
+                f'{request.endpoint}: выполнено SQL-запросов {count}, бюджет маршрута {limit}'
+            )
+        return response
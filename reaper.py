@@ -0,0 +1,83 @@
+"""
+Cloud Storage Server - фоновое удаление освобожденного содержимого с диска
+
+Запросы удаления только меняют БД (счетчики ссылок блобов, записи файлов),
+а файлы с диска удаляет задача 'reap'. Так удаление папки с десятками
+тысяч файлов не зависит от скорости диска.
+"""
+
+import os
+from flask import current_app
+from models import db, Blob
+from jobs import job_handler, enqueue
+from storage import resolve_path, unlink_blob_file
+from thumbnails import remove_renditions
+
+# Сколько путей передается одной задаче и сколько блобов удаляется за транзакцию
+REAP_BATCH_SIZE = 500
+
+def enqueue_reap(legacy_paths=()):
+    """Ставит в очередь удаление освобожденного содержимого (commit делает вызывающий код).
+
+    legacy_paths - пути файлов старого формата (без блоба), их записи уже удалены.
+    Блобы без ссылок задача находит сама.
+    """
+    legacy_paths = list(legacy_paths)
+    jobs = [enqueue('reap', {'paths': legacy_paths[:REAP_BATCH_SIZE]})]
+    for start in range(REAP_BATCH_SIZE, len(legacy_paths), REAP_BATCH_SIZE):
+        jobs.append(enqueue('reap', {'paths': legacy_paths[start:start + REAP_BATCH_SIZE]}))
+    return jobs
+
+def reap_orphaned_blobs(upload_folder, batch_size=REAP_BATCH_SIZE):
+    """Удаляет блобы без ссылок: запись из БД, затем файл и миниатюры с диска.
+
+    Строки пакета блокируются (FOR UPDATE) до commit, и блоб удаляется
+    условным DELETE в той же транзакции: загрузка того же содержимого либо
+    успела увеличить счетчик (блоб остается), либо ждет блокировку и после
+    commit не находит блоб и пишет новый файл под собственным именем
+    (storage.blob_file_name). Блобы, строки которых заняты загрузкой,
+    пропускаются до следующего запуска. Файл удаляется после commit, только
+    если на его путь не указывает ни одна запись. Возвращает число
+    удаленных с диска блобов.
+    """
+    removed_count = 0
+    last_id = 0
+    while True:
+        blobs = Blob.query.filter(Blob.refcount <= 0, Blob.id > last_id).order_by(Blob.id).limit(batch_size).with_for_update(skip_locked=True).all()
+        if not blobs:
+            break
+        last_id = blobs[-1].id
+
+        removed = []
+        for blob in blobs:
+            deleted = Blob.query.filter(
+                Blob.id == blob.id,
+                Blob.refcount <= 0,
+                ~Blob.files.any()
+            ).delete(synchronize_session=False)
+            if deleted:
+                removed.append((blob.file_path, blob.content_hash))
+        db.session.commit()
+
+        # Файлы удаляются только после фиксации удаления записей
+        for blob_path, content_hash in removed:
+            full_path = resolve_path(upload_folder, blob_path)
+            if unlink_blob_file(full_path, blob_path, content_hash):
+                remove_renditions(upload_folder, full_path)
+                removed_count += 1
+    return removed_count
+
+@job_handler('reap')
+def reap_job(job, payload):
+    """Удаление с диска содержимого удаленных файлов"""
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+
+    # Файлы старого формата: у каждого собственная копия на диске
+    for file_path in payload.get('paths', []):
+        full_path = resolve_path(upload_folder, file_path)
+        if os.path.exists(full_path):
+            os.remove(full_path)
+        remove_renditions(upload_folder, full_path)
+
+    removed = reap_orphaned_blobs(upload_folder)
+    print(f"Удалено с диска: файлов {len(payload.get('paths', []))}, блобов {removed}")
@@ -9,7 +9,16 @@ import sys
 import argparse
 from dotenv import load_dotenv
 from app import create_app, db
+from jobs import WorkerPool
+from storage import migrate_layout
+from thumbnails import (
+    migrate_thumbnail_layout, sweep_thumbnails, collect_thumbnail_sources, schedule_thumbnail_gc,
+    backfill_image_metadata
+)
 from models import User
+from migrations import prepare_database, explain_hot_queries
+from content_index import backfill_content_index
+from upload_sessions import schedule_upload_session_gc
 
 def create_env_file():
     """Создает файл .env с настройками по умолчанию"""
@@ -48,6 +57,21 @@ SECRET_KEY=your-secret-key-change-in-production
 UPLOAD_FOLDER=uploads
 MAX_CONTENT_LENGTH=1073741824
 STORAGE_LIMIT_DEFAULT=1073741824
+# Число потоков записи файлов при загрузке нескольких файлов сразу
+UPLOAD_WORKERS=4
+# Сессия загрузки по частям истекает без новых частей (секунды); интервал проверки
+UPLOAD_SESSION_TTL=86400
+UPLOAD_SESSION_GC_INTERVAL=3600
+# Объем миниатюр (байт), которые процесс держит в памяти
+THUMBNAIL_CACHE_SIZE=67108864
+# Объем папки миниатюр на диске (байт) и интервал ее очистки (секунды)
+THUMBNAIL_DISK_LIMIT=2147483648
+THUMBNAIL_GC_INTERVAL=3600
+
+# Фоновая очередь задач (миниатюры и другая обработка после загрузки)
+# JOBS_INPROCESS=false - обработчики запускаются отдельно: python run.py --worker
+JOBS_INPROCESS=true
+JOB_WORKERS=2
 
 # Окружение
 FLASK_ENV=development
@@ -84,6 +108,26 @@ def main():
     parser.add_argument('--create-env', action='store_true', help='Создать файл .env')
     parser.add_argument('--setup-db', action='store_true', help='Настроить базу данных')
     parser.add_argument('--debug', action='store_true', help='Запустить в режиме отладки')
+    parser.add_argument('--worker', action='store_true', help='Запустить только обработчики фоновых задач')
+    parser.add_argument('--workers', type=int, help='Количество потоков обработчиков фоновых задач')
+    parser.add_argument('--migrate', action='store_true',
+                       help='Добавить недостающие колонки и индексы в существующие таблицы')
+    parser.add_argument('--explain', action='store_true',
+                       help='Показать планы частых запросов и найти полный просмотр таблиц')
+    parser.add_argument('--migrate-layout', action='store_true',
+                       help='Перенести файлы в разбитую по префиксу раскладку (ab/cd/<имя>)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                       help='Размер пакета для --migrate-layout, --backfill-metadata и --index-content')
+    parser.add_argument('--rebuild-folder-tree', action='store_true',
+                       help='Пересчитать пути папок (tree_path, path) по parent_id')
+    parser.add_argument('--reconcile-folders', action='store_true',
+                       help='Пересчитать объем и число файлов и папок в каждой папке')
+    parser.add_argument('--backfill-metadata', action='store_true',
+                       help='Извлечь размеры и цвет-заглушку изображений, загруженных ранее')
+    parser.add_argument('--index-content', action='store_true',
+                       help='Поставить в очередь извлечение текста документов, загруженных ранее')
+    parser.add_argument('--gc-thumbnails', action='store_true',
+                       help='Удалить устаревшие миниатюры и сократить папку миниатюр до THUMBNAIL_DISK_LIMIT')
     
     args = parser.parse_args()
     
@@ -112,12 +156,14 @@ def main():
     # Создание приложения
     app = create_app()
     
-    # Создание таблиц базы данных
+    # Таблицы, миграции, поисковый индекс и пути папок; затем администратор по умолчанию
     with app.app_context():
-        print("Создание таблиц базы данных...")
-        db.create_all()
+        prepare_database(
+            migrate=args.migrate,
+            rebuild_tree=args.rebuild_folder_tree,
+            reconcile=args.reconcile_folders
+        )
         
-        # Создание администратора по умолчанию
         admin = User.query.filter_by(is_admin=True).first()
         if not admin:
             admin = User(
@@ -133,6 +179,77 @@ def main():
         else:
             print("✓ Администратор уже существует")
     
+    if args.rebuild_folder_tree or args.reconcile_folders or args.migrate:
+        return
+    
+    # Планы частых запросов; код выхода 1, если какой-то из них просматривает всю таблицу
+    if args.explain:
+        with app.app_context():
+            plans = explain_hot_queries()
+        for plan in plans:
+            print(f"{'⚠' if plan.full_scan else '✓'} {plan.name}")
+            for line in plan.plan:
+                print(f"    {line}")
+        full_scans = [plan.name for plan in plans if plan.full_scan]
+        if full_scans:
+            print(f"Полный просмотр таблицы: {', '.join(full_scans)} "
+                  f"(на почти пустых таблицах PostgreSQL и MySQL могут выбирать его и при наличии индекса)")
+            sys.exit(1)
+        return
+    
+    # Перенос файлов в новую раскладку (сервер можно не останавливать)
+    if args.migrate_layout:
+        with app.app_context():
+            moved = migrate_layout(app.config['UPLOAD_FOLDER'], batch_size=args.batch_size)
+            moved_thumbnails = migrate_thumbnail_layout(app.config['UPLOAD_FOLDER'])
+        print(f"✓ Перенесено файлов: {moved}, миниатюр: {moved_thumbnails}")
+        return
+    
+    # Сведения об изображениях, загруженных до появления колонок в File
+    if args.backfill_metadata:
+        with app.app_context():
+            filled = backfill_image_metadata(app.config['UPLOAD_FOLDER'], batch_size=args.batch_size)
+        print(f"✓ Обработано изображений: {filled}")
+        return
+    
+    # Текст документов, загруженных до появления поиска по содержимому (извлекают обработчики задач)
+    if args.index_content:
+        with app.app_context():
+            queued = backfill_content_index(batch_size=args.batch_size)
+        print(f"✓ Файлов в очереди на индексацию содержимого: {queued}")
+        return
+    
+    # Очистка миниатюр вручную
+    if args.gc_thumbnails:
+        with app.app_context():
+            upload_folder = app.config['UPLOAD_FOLDER']
+            stats = sweep_thumbnails(
+                upload_folder,
+                collect_thumbnail_sources(upload_folder),
+                app.config['THUMBNAIL_DISK_LIMIT']
+            )
+        print(f"✓ Миниатюр: {stats['files']} ({stats['bytes']} байт), удалено: "
+              f"без исходника {stats['orphaned']}, устаревших {stats['stale']}, вытеснено {stats['evicted']}")
+        return
+    
+    # Периодическая очистка миниатюр и брошенных сессий загрузки выполняется очередью задач
+    with app.app_context():
+        schedule_thumbnail_gc()
+        schedule_upload_session_gc()
+        db.session.commit()
+    
+    # Запуск отдельного процесса обработчиков фоновых задач
+    if args.worker:
+        pool = WorkerPool(app, size=args.workers).start()
+        print(f"Обработчики фоновых задач запущены: {pool.size}")
+        pool.join()
+        print("\nОбработчики фоновых задач остановлены")
+        return
+    
+    # Обработчики фоновых задач внутри веб-процесса
+    if app.config['JOBS_INPROCESS']:
+        WorkerPool(app, size=args.workers).start()
+    
     # Получение настроек
     port = int(os.environ.get('PORT', args.port))
     database_type = os.environ.get('DATABASE_TYPE', 'sqlite')
@@ -148,6 +265,7 @@ def main():
     print(f"База данных: {database_type}")
     print(f"Папка загрузок: {upload_folder}")
     print(f"Режим отладки: {'Включен' if args.debug else 'Выключен'}")
+    print(f"Фоновые задачи: {'в веб-процессе' if app.config['JOBS_INPROCESS'] else 'отдельный процесс (--worker)'}")
     print("="*50)
     print(f"Сервер доступен по адресу: http://localhost:{port}")
     print(f"Веб-интерфейс: http://localhost:{port}")
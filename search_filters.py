@@ -0,0 +1,169 @@
+"""
+Cloud Storage Server - фильтры и фасеты поиска файлов
+
+Найденные файлы можно сузить по семейству типов (изображения, видео, PDF...),
+диапазону размера, дате загрузки и доступу (публичный, общий, личный). Для
+каждого значения фильтра считается число файлов - все счетчики одним
+агрегирующим запросом (SUM(CASE ...)). Счетчик значения учитывает фильтры
+остальных групп, но не своей: выбор "Видео" не обнуляет счетчики других типов.
+
+Условия - фрагменты SQL над таблицей files с именованными параметрами, поэтому
+подходят для любого бэкенда поиска (search_index.py). Выборки по пользователю
+обслуживают индексы (user_id, mime_type), (user_id, file_size) и
+(user_id, created_at).
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+# Семейства типов: значение -> (название, условие)
+MIME_FAMILIES = {
+    'images': ('Изображения', "files.mime_type LIKE 'image/%'"),
+    'video': ('Видео', "files.mime_type LIKE 'video/%'"),
+    'audio': ('Аудио', "files.mime_type LIKE 'audio/%'"),
+    'pdf': ('PDF', "files.mime_type = 'application/pdf'"),
+    'documents': ('Документы', (
+        "(files.mime_type LIKE 'application/vnd.openxmlformats-officedocument.%' "
+        "OR files.mime_type LIKE 'application/vnd.oasis.opendocument.%' "
+        "OR files.mime_type IN ('application/msword', 'application/vnd.ms-excel', "
+        "'application/vnd.ms-powerpoint', 'application/rtf'))"
+    )),
+    'archives': ('Архивы', (
+        "files.mime_type IN ('application/zip', 'application/x-tar', 'application/gzip', "
+        "'application/x-7z-compressed', 'application/x-rar-compressed', 'application/vnd.rar', "
+        "'application/x-bzip2')"
+    )),
+    'text': ('Текст', "files.mime_type LIKE 'text/%'"),
+}
+
+# Диапазоны размера: значение -> (название, от, до) в байтах, граница "до" не включается
+SIZE_RANGES = {
+    'small': ('До 1 МБ', None, 1024 * 1024),
+    'medium': ('1–100 МБ', 1024 * 1024, 100 * 1024 * 1024),
+    'large': ('100 МБ – 1 ГБ', 100 * 1024 * 1024, 1024 * 1024 * 1024),
+    'huge': ('Больше 1 ГБ', 1024 * 1024 * 1024, None),
+}
+
+# Периоды загрузки: значение -> (название, дней назад)
+DATE_RANGES = {
+    'day': ('За сутки', 1),
+    'week': ('За неделю', 7),
+    'month': ('За месяц', 30),
+    'year': ('За год', 365),
+}
+
+# Доступ: значение -> (название, условие)
+SHARE_STATUSES = {
+    'public': ('Публичные', "files.is_public = :is_public"),
+    'shared': ('Общие', "EXISTS (SELECT 1 FROM file_shares WHERE file_shares.file_id = files.id)"),
+    'private': ('Личные', (
+        "files.is_public <> :is_public "
+        "AND NOT EXISTS (SELECT 1 FROM file_shares WHERE file_shares.file_id = files.id)"
+    )),
+}
+
+# Группы фасетов в порядке показа: параметр запроса -> (название, значения)
+FACET_GROUPS = {
+    'family': ('Тип', MIME_FAMILIES),
+    'size': ('Размер', SIZE_RANGES),
+    'date': ('Загружен', DATE_RANGES),
+    'status': ('Доступ', SHARE_STATUSES),
+}
+
+# date_from и date_to - явный диапазон дат загрузки (включительно), дополняет период date
+SearchFilters = namedtuple('SearchFilters', ['family', 'size', 'date', 'date_from', 'date_to', 'status'])
+
+NO_FILTERS = SearchFilters(None, None, None, None, None, None)
+
+FacetValue = namedtuple('FacetValue', ['value', 'label', 'count'])
+
+def as_datetime(value):
+    return datetime.combine(value, datetime.min.time()) if value is not None else None
+
+def form_filters(form):
+    """Фильтры из проверенной формы поиска (forms.SearchForm)"""
+    return SearchFilters(
+        family=form.family.data or None,
+        size=form.size.data or None,
+        date=form.date.data or None,
+        date_from=as_datetime(form.date_from.data),
+        date_to=as_datetime(form.date_to.data),
+        status=form.status.data or None
+    )
+
+def has_filters(filters):
+    return any(value is not None for value in filters)
+
+def filter_args(filters):
+    """Параметры запроса для ссылок с теми же фильтрами"""
+    args = {name: value for name, value in filters._asdict().items() if value is not None}
+    for name in ('date_from', 'date_to'):
+        if name in args:
+            args[name] = args[name].strftime('%Y-%m-%d')
+    return args
+
+def value_condition(group, value, params):
+    """Условие значения фильтра; параметры условия добавляются в params"""
+    if group == 'family':
+        return MIME_FAMILIES[value][1]
+    if group == 'size':
+        _, low, high = SIZE_RANGES[value]
+        bounds = []
+        if low is not None:
+            bounds.append(f'files.file_size >= {low}')
+        if high is not None:
+            bounds.append(f'files.file_size < {high}')
+        return ' AND '.join(bounds)
+    if group == 'date':
+        params[f'since_{value}'] = datetime.utcnow() - timedelta(days=DATE_RANGES[value][1])
+        return f'files.created_at >= :since_{value}'
+    params['is_public'] = True
+    return SHARE_STATUSES[value][1]
+
+def group_conditions(filters, params):
+    """Условия выбранных фильтров по группам: {группа: [условие]}"""
+    conditions = {}
+    for group in FACET_GROUPS:
+        value = getattr(filters, group)
+        if value is not None:
+            conditions.setdefault(group, []).append(value_condition(group, value, params))
+    if filters.date_from is not None:
+        params['date_from'] = filters.date_from
+        conditions.setdefault('date', []).append('files.created_at >= :date_from')
+    if filters.date_to is not None:
+        params['date_to'] = filters.date_to + timedelta(days=1)
+        conditions.setdefault('date', []).append('files.created_at < :date_to')
+    return conditions
+
+def filter_conditions(filters):
+    """Условия всех выбранных фильтров: ([условие], params)"""
+    params = {}
+    conditions = group_conditions(filters, params)
+    return [f'({condition})' for group in conditions.values() for condition in group], params
+
+def facet_counts_sql(filters, source):
+    """Запрос счетчиков всех значений фасетов по файлам из source ("FROM ... WHERE ...").
+
+    Возвращает (sql, params); колонки результата называются <группа>_<значение>.
+    """
+    params = {}
+    conditions = group_conditions(filters, params)
+    columns = []
+    for group, (_, choices) in FACET_GROUPS.items():
+        # Счетчик значения учитывает фильтры остальных групп
+        others = [f'({condition})' for other, items in conditions.items() if other != group for condition in items]
+        for value in choices:
+            condition = ' AND '.join([f'({value_condition(group, value, params)})'] + others)
+            columns.append(f'SUM(CASE WHEN {condition} THEN 1 ELSE 0 END) AS {group}_{value}')
+    return f"SELECT {', '.join(columns)} {source}", params
+
+def read_facets(row):
+    """Счетчики из строки результата facet_counts_sql: {группа: (название, [FacetValue])}"""
+    row = row._mapping
+    return {
+        group: (title, [
+            FacetValue(value, label, int(row[f'{group}_{value}'] or 0))
+            for value, (label, *_) in choices.items()
+        ])
+        for group, (title, choices) in FACET_GROUPS.items()
+    }
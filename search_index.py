@@ -0,0 +1,475 @@
+"""
+Cloud Storage Server - поисковый индекс имен файлов и папок
+
+Бэкенд выбирается по СУБД:
+- SQLite: виртуальные таблицы FTS5 (files_fts, folders_fts) над files и
+  folders, синхронизируются триггерами БД;
+- PostgreSQL: GIN-индексы по выражению to_tsvector('simple', ...);
+- MySQL/MariaDB: индексы FULLTEXT.
+Индекс обновляется самой СУБД при любых INSERT/UPDATE/DELETE, включая
+массовые (удаление дерева папок, переименование), поэтому код загрузки,
+переименования, перемещения и удаления о нем не знает.
+
+Тот же индекс ищет по тексту файлов (FileContent, content_index.py) и
+возвращает фрагменты с найденными словами. Найденные файлы сужаются фильтрами
+по типу, размеру, дате и доступу, счетчики фасетов считаются одним запросом
+(search_filters.py).
+
+Каждое слово запроса ищется как префикс, результаты упорядочены по
+релевантности и разбиты на страницы. Если индекс еще не создан
+(python run.py --migrate), поиск выполняется через LIKE.
+"""
+
+import re
+from collections import namedtuple
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import DBAPIError
+from markupsafe import Markup, escape
+from models import db, File, Folder, FileContent
+from search_filters import NO_FILTERS, has_filters, filter_conditions, facet_counts_sql, read_facets
+
+# Результатов на странице поиска
+SEARCH_PAGE_SIZE = 50
+
+SEARCH_KINDS = ('all', 'files', 'folders', 'content')
+
+# Границы найденных слов во фрагменте (заменяются на <mark> после экранирования)
+MARK_START = '\x02'
+MARK_END = '\x03'
+
+# Длина фрагмента текста, символов
+SNIPPET_LENGTH = 200
+
+# snippets - фрагменты текста найденных файлов (только для поиска по содержимому)
+SearchPage = namedtuple('SearchPage', ['results', 'has_next', 'snippets'])
+
+# Файлы пользователя без поиска по словам (только фильтры)
+FILES_SOURCE = "FROM files WHERE files.user_id = :user_id"
+CONTENT_SOURCE = "FROM file_contents JOIN files ON files.id = file_contents.file_id WHERE files.user_id = :user_id"
+
+def split_terms(query):
+    """Слова запроса: буквы и цифры, все остальное - разделители"""
+    return re.findall(r'[^\W_]+', query.lower())
+
+def make_snippet(content, terms, length=SNIPPET_LENGTH):
+    """Фрагмент текста вокруг первого найденного слова с отмеченными словами запроса"""
+    pattern = re.compile(r'(?<![^\W_])(?:' + '|'.join(re.escape(term) for term in terms) + r')[^\W_]*', re.IGNORECASE)
+    match = pattern.search(content)
+    start = max((match.start() if match else 0) - length // 3, 0)
+    if start > 0:
+        # Фрагмент начинается с целого слова
+        space = content.find(' ', start, match.start())
+        start = space + 1 if space != -1 else start
+    fragment = content[start:start + length]
+    fragment = pattern.sub(lambda m: f'{MARK_START}{m.group(0)}{MARK_END}', fragment)
+    return ('…' if start > 0 else '') + fragment + ('…' if start + length < len(content) else '')
+
+def where_sql(conditions):
+    """Условия фильтров для добавления к WHERE"""
+    return ''.join(f' AND {condition}' for condition in conditions)
+
+def highlight(snippet):
+    """Фрагмент как безопасный HTML: текст экранирован, найденные слова в <mark>"""
+    html = str(escape(' '.join(snippet.split())))
+    return Markup(html.replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+class LikeSearchBackend:
+    """Поиск подстроки через LIKE без индекса: запасной вариант"""
+
+    name = 'like'
+    setup_on_start = False
+
+    def is_ready(self):
+        return True
+
+    def setup(self):
+        return False
+
+    def match_source(self, terms, content=False):
+        """Найденные файлы как "FROM ... WHERE ..." и параметры (для счетчиков фасетов)"""
+        source, column = (CONTENT_SOURCE, 'file_contents.content') if content else (FILES_SOURCE, 'files.original_filename')
+        params = {f'term_{i}': f'%{term}%' for i, term in enumerate(terms)}
+        return source + ''.join(f' AND LOWER({column}) LIKE :{name}' for name in params), params
+
+    def find(self, user_id, terms, kind, limit, offset, filters=NO_FILTERS):
+        """[(kind, id)] страницы результатов; с фильтрами - только файлы"""
+        conditions, params = filter_conditions(filters)
+        rows = []
+        if kind in ('all', 'files'):
+            query = db.session.query(File.id).filter(File.user_id == user_id, *map(text, conditions)).params(params)
+            for term in terms:
+                query = query.filter(File.original_filename.ilike(f'%{term}%'))
+            rows.extend(('file', file_id) for (file_id,) in query.order_by(File.original_filename, File.id).limit(offset + limit))
+        if kind in ('all', 'folders') and not conditions:
+            query = db.session.query(Folder.id).filter(Folder.user_id == user_id)
+            for term in terms:
+                query = query.filter(Folder.name.ilike(f'%{term}%'))
+            rows.extend(('folder', folder_id) for (folder_id,) in query.order_by(Folder.name, Folder.id).limit(offset + limit))
+        return rows[offset:offset + limit]
+
+    def find_content(self, user_id, terms, limit, offset, filters=NO_FILTERS):
+        """[(file_id, фрагмент)] страницы результатов поиска по содержимому"""
+        conditions, params = filter_conditions(filters)
+        query = db.session.query(FileContent.file_id, FileContent.content).join(
+            File, File.id == FileContent.file_id
+        ).filter(File.user_id == user_id, *map(text, conditions)).params(params)
+        for term in terms:
+            query = query.filter(FileContent.content.ilike(f'%{term}%'))
+        rows = query.order_by(FileContent.file_id).limit(limit).offset(offset)
+        return [(file_id, make_snippet(content, terms)) for file_id, content in rows]
+
+class IndexedSearchBackend:
+    """Общая часть бэкендов с индексом: один UNION ALL-запрос по файлам и папкам"""
+
+    # Найденные файлы ("FROM ... WHERE ...") по имени и по содержимому
+    files_source = None
+    content_source = None
+    # Запросы к files и folders с колонками kind, id, score
+    files_select = None
+    folders_select = None
+    # Страница поиска по содержимому (id, snippet); {filters} - место условий фильтров
+    content_select = None
+    # Порядок: по убыванию score (PostgreSQL, MySQL) или по возрастанию (bm25 в SQLite)
+    score_order = 'DESC'
+    # Создавать индекс при каждом запуске (быстро) или только по --migrate (долго на больших таблицах)
+    setup_on_start = False
+
+    def build_match(self, terms):
+        raise NotImplementedError
+
+    def match_source(self, terms, content=False):
+        return (self.content_source if content else self.files_source), {'match': self.build_match(terms)}
+
+    def find(self, user_id, terms, kind, limit, offset, filters=NO_FILTERS):
+        conditions, params = filter_conditions(filters)
+        parts = []
+        if kind in ('all', 'files'):
+            parts.append(self.files_select + where_sql(conditions))
+        if kind in ('all', 'folders') and not conditions:
+            parts.append(self.folders_select)
+        if not parts:
+            return []
+        sql = (' UNION ALL '.join(parts) +
+               f' ORDER BY score {self.score_order}, kind, id LIMIT :limit OFFSET :offset')
+        rows = db.session.execute(text(sql), {
+            **params,
+            'match': self.build_match(terms),
+            'user_id': user_id,
+            'limit': limit,
+            'offset': offset
+        })
+        return [(row.kind, row.id) for row in rows]
+
+    def find_content(self, user_id, terms, limit, offset, filters=NO_FILTERS):
+        conditions, params = filter_conditions(filters)
+        rows = db.session.execute(text(self.content_select.format(filters=where_sql(conditions))), {
+            **params,
+            'match': self.build_match(terms),
+            'user_id': user_id,
+            'mark_start': MARK_START,
+            'mark_end': MARK_END,
+            'limit': limit,
+            'offset': offset
+        })
+        return [(row.id, row.snippet) for row in rows]
+
+class SqliteSearchBackend(IndexedSearchBackend):
+    """FTS5 с внешним содержимым (content=files), синхронизация - триггерами"""
+
+    name = 'fts5'
+    score_order = 'ASC'
+    setup_on_start = True
+
+    # Таблица, колонка, имя FTS-таблицы, ключ строки
+    TABLES = (
+        ('files', 'original_filename', 'files_fts', 'id'),
+        ('folders', 'name', 'folders_fts', 'id'),
+        ('file_contents', 'content', 'file_contents_fts', 'file_id'),
+    )
+
+    files_source = (
+        "FROM files_fts JOIN files ON files.id = files_fts.rowid "
+        "WHERE files_fts MATCH :match AND files.user_id = :user_id"
+    )
+    content_source = (
+        "FROM file_contents_fts JOIN files ON files.id = file_contents_fts.rowid "
+        "WHERE file_contents_fts MATCH :match AND files.user_id = :user_id"
+    )
+    files_select = "SELECT 'file' AS kind, files.id AS id, bm25(files_fts) AS score " + files_source
+    folders_select = (
+        "SELECT 'folder' AS kind, folders.id AS id, bm25(folders_fts) AS score "
+        "FROM folders_fts JOIN folders ON folders.id = folders_fts.rowid "
+        "WHERE folders_fts MATCH :match AND folders.user_id = :user_id"
+    )
+    content_select = (
+        "SELECT files.id AS id, snippet(file_contents_fts, 0, :mark_start, :mark_end, '…', 24) AS snippet "
+        + content_source +
+        "{filters} ORDER BY bm25(file_contents_fts), files.id LIMIT :limit OFFSET :offset"
+    )
+
+    def build_match(self, terms):
+        return ' AND '.join(f'"{term}"*' for term in terms)
+
+    def get_objects(self):
+        with db.engine.connect() as connection:
+            return {name for (name,) in connection.execute(text(
+                "SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')"
+            ))}
+
+    def is_ready(self):
+        objects = self.get_objects()
+        return all(fts in objects and f'{fts}_ad' in objects for _, _, fts, _ in self.TABLES)
+
+    def setup(self):
+        """Создает FTS-таблицы и триггеры; новую таблицу заполняет по существующим строкам"""
+        objects = self.get_objects()
+        created = False
+        with db.engine.begin() as connection:
+            for table, column, fts, key in self.TABLES:
+                if fts not in objects:
+                    connection.execute(text(
+                        f"CREATE VIRTUAL TABLE {fts} USING fts5({column}, content='{table}', content_rowid='{key}', "
+                        f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+                    ))
+                    connection.execute(text(f"INSERT INTO {fts}({fts}) VALUES('rebuild')"))
+                    created = True
+                connection.execute(text(
+                    f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+                    f"INSERT INTO {fts}(rowid, {column}) VALUES (new.{key}, new.{column}); END"
+                ))
+                connection.execute(text(
+                    f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+                    f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.{key}, old.{column}); END"
+                ))
+                connection.execute(text(
+                    f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {column} ON {table} BEGIN "
+                    f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.{key}, old.{column}); "
+                    f"INSERT INTO {fts}(rowid, {column}) VALUES (new.{key}, new.{column}); END"
+                ))
+        return created
+
+class PostgresSearchBackend(IndexedSearchBackend):
+    """tsvector по имени и тексту; GIN-индексы по тем же выражениям обновляет сама СУБД"""
+
+    name = 'tsvector'
+
+    # Знаки препинания в именах заменяются пробелами, чтобы "отчет_2024.pdf" давал слова отчет, 2024, pdf
+    @staticmethod
+    def vector(column):
+        return f"to_tsvector('simple', regexp_replace({column}, '[^[:alnum:]]+', ' ', 'g'))"
+
+    CONTENT_VECTOR = "to_tsvector('simple', content)"
+
+    # Таблица, индексируемое выражение, имя индекса
+    INDEXES = (
+        ('files', vector.__func__('original_filename'), 'ix_files_name_search'),
+        ('folders', vector.__func__('name'), 'ix_folders_name_search'),
+        ('file_contents', CONTENT_VECTOR, 'ix_file_contents_search'),
+    )
+
+    def __init__(self):
+        self.files_source = (
+            f"FROM files WHERE files.user_id = :user_id "
+            f"AND {self.vector('original_filename')} @@ to_tsquery('simple', :match)"
+        )
+        self.content_source = (
+            "FROM file_contents JOIN files ON files.id = file_contents.file_id "
+            f"WHERE files.user_id = :user_id AND {self.CONTENT_VECTOR} @@ to_tsquery('simple', :match)"
+        )
+        self.files_select = (
+            f"SELECT 'file' AS kind, id, ts_rank({self.vector('original_filename')}, to_tsquery('simple', :match)) AS score "
+            + self.files_source
+        )
+        self.folders_select = (
+            f"SELECT 'folder' AS kind, id, ts_rank({self.vector('name')}, to_tsquery('simple', :match)) AS score "
+            f"FROM folders WHERE user_id = :user_id AND {self.vector('name')} @@ to_tsquery('simple', :match)"
+        )
+        # ts_headline дорогой - считается только для строк страницы
+        self.content_select = (
+            "SELECT page.id, ts_headline('simple', file_contents.content, to_tsquery('simple', :match), "
+            "'StartSel=' || :mark_start || ', StopSel=' || :mark_end || ', MaxWords=35, MinWords=15') AS snippet "
+            "FROM (SELECT files.id, "
+            f"ts_rank({self.CONTENT_VECTOR}, to_tsquery('simple', :match)) AS score "
+            + self.content_source +
+            "{filters} ORDER BY score DESC, files.id LIMIT :limit OFFSET :offset) AS page "
+            "JOIN file_contents ON file_contents.file_id = page.id "
+            "ORDER BY page.score DESC, page.id"
+        )
+
+    def build_match(self, terms):
+        return ' & '.join(f'{term}:*' for term in terms)
+
+    def is_ready(self):
+        with db.engine.connect() as connection:
+            existing = {name for (name,) in connection.execute(text('SELECT indexname FROM pg_indexes'))}
+        return all(index in existing for _, _, index in self.INDEXES)
+
+    def setup(self):
+        """Строит GIN-индексы без блокировки записи (CONCURRENTLY)"""
+        created = False
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            existing = {name for (name,) in connection.execute(text('SELECT indexname FROM pg_indexes'))}
+            for table, expression, index in self.INDEXES:
+                if index in existing:
+                    continue
+                try:
+                    connection.execute(text(
+                        f"CREATE INDEX CONCURRENTLY {index} ON {table} USING gin ({expression})"
+                    ))
+                except Exception:
+                    # Прерванная сборка оставляет нерабочий (INVALID) индекс - удаляем его
+                    connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {index}'))
+                    raise
+                created = True
+        return created
+
+class MysqlSearchBackend(IndexedSearchBackend):
+    """FULLTEXT-индексы InnoDB, поиск в BOOLEAN MODE"""
+
+    name = 'fulltext'
+
+    INDEXES = (
+        ('files', 'original_filename', 'ix_files_name_search'),
+        ('folders', 'name', 'ix_folders_name_search'),
+        ('file_contents', 'content', 'ix_file_contents_search'),
+    )
+
+    files_source = (
+        "FROM files WHERE files.user_id = :user_id "
+        "AND MATCH(files.original_filename) AGAINST (:match IN BOOLEAN MODE)"
+    )
+    content_source = (
+        "FROM file_contents JOIN files ON files.id = file_contents.file_id "
+        "WHERE files.user_id = :user_id AND MATCH(file_contents.content) AGAINST (:match IN BOOLEAN MODE)"
+    )
+    files_select = (
+        "SELECT 'file' AS kind, id, MATCH(original_filename) AGAINST (:match IN BOOLEAN MODE) AS score "
+        + files_source
+    )
+    folders_select = (
+        "SELECT 'folder' AS kind, id, MATCH(name) AGAINST (:match IN BOOLEAN MODE) AS score "
+        "FROM folders WHERE user_id = :user_id AND MATCH(name) AGAINST (:match IN BOOLEAN MODE)"
+    )
+    content_select = (
+        "SELECT files.id AS id, file_contents.content AS snippet "
+        + content_source +
+        "{filters} ORDER BY MATCH(file_contents.content) AGAINST (:match IN BOOLEAN MODE) DESC, files.id "
+        "LIMIT :limit OFFSET :offset"
+    )
+
+    def build_match(self, terms):
+        return ' '.join(f'+{term}*' for term in terms)
+
+    def find_content(self, user_id, terms, limit, offset, filters=NO_FILTERS):
+        # Функции фрагментов в MySQL нет - фрагмент вырезается из текста
+        rows = super().find_content(user_id, terms, limit, offset, filters)
+        return [(file_id, make_snippet(content, terms)) for file_id, content in rows]
+
+    def get_indexes(self, table):
+        return {index['name'] for index in inspect(db.engine).get_indexes(table)}
+
+    def is_ready(self):
+        return all(index in self.get_indexes(table) for table, _, index in self.INDEXES)
+
+    def setup(self):
+        created = False
+        for table, column, index in self.INDEXES:
+            if index in self.get_indexes(table):
+                continue
+            with db.engine.begin() as connection:
+                connection.execute(text(f"ALTER TABLE {table} ADD FULLTEXT INDEX {index} ({column})"))
+            created = True
+        return created
+
+def get_search_backend():
+    """Бэкенд поиска для текущей СУБД (без обращения к БД)"""
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return SqliteSearchBackend()
+    if dialect == 'postgresql':
+        return PostgresSearchBackend()
+    if dialect in ('mysql', 'mariadb'):
+        return MysqlSearchBackend()
+    return LikeSearchBackend()
+
+def browse_files(user_id, limit, offset, filters):
+    """[(kind, id)] файлов, подходящих под фильтры, без поиска по словам: новые первыми"""
+    conditions, params = filter_conditions(filters)
+    rows = db.session.execute(text(
+        f"SELECT files.id AS id {FILES_SOURCE}{where_sql(conditions)} "
+        "ORDER BY files.created_at DESC, files.id DESC LIMIT :limit OFFSET :offset"
+    ), {**params, 'user_id': user_id, 'limit': limit, 'offset': offset})
+    return [('file', row.id) for row in rows]
+
+def search_items(backend, user_id, query, kind='all', page=1, per_page=SEARCH_PAGE_SIZE, filters=NO_FILTERS):
+    """Страница результатов поиска: SearchPage([File или Folder], has_next, {file_id: фрагмент}).
+
+    Запросы: поиск по индексу и загрузка найденных файлов и папок. При поиске
+    по содержимому (kind='content') находятся только файлы, с фрагментами текста.
+    С фильтрами (filters) находятся только файлы; без слов запроса - все файлы
+    под фильтрами.
+    """
+    terms = split_terms(query)
+    if kind not in SEARCH_KINDS or not (terms or has_filters(filters) and kind != 'folders'):
+        return SearchPage([], False, {})
+    offset = (max(page, 1) - 1) * per_page
+    with_snippets = kind == 'content' and terms
+
+    try:
+        if not terms:
+            found = browse_files(user_id, per_page + 1, offset, filters)
+        elif with_snippets:
+            found = backend.find_content(user_id, terms, per_page + 1, offset, filters)
+        else:
+            found = backend.find(user_id, terms, kind, per_page + 1, offset, filters)
+    except DBAPIError as e:
+        # Индекс еще не создан (нет FTS-таблицы или FULLTEXT-индекса)
+        print(f"Поиск по индексу ({backend.name}) недоступен, используется LIKE: {e}")
+        db.session.rollback()
+        if with_snippets:
+            found = LikeSearchBackend().find_content(user_id, terms, per_page + 1, offset, filters)
+        else:
+            found = LikeSearchBackend().find(user_id, terms, kind, per_page + 1, offset, filters)
+
+    has_next = len(found) > per_page
+    found = found[:per_page]
+
+    snippets = {}
+    if with_snippets:
+        snippets = {file_id: highlight(snippet) for file_id, snippet in found}
+        rows = [('file', file_id) for file_id, _ in found]
+    else:
+        rows = found
+
+    file_ids = [item_id for item_kind, item_id in rows if item_kind == 'file']
+    folder_ids = [item_id for item_kind, item_id in rows if item_kind == 'folder']
+    items = {}
+    if file_ids:
+        items.update((('file', file.id), file) for file in File.query.filter(File.id.in_(file_ids)))
+    if folder_ids:
+        items.update((('folder', folder.id), folder) for folder in Folder.query.filter(Folder.id.in_(folder_ids)))
+    return SearchPage([items[row] for row in rows if row in items], has_next, snippets)
+
+def count_facets(backend, user_id, query, kind='all', filters=NO_FILTERS):
+    """Счетчики фасетов найденных файлов: {группа: (название, [FacetValue])}.
+
+    Один агрегирующий запрос; без слов запроса считаются все файлы
+    пользователя. Для поиска только папок фасетов нет (None).
+    """
+    if kind == 'folders' or kind not in SEARCH_KINDS:
+        return None
+    terms = split_terms(query)
+    content = kind == 'content'
+
+    def execute(backend):
+        source, params = backend.match_source(terms, content) if terms else (FILES_SOURCE, {})
+        sql, filter_params = facet_counts_sql(filters, source)
+        return db.session.execute(text(sql), {**params, **filter_params, 'user_id': user_id}).one()
+
+    try:
+        row = execute(backend)
+    except DBAPIError as e:
+        print(f"Счетчики фасетов по индексу ({backend.name}) недоступны, используется LIKE: {e}")
+        db.session.rollback()
+        row = execute(LikeSearchBackend())
+    return read_facets(row)
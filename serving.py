@@ -0,0 +1,202 @@
+"""
+Cloud Storage Server - отдача файлов клиенту
+
+Сильный ETag, условные запросы (304), Range-запросы, включая несколько
+диапазонов (multipart/byteranges), и режимы X-Accel-Redirect / X-Sendfile.
+"""
+
+import os
+import uuid
+from urllib.parse import quote
+from flask import current_app, request, send_file
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import is_resource_modified
+from werkzeug.utils import send_file as werkzeug_send_file
+
+# Больше диапазонов в одном запросе не обслуживаем - отдаем файл целиком
+MAX_RANGES = 16
+
+# Размер блока чтения при отдаче диапазонов
+RANGE_BLOCK_SIZE = 64 * 1024
+
+def file_etag(file):
+    """Сильный ETag записи File: id, размер и время последнего изменения"""
+    updated_at = file.updated_at or file.created_at
+    version = updated_at.strftime('%Y%m%d%H%M%S%f') if updated_at else '0'
+    return f"{file.id}-{file.file_size}-{version}"
+
+def parse_byte_ranges(value):
+    """Разбирает заголовок Range (bytes=0-9,20-,-5) в список (start, stop).
+
+    stop не включается; для суффикса (последние N байт) start = -N, stop = None.
+    В отличие от werkzeug допускает пересекающиеся диапазоны. Возвращает
+    None, если заголовок некорректен.
+    """
+    if not value or not value.startswith('bytes='):
+        return None
+
+    ranges = []
+    for item in value[len('bytes='):].split(','):
+        first, sep, last = item.strip().partition('-')
+        if not sep or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            if not last:
+                return None
+            ranges.append((-int(last), None))
+        elif last:
+            if int(last) < int(first):
+                return None
+            ranges.append((int(first), int(last) + 1))
+        else:
+            ranges.append((int(first), None))
+    return ranges
+
+def normalize_ranges(ranges, size):
+    """Приводит диапазоны из заголовка Range к списку (start, stop) в пределах файла.
+
+    Пересекающиеся и соседние диапазоны объединяются, недостижимые
+    отбрасываются.
+    """
+    normalized = []
+    for start, stop in ranges:
+        if start < 0:
+            # Суффикс: последние N байт
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            normalized.append((start, stop))
+
+    normalized.sort()
+    merged = []
+    for start, stop in normalized:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def iter_ranges(full_path, parts, closing=b'', block_size=RANGE_BLOCK_SIZE):
+    """Генератор тела ответа: для каждой части заголовок (если есть) и ее байты"""
+    with open(full_path, 'rb') as f:
+        for header, start, stop in parts:
+            yield header
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                block = f.read(min(block_size, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+            if header:
+                yield b'\r\n'
+    yield closing
+
+def send_multiple_ranges(full_path, byte_ranges, mimetype, as_attachment, download_name, etag, last_modified):
+    """Ответ 206 с несколькими диапазонами файла (multipart/byteranges)"""
+    # Заголовки (Content-Disposition, ETag, Last-Modified) собирает werkzeug,
+    # тело формируется здесь
+    response = werkzeug_send_file(
+        full_path,
+        request.environ,
+        mimetype=mimetype,
+        as_attachment=as_attachment,
+        download_name=download_name,
+        conditional=False,
+        etag=etag or False,
+        last_modified=last_modified,
+        use_x_sendfile=True,
+        response_class=current_app.response_class
+    )
+    del response.headers['X-Sendfile']
+
+    size = os.stat(full_path).st_size
+    ranges = normalize_ranges(byte_ranges, size)
+    if not ranges:
+        raise RequestedRangeNotSatisfiable(size)
+
+    content_type = response.headers['Content-Type']
+    if len(ranges) == 1:
+        # После объединения остался один диапазон - отдаем без разделителей
+        start, stop = ranges[0]
+        parts = [(b'', start, stop)]
+        closing = b''
+        response.content_range = f"bytes {start}-{stop - 1}/{size}"
+        length = stop - start
+    else:
+        boundary = uuid.uuid4().hex
+        parts = [
+            (
+                f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n".encode('ascii'),
+                start,
+                stop
+            )
+            for start, stop in ranges
+        ]
+        closing = f"--{boundary}--\r\n".encode('ascii')
+        length = sum(len(header) + (stop - start) + 2 for header, start, stop in parts) + len(closing)
+        response.headers['Content-Type'] = f"multipart/byteranges; boundary={boundary}"
+
+    response.response = iter_ranges(full_path, parts, closing)
+    response.status_code = 206
+    response.content_length = length
+    response.accept_ranges = 'bytes'
+    return response
+
+def send_stored_file(full_path, mimetype, as_attachment=False, download_name=None, etag=None, last_modified=None):
+    """Отдает файл из UPLOAD_FOLDER согласно FILE_SERVING_MODE.
+
+    direct - байты передает сам Flask: ответ содержит ETag и Last-Modified,
+    на If-None-Match / If-Modified-Since возвращается 304, Range-запросы
+    (один или несколько диапазонов) возвращают 206. x-accel (nginx) и
+    x-sendfile (Apache, lighttpd) - Flask только проверяет права и
+    возвращает заголовок, а файл, условные запросы и диапазоны обслуживает
+    фронтовой сервер через sendfile. Если файла нет, FileNotFoundError.
+    """
+    mode = current_app.config['FILE_SERVING_MODE']
+    if mode not in ('x-accel', 'x-sendfile'):
+        byte_ranges = parse_byte_ranges(request.headers.get('Range')) or []
+        if (
+            1 < len(byte_ranges) <= MAX_RANGES
+            and request.method in ('GET', 'HEAD')
+            and is_resource_modified(request.environ, etag, last_modified=last_modified)
+            and ('HTTP_IF_RANGE' not in request.environ
+                 or not is_resource_modified(request.environ, etag, last_modified=last_modified, ignore_if_range=False))
+        ):
+            return send_multiple_ranges(full_path, byte_ranges, mimetype, as_attachment, download_name, etag, last_modified)
+
+        # Один диапазон и 304 обрабатывает werkzeug
+        response = send_file(
+            full_path,
+            mimetype=mimetype,
+            as_attachment=as_attachment,
+            download_name=download_name,
+            etag=etag if etag is not None else True,
+            last_modified=last_modified
+        )
+        # Просмотрщики (PDF, видео) запрашивают диапазоны, только увидев этот заголовок
+        response.accept_ranges = 'bytes'
+        return response
+
+    # Условные запросы и диапазоны обрабатывает фронтовой сервер
+    response = werkzeug_send_file(
+        full_path,
+        request.environ,
+        mimetype=mimetype,
+        as_attachment=as_attachment,
+        download_name=download_name,
+        conditional=False,
+        use_x_sendfile=True,
+        response_class=current_app.response_class
+    )
+
+    if mode == 'x-accel':
+        relative = os.path.relpath(full_path, os.path.abspath(current_app.config['UPLOAD_FOLDER']))
+        del response.headers['X-Sendfile']
+        response.headers['X-Accel-Redirect'] = current_app.config['X_ACCEL_PREFIX'].rstrip('/') + '/' + quote(relative.replace(os.sep, '/'))
+        # Тело отдает nginx из internal location
+        response.content_length = 0
+    return response
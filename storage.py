@@ -0,0 +1,396 @@
+"""
+Cloud Storage Server - работа с файлами хранилища на диске
+"""
+
+import os
+import re
+import uuid
+import shutil
+import hashlib
+import threading
+from collections import namedtuple
+from sqlalchemy import exists
+from sqlalchemy.exc import IntegrityError
+from models import db, Blob, File, User
+
+# Размер блока чтения входящего потока
+INGEST_BLOCK_SIZE = 1024 * 1024  # 1MB
+
+# Запас на служебную часть тела multipart-формы (границы, заголовки частей, поле CSRF):
+# запрос, Content-Length которого больше свободного места на этот запас, отклоняется сразу
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+
+IngestResult = namedtuple('IngestResult', ['size', 'sha256'])
+
+# Имена, начинающиеся с шестнадцатеричного префикса (хеши, uuid), раскладываются по нему
+HEX_PREFIX = re.compile(r'^[0-9a-f]{4}')
+
+class FileTooLargeError(Exception):
+    """Файл превышает максимальный допустимый размер"""
+
+class QuotaExceededError(Exception):
+    """Загрузка превышает свободное место в хранилище пользователя"""
+
+class QuotaBudget:
+    """Остаток свободного места, общий для файлов, записываемых параллельно"""
+
+    def __init__(self, available):
+        self.available = available
+        self.exceeded = False
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        with self.lock:
+            if self.exceeded or size > self.available:
+                # Останавливаем и остальные потоки этой загрузки
+                self.exceeded = True
+                raise QuotaExceededError(size)
+            self.available -= size
+
+    def release(self, size):
+        with self.lock:
+            self.available += size
+
+def shard_path(name):
+    """Путь внутри хранилища с разбиением по префиксу имени: ab/cd/<name>.
+
+    Так в одном каталоге оказывается не больше нескольких тысяч файлов
+    даже при миллионах записей. Для имен без шестнадцатеричного префикса
+    каталог выбирается по хешу имени.
+    """
+    key = name if HEX_PREFIX.match(name) else hashlib.sha256(name.encode('utf-8')).hexdigest()
+    return f"{key[:2]}/{key[2:4]}/{name}"
+
+def normalize_file_path(file_path):
+    """Приводит путь из БД к пути внутри UPLOAD_FOLDER.
+
+    Старые записи хранят путь с префиксом 'uploads\\' или 'uploads/'.
+    """
+    relative = file_path.replace('\\', '/')
+    if relative.startswith('uploads/'):
+        relative = relative[len('uploads/'):]
+    return relative
+
+def resolve_path(upload_folder, file_path):
+    """Возвращает полный путь к файлу на диске для записи любого формата.
+
+    Поддерживает обе раскладки: если по пути из БД файла нет (его перенесла
+    миграция после того, как запись была прочитана), файл ищется по
+    плоскому и разбитому по префиксу пути.
+    """
+    upload_folder = os.path.abspath(upload_folder)
+    relative = normalize_file_path(file_path)
+    full_path = os.path.join(upload_folder, relative)
+    if os.path.exists(full_path):
+        return full_path
+
+    name = os.path.basename(relative)
+    for candidate in (shard_path(name), name):
+        candidate_path = os.path.join(upload_folder, candidate)
+        if candidate_path != full_path and os.path.exists(candidate_path):
+            return candidate_path
+    return full_path
+
+def link_or_copy(source, destination):
+    """Создает второе имя файла: жесткую ссылку, а если ФС не поддерживает - копию"""
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copy2(source, destination)
+
+def reserve_quota(user_id, size):
+    """Атомарно резервирует size байт в хранилище пользователя.
+
+    Проверка лимита и увеличение storage_used выполняются одним условным
+    UPDATE на стороне БД, поэтому параллельные загрузки (другие процессы,
+    вкладки) не могут вместе превысить лимит. Возвращает True, если место
+    зарезервировано. Commit делает вызывающий код.
+    """
+    if size <= 0:
+        return True
+
+    reserved = User.query.filter(
+        User.id == user_id,
+        User.storage_used + size <= User.storage_limit
+    ).update({User.storage_used: User.storage_used + size}, synchronize_session=False)
+    return reserved == 1
+
+def release_quota(user_id, size):
+    """Возвращает size байт в хранилище пользователя (commit делает вызывающий код)"""
+    if size <= 0:
+        return
+
+    User.query.filter_by(id=user_id).update(
+        {User.storage_used: User.storage_used - size},
+        synchronize_session=False
+    )
+
+class QuotaReservation:
+    """Место, зарезервированное под одну загрузку.
+
+    Резерв фиксируется сразу, чтобы не держать блокировку строки
+    пользователя, пока читается тело запроса. По окончании загрузки
+    settle() оставляет за ней фактически записанный объем, а release()
+    возвращает все, что не было использовано.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.size = 0
+
+    def reserve(self, size):
+        if not reserve_quota(self.user_id, size):
+            db.session.rollback()
+            return False
+        db.session.commit()
+        self.size += max(size, 0)
+        return True
+
+    def ensure(self, size):
+        """Дорезервирует место, если загружено больше, чем было зарезервировано"""
+        if size <= self.size:
+            return True
+        return self.reserve(size - self.size)
+
+    def settle(self, used):
+        """Возвращает неиспользованный остаток и фиксирует текущую транзакцию.
+
+        Если commit не удался, резерв остается целиком и его возвращает release().
+        """
+        release_quota(self.user_id, self.size - used)
+        db.session.commit()
+        self.size = 0
+
+    def release(self):
+        if self.size:
+            release_quota(self.user_id, self.size)
+            db.session.commit()
+            self.size = 0
+
+def ingest_stream(stream, destination, max_size=None, budget=None, block_size=INGEST_BLOCK_SIZE):
+    """Записывает поток на диск за один проход, одновременно считая размер и SHA-256.
+
+    Поток читается ровно один раз. Если размер превышает max_size или
+    остаток budget (QuotaBudget), запись прерывается сразу, частично
+    записанный файл удаляется и выбрасывается FileTooLargeError или
+    QuotaExceededError соответственно.
+    """
+    digest = hashlib.sha256()
+    size = 0
+
+    try:
+        with open(destination, 'wb') as f:
+            while True:
+                block = stream.read(block_size)
+                if not block:
+                    break
+                if max_size is not None and size + len(block) > max_size:
+                    raise FileTooLargeError(size + len(block))
+                if budget is not None:
+                    budget.consume(len(block))
+                size += len(block)
+                digest.update(block)
+                f.write(block)
+    except BaseException as e:
+        if os.path.exists(destination):
+            os.remove(destination)
+        if budget is not None and not isinstance(e, QuotaExceededError):
+            # Место, занятое неудавшимся файлом, возвращается остальным
+            budget.release(size)
+        raise
+
+    return IngestResult(size, digest.hexdigest())
+
+def hash_file(path, block_size=INGEST_BLOCK_SIZE):
+    """Считает размер и SHA-256 уже записанного на диск файла"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            size += len(block)
+            digest.update(block)
+    return IngestResult(size, digest.hexdigest())
+
+def acquire_blob(content_hash, size=None, owner_id=None):
+    """Увеличивает счетчик ссылок существующего блоба.
+
+    owner_id - блоб берется, только если у этого пользователя уже есть файл с
+    ним: по одному хешу (мгновенная загрузка) нельзя получить чужое содержимое
+    или узнать, что оно хранится на сервере.
+
+    Возвращает Blob или None, если содержимого с таким хешем (и размером) нет.
+    """
+    query = Blob.query.filter_by(content_hash=content_hash)
+    if size is not None:
+        query = query.filter_by(size=size)
+    if owner_id is not None:
+        query = query.filter(exists().where(File.blob_id == Blob.id, File.user_id == owner_id))
+
+    # Инкремент на стороне БД, чтобы параллельные загрузки не теряли ссылки
+    if query.update({Blob.refcount: Blob.refcount + 1}, synchronize_session=False) == 0:
+        return None
+
+    blob = Blob.query.filter_by(content_hash=content_hash).first()
+    db.session.refresh(blob)
+    return blob
+
+def blob_file_name(content_hash):
+    """Имя файла нового блоба: хеш содержимого и случайный суффикс.
+
+    Пока удаляется файл блоба без ссылок, то же содержимое могут загрузить
+    заново. С общим именем по хешу новая загрузка записала бы файл на место
+    удаляемого и потеряла бы его; с собственным именем у каждого блоба
+    удаление никогда не задевает файл, записанный позже.
+    """
+    return f"{content_hash}-{uuid.uuid4().hex[:12]}"
+
+def store_blob(upload_folder, temp_path, content_hash, size):
+    """Помещает записанный во временный файл контент в хранилище блобов.
+
+    Если такой контент уже хранится, временный файл удаляется и у блоба
+    увеличивается счетчик ссылок. Возвращает (blob, created), где created
+    означает, что на диске появился новый файл.
+    """
+    blob = acquire_blob(content_hash, size)
+    if blob is not None:
+        os.remove(temp_path)
+        return blob, False
+
+    blob_path = shard_path(blob_file_name(content_hash))
+    full_blob_path = os.path.join(upload_folder, blob_path)
+    os.makedirs(os.path.dirname(full_blob_path), exist_ok=True)
+    os.replace(temp_path, full_blob_path)
+
+    try:
+        with db.session.begin_nested():
+            blob = Blob(content_hash=content_hash, file_path=blob_path, size=size, refcount=1)
+            db.session.add(blob)
+    except IntegrityError:
+        # Такой же контент параллельно сохранила другая загрузка - свой файл не нужен
+        os.remove(full_blob_path)
+        blob = acquire_blob(content_hash, size)
+        return blob, False
+
+    return blob, True
+
+def release_blob(blob):
+    """Уменьшает счетчик ссылок блоба.
+
+    Когда ссылок не остается, запись блоба удаляется из БД и функция
+    возвращает путь к файлу внутри UPLOAD_FOLDER, который нужно удалить
+    с диска после фиксации транзакции. Иначе возвращает None.
+    """
+    Blob.query.filter_by(id=blob.id).update({Blob.refcount: Blob.refcount - 1}, synchronize_session=False)
+    db.session.refresh(blob)
+
+    if blob.refcount > 0:
+        return None
+
+    blob_path = blob.file_path
+    db.session.delete(blob)
+    return blob_path
+
+def unlink_blob_file(full_path, blob_path, content_hash):
+    """Удаляет с диска файл удаленного блоба (после commit удаления записи).
+
+    Новые блобы получают собственные имена (blob_file_name), поэтому файл
+    можно удалить, даже если то же содержимое уже загрузили заново. Запись,
+    которая по-прежнему указывает на этот путь (блоб старой раскладки с
+    именем по хешу), файл сохраняет.
+    """
+    if Blob.query.filter_by(content_hash=content_hash, file_path=blob_path).first() is not None:
+        return False
+
+    if os.path.exists(full_path):
+        os.remove(full_path)
+        return True
+    return False
+
+def _migrate_batch(upload_folder, rows, update_row):
+    """Переносит пакет файлов в разбитую раскладку (см. migrate_layout)"""
+    moved_sources = []
+    for row in rows:
+        relative = normalize_file_path(row.file_path)
+        target = shard_path(os.path.basename(relative))
+        if relative == target:
+            continue
+
+        source_path = os.path.join(upload_folder, relative)
+        if not os.path.exists(source_path):
+            print(f"Файл не найден на диске, пропущен: {source_path}")
+            continue
+
+        target_path = os.path.join(upload_folder, target)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        link_or_copy(source_path, target_path)
+
+        if update_row(row, target):
+            moved_sources.append(source_path)
+        elif os.path.exists(target_path):
+            # Запись удалили или изменили параллельно - новое имя не нужно
+            os.remove(target_path)
+
+    db.session.commit()
+
+    # Старые имена удаляются только после фиксации новых путей
+    for source_path in moved_sources:
+        if os.path.exists(source_path):
+            os.remove(source_path)
+    return len(moved_sources)
+
+def migrate_layout(upload_folder, batch_size=500):
+    """Переносит файлы из плоской раскладки в ab/cd/<name>, не останавливая сервер.
+
+    Файлы обрабатываются пакетами: сначала создается новое имя (жесткая
+    ссылка), затем пути пакета обновляются в БД одной транзакцией, и
+    только после commit удаляются старые имена. Запросы, успевшие прочитать
+    старый путь, находят файл через resolve_path. Возвращает число
+    перенесенных файлов.
+    """
+    upload_folder = os.path.abspath(upload_folder)
+
+    def update_blob(blob, target):
+        updated = Blob.query.filter_by(id=blob.id, file_path=blob.file_path).update(
+            {Blob.file_path: target}, synchronize_session=False
+        )
+        if updated:
+            File.query.filter_by(blob_id=blob.id).update(
+                {File.file_path: target, File.filename: target}, synchronize_session=False
+            )
+        return updated
+
+    def update_legacy_file(file, target):
+        return File.query.filter_by(id=file.id, file_path=file.file_path).update(
+            {File.file_path: target}, synchronize_session=False
+        )
+
+    moved = 0
+    for model, query, update_row in (
+        (Blob, Blob.query, update_blob),
+        (File, File.query.filter(File.blob_id.is_(None)), update_legacy_file),
+    ):
+        last_id = 0
+        while True:
+            rows = query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            moved += _migrate_batch(upload_folder, rows, update_row)
+            print(f"Перенесено файлов: {moved}")
+
+    # Файлы, зарегистрированные во время миграции со старым путем блоба
+    stale = db.session.query(File.id, Blob.file_path).join(Blob, File.blob_id == Blob.id).filter(
+        File.file_path != Blob.file_path
+    ).all()
+    for file_id, blob_path in stale:
+        File.query.filter_by(id=file_id).update(
+            {File.file_path: blob_path, File.filename: blob_path}, synchronize_session=False
+        )
+    db.session.commit()
+
+    return moved
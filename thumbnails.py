@@ -0,0 +1,592 @@
+"""
+Cloud Storage Server - миниатюры изображений
+
+Для каждого изображения создается набор размеров (renditions) в WebP и
+JPEG: квадратные миниатюры для списка и сетки (в том числе для HiDPI
+экранов) и уменьшенная копия для просмотра. Все размеры получаются за одно
+декодирование исходника.
+"""
+
+import os
+import json
+import time
+import uuid
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from models import db, File, Job
+from jobs import job_handler, enqueue
+from storage import shard_path, resolve_path, normalize_file_path
+
+# Импорт для работы с изображениями
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError, features
+    PIL_AVAILABLE = True
+    WEBP_AVAILABLE = features.check('webp')
+except ImportError:
+    PIL_AVAILABLE = False
+    WEBP_AVAILABLE = False
+    print("WARNING: PIL/Pillow не установлен. Миниатюры будут отключены.")
+
+# Размеры миниатюр: имя -> (сторона в пикселях, обрезать до квадрата)
+RENDITIONS = {
+    'list': (64, True),        # список и сетка, экраны 1x
+    'grid': (150, True),       # сетка, экраны 2x
+    'retina': (300, True),     # сетка, экраны 3x и крупные плитки
+    'preview': (1600, False),  # просмотр изображения, без обрезки
+}
+DEFAULT_RENDITION = 'grid'
+
+# Сколько изображений массовая генерация отдает пулу процессов за раз;
+# прогресс сохраняется после каждого пакета
+BULK_BATCH_SIZE = 200
+
+# Сколько миниатюр можно получить одним запросом /api/thumbnails
+MAX_BATCH_THUMBNAILS = 200
+
+# При превышении лимита миниатюры вытесняются, пока не займут эту долю лимита
+GC_LOW_WATERMARK = 0.9
+
+# Временные файлы и миниатюры без исходника удаляются, если они старше (секунды)
+GC_TEMP_MAX_AGE = 3600
+
+# Обращения к миниатюре из кеша в памяти отмечаются на диске (atime) не чаще (секунды)
+CACHE_TOUCH_INTERVAL = 60
+
+# Тег EXIF Orientation; значения 5-8 означают поворот на 90 градусов
+EXIF_ORIENTATION = 0x0112
+
+# Форматы миниатюр: имя -> (расширение, MIME-тип)
+THUMBNAIL_FORMATS = {
+    'webp': ('webp', 'image/webp'),
+    'jpeg': ('jpg', 'image/jpeg'),
+}
+
+class ThumbnailCache:
+    """LRU-кеш байтов миниатюр с ограничением суммарного объема.
+
+    Ключ содержит версию файла, поэтому после изменения файла старые
+    записи не отдаются, а просто вытесняются. Для каждой записи помнится,
+    когда обращение к ней последний раз отмечалось на диске: иначе очистка
+    папки миниатюр вытесняла бы самые востребованные, отдаваемые из памяти.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.touched = {}
+        self.lock = threading.Lock()
+        # Откуда отдавались миниатюры: из памяти, с диска или создавались заново
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        """Статистика кеша этого процесса"""
+        with self.lock:
+            counters = dict(self.counters)
+            entries = len(self.entries)
+            size = self.size
+        requests = sum(counters.values())
+        return dict(
+            counters,
+            requests=requests,
+            memory_hit_ratio=counters['memory_hits'] / requests if requests else 0,
+            hit_ratio=(counters['memory_hits'] + counters['disk_hits']) / requests if requests else 0,
+            memory_entries=entries,
+            memory_bytes=size,
+            memory_limit=self.max_bytes
+        )
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            return data
+
+    def should_touch(self, key, interval=CACHE_TOUCH_INTERVAL):
+        """True, если обращение к записи пора отметить на диске (touch_thumbnail)"""
+        now = time.time()
+        with self.lock:
+            if key not in self.entries or now - self.touched.get(key, 0) < interval:
+                return False
+            self.touched[key] = now
+            return True
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = data
+            self.size += len(data)
+            # Запись кладется после чтения с диска, отмеченного touch_thumbnail
+            self.touched[key] = time.time()
+
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.touched.pop(evicted_key, None)
+
+def get_thumbnail_filename(file_path, rendition=DEFAULT_RENDITION, fmt='jpeg'):
+    """Имя файла миниатюры: <имя без расширения>_<размер>.<расширение>.
+
+    JPEG размера grid сохраняет прежнее имя <имя>_thumb.jpg, поэтому уже
+    созданные миниатюры продолжают находиться.
+    """
+    filename = os.path.basename(file_path.replace('\\', '/'))
+    name, ext = os.path.splitext(filename)
+    if rendition == DEFAULT_RENDITION and fmt == 'jpeg':
+        return f"{name}_thumb.jpg"
+    return f"{name}_{rendition}.{THUMBNAIL_FORMATS[fmt][0]}"
+
+def get_thumbnail_path(upload_folder, file_path, rendition=DEFAULT_RENDITION, fmt='jpeg'):
+    """Возвращает путь к миниатюре файла (thumbnails/ab/cd/<name>_<размер>.<расширение>)"""
+    if not PIL_AVAILABLE:
+        return None
+
+    # Путь к папке миниатюр
+    thumbnails_folder = os.path.abspath(os.path.join(upload_folder, 'thumbnails'))
+
+    thumbnail_filename = get_thumbnail_filename(file_path, rendition, fmt)
+    thumbnail_path = os.path.join(thumbnails_folder, shard_path(thumbnail_filename))
+
+    # Миниатюра, созданная до перехода на разбитую раскладку
+    if not os.path.exists(thumbnail_path):
+        flat_path = os.path.join(thumbnails_folder, thumbnail_filename)
+        if os.path.exists(flat_path):
+            return flat_path
+
+    return thumbnail_path
+
+def get_thumbnail_formats():
+    """Форматы, которые может сохранить установленный Pillow"""
+    return [fmt for fmt in THUMBNAIL_FORMATS if fmt != 'webp' or WEBP_AVAILABLE]
+
+def get_rendition_paths(upload_folder, file_path):
+    """Пути ко всем миниатюрам файла: (размер, формат) -> путь"""
+    return {
+        (rendition, fmt): get_thumbnail_path(upload_folder, file_path, rendition, fmt)
+        for rendition in RENDITIONS
+        for fmt in get_thumbnail_formats()
+    }
+
+def renditions_exist(upload_folder, file_path):
+    """Созданы ли все миниатюры файла"""
+    return all(os.path.exists(path) for path in get_rendition_paths(upload_folder, file_path).values())
+
+def renditions_up_to_date(upload_folder, file_path, image_path):
+    """Созданы ли все миниатюры файла и не старше ли они исходника"""
+    try:
+        source_mtime = os.path.getmtime(image_path)
+    except OSError:
+        return False
+
+    for path in get_rendition_paths(upload_folder, file_path).values():
+        try:
+            if os.path.getmtime(path) < source_mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+def touch_thumbnail(path):
+    """Отмечает обращение к миниатюре (atime) для вытеснения давно не используемых.
+
+    Время выставляется явно: ФС часто смонтированы с noatime/relatime.
+    mtime не меняется - по нему проверяется актуальность миниатюры.
+    """
+    try:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except OSError:
+        pass
+
+def remove_renditions(upload_folder, file_path):
+    """Удаляет все миниатюры файла с диска, возвращает число освобожденных байт"""
+    freed = 0
+    for rendition in RENDITIONS:
+        for fmt in THUMBNAIL_FORMATS:
+            path = get_thumbnail_path(upload_folder, file_path, rendition, fmt)
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                freed += size
+            except OSError:
+                pass
+    return freed
+
+def get_thumbnail_source_name(thumbnail_filename):
+    """Имя исходника (без расширения) по имени файла миниатюры или None"""
+    suffixes = ['_thumb.jpg'] + [
+        f"_{rendition}.{ext}" for rendition in RENDITIONS for ext, mime in THUMBNAIL_FORMATS.values()
+    ]
+    for suffix in suffixes:
+        if thumbnail_filename.endswith(suffix):
+            return thumbnail_filename[:-len(suffix)]
+    return None
+
+def sweep_thumbnails(upload_folder, sources, max_bytes=0):
+    """Очистка папки миниатюр.
+
+    sources - имена исходников (без расширения) -> полный путь к исходнику.
+    Удаляются миниатюры удаленных файлов, миниатюры старше своего исходника
+    и брошенные временные файлы. Если остальное превышает max_bytes,
+    вытесняются миниатюры с самым давним обращением (atime). Удаленные
+    миниатюры создаются заново при следующем запросе. Возвращает статистику.
+    """
+    thumbnails_folder = os.path.abspath(os.path.join(upload_folder, 'thumbnails'))
+    stats = {'files': 0, 'bytes': 0, 'orphaned': 0, 'stale': 0, 'evicted': 0, 'freed': 0}
+    source_mtimes = {}
+    kept = []
+    now = time.time()
+
+    def remove(path, size, reason):
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        stats[reason] += 1
+        stats['freed'] += size
+
+    for root, dirs, files in os.walk(thumbnails_folder):
+        for filename in files:
+            path = os.path.join(root, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            # Свежие файлы не трогаем: их исходник мог появиться в БД после чтения sources
+            name = get_thumbnail_source_name(filename)
+            if filename.endswith('.tmp') or name is None or name not in sources:
+                if now - st.st_mtime > GC_TEMP_MAX_AGE:
+                    remove(path, st.st_size, 'orphaned')
+                continue
+
+            if name not in source_mtimes:
+                try:
+                    source_mtimes[name] = os.path.getmtime(sources[name])
+                except OSError:
+                    source_mtimes[name] = None
+            if source_mtimes[name] is not None and st.st_mtime < source_mtimes[name]:
+                remove(path, st.st_size, 'stale')
+                continue
+
+            kept.append((st.st_atime, st.st_size, path))
+
+    total = sum(size for atime, size, path in kept)
+    if max_bytes and total > max_bytes:
+        kept.sort()
+        target = max_bytes * GC_LOW_WATERMARK
+        for atime, size, path in kept:
+            if total <= target:
+                break
+            remove(path, size, 'evicted')
+            total -= size
+        kept = [entry for entry in kept if os.path.exists(entry[2])]
+
+    stats['files'] = len(kept)
+    stats['bytes'] = total
+    return stats
+
+def collect_thumbnail_sources(upload_folder):
+    """Имена исходников всех файлов в БД (как в именах миниатюр) -> путь к исходнику"""
+    upload_folder = os.path.abspath(upload_folder)
+    sources = {}
+    for (file_path,) in db.session.query(File.file_path).distinct():
+        relative = normalize_file_path(file_path)
+        name = os.path.splitext(os.path.basename(relative))[0]
+        sources[name] = os.path.join(upload_folder, relative)
+    return sources
+
+def schedule_thumbnail_gc(delay=None):
+    """Планирует очистку миниатюр, если она еще не запланирована (commit делает вызывающий код)"""
+    interval = current_app.config['THUMBNAIL_GC_INTERVAL']
+    if delay is None and not interval:
+        return None
+
+    active = Job.query.filter(
+        Job.kind == 'thumbnail_gc',
+        Job.status.in_(('queued', 'running'))
+    ).first()
+    if active is not None:
+        return active
+    return enqueue('thumbnail_gc', max_attempts=1, delay=interval if delay is None else delay)
+
+def save_image(image, path, fmt):
+    """Сохраняет изображение через временный файл, чтобы читатели не видели его недописанным"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        if fmt == 'webp':
+            image.save(temp_path, 'WEBP', quality=80, method=4)
+        else:
+            image.save(temp_path, 'JPEG', quality=85, optimize=True, progressive=True)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def get_image_info(source):
+    """Размеры исходника с учетом EXIF-поворота и ориентация (вызывать до draft)"""
+    orientation = source.getexif().get(EXIF_ORIENTATION, 1)
+    width, height = source.size
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+    return {'width': width, 'height': height, 'orientation': orientation}
+
+def to_rgb(img):
+    """Приводит изображение к RGB, прозрачность заменяется белым фоном (JPEG ее не поддерживает)"""
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    if img.mode != 'RGB':
+        return img.convert('RGB')
+    return img
+
+def get_dominant_color(img):
+    """Преобладающий цвет RGB-изображения в виде #rrggbb (заглушка до загрузки миниатюры)"""
+    small = img.copy()
+    small.thumbnail((32, 32))
+    palette = small.quantize(colors=4)
+    count, index = max(palette.getcolors())
+    red, green, blue = palette.getpalette()[index * 3:index * 3 + 3]
+    return f"#{red:02x}{green:02x}{blue:02x}"
+
+def extract_image_metadata(image_path):
+    """Сведения об изображении без создания миниатюр: декодируется только уменьшенная копия"""
+    with Image.open(image_path) as source:
+        metadata = get_image_info(source)
+        source.draft('RGB', (64, 64))
+        metadata['color'] = get_dominant_color(to_rgb(source))
+    return metadata
+
+def save_image_metadata(file_id, metadata):
+    """Записывает сведения об изображении в File (commit делает вызывающий код)"""
+    File.query.filter_by(id=file_id).update({
+        File.image_width: metadata['width'],
+        File.image_height: metadata['height'],
+        File.image_orientation: metadata['orientation'],
+        File.placeholder_color: metadata['color'],
+        # Содержимое не менялось - версия файла (и адреса миниатюр) остается прежней
+        File.updated_at: File.updated_at
+    }, synchronize_session=False)
+
+def create_renditions(image_path, upload_folder, file_path):
+    """Создает все миниатюры изображения и возвращает сведения о нем.
+
+    Ошибки пробрасываются вызывающему коду.
+    """
+    largest = max(size for size, crop in RENDITIONS.values())
+
+    with Image.open(image_path) as source:
+        metadata = get_image_info(source)
+
+        # JPEG декодируется сразу в уменьшенном масштабе (1/2, 1/4, 1/8), но не
+        # меньше самого крупного размера - 40 МП фото не раскрывается целиком
+        source.draft('RGB', (largest, largest))
+        img = to_rgb(ImageOps.exif_transpose(source))
+        metadata['color'] = get_dominant_color(img)
+
+        for rendition, (size, crop) in RENDITIONS.items():
+            if crop:
+                # Квадрат по центру, как object-fit: cover в шаблонах
+                resized = ImageOps.fit(img, (size, size), Image.Resampling.LANCZOS)
+            else:
+                resized = img.copy()
+                resized.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+            for fmt in get_thumbnail_formats():
+                save_image(resized, get_thumbnail_path(upload_folder, file_path, rendition, fmt), fmt)
+
+    return metadata
+
+def generate_renditions(image_path, upload_folder, file_path):
+    """Генерирует миниатюры изображения, возвращает успех"""
+    if not PIL_AVAILABLE:
+        return False
+
+    try:
+        create_renditions(image_path, upload_folder, file_path)
+        return True
+    except Exception as e:
+        print(f"Ошибка при создании миниатюры {image_path}: {e}")
+        return False
+
+def render_in_process(image_path, upload_folder, file_path):
+    """Создает миниатюры в процессе пула.
+
+    Возвращает (сведения об изображении, None) или (None, текст ошибки):
+    в БД их записывает родительский процесс.
+    """
+    try:
+        return create_renditions(image_path, upload_folder, file_path), None
+    except Exception as e:
+        return None, str(e)
+
+def extract_in_process(image_path):
+    """Извлекает сведения об изображении в процессе пула (миниатюры уже есть).
+
+    Возвращает то же, что render_in_process.
+    """
+    try:
+        return extract_image_metadata(image_path), None
+    except Exception as e:
+        return None, str(e)
+
+def migrate_thumbnail_layout(upload_folder):
+    """Переносит миниатюры из плоской папки thumbnails в разбитую раскладку.
+
+    Миниатюры не хранятся в БД, поэтому каждая просто переименовывается.
+    Возвращает число перенесенных миниатюр.
+    """
+    thumbnails_folder = os.path.abspath(os.path.join(upload_folder, 'thumbnails'))
+    if not os.path.isdir(thumbnails_folder):
+        return 0
+
+    moved = 0
+    with os.scandir(thumbnails_folder) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            target_path = os.path.join(thumbnails_folder, shard_path(entry.name))
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            os.replace(entry.path, target_path)
+            moved += 1
+    return moved
+
+@job_handler('thumbnail')
+def thumbnail_job(job, payload):
+    """Фоновая генерация миниатюр загруженного изображения"""
+    if not PIL_AVAILABLE:
+        return
+
+    file = db.session.get(File, job.file_id)
+    if file is None:
+        # Файл удален до обработки задачи
+        return
+
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    image_path = resolve_path(upload_folder, file.file_path)
+
+    try:
+        if not renditions_exist(upload_folder, file.file_path):
+            save_image_metadata(file.id, create_renditions(image_path, upload_folder, file.file_path))
+        elif file.image_width is None:
+            # Миниатюры того же содержимого уже есть - нужны только сведения
+            save_image_metadata(file.id, extract_image_metadata(image_path))
+    except UnidentifiedImageError as e:
+        # Повторять бессмысленно: файл не является изображением
+        job.last_error = str(e)
+
+def backfill_image_metadata(upload_folder, batch_size=500):
+    """Извлекает сведения об изображениях, загруженных до их появления в File.
+
+    Возвращает число обработанных изображений.
+    """
+    query = File.query.filter(File.mime_type.like('image/%'), File.image_width.is_(None))
+    filled = 0
+    last_id = 0
+    while True:
+        files = query.filter(File.id > last_id).order_by(File.id).limit(batch_size).all()
+        if not files:
+            break
+        last_id = files[-1].id
+
+        for file in files:
+            try:
+                save_image_metadata(file.id, extract_image_metadata(resolve_path(upload_folder, file.file_path)))
+                filled += 1
+            except Exception as e:
+                print(f"Не удалось прочитать изображение {file.original_filename}: {e}")
+        db.session.commit()
+        print(f"Обработано изображений: {filled}")
+    return filled
+
+def save_bulk_progress(job, payload, progress):
+    """Сохраняет прогресс массовой генерации в payload задачи"""
+    job.payload = json.dumps(dict(payload, progress=progress))
+    db.session.commit()
+
+@job_handler('thumbnail_bulk')
+def thumbnail_bulk_job(job, payload):
+    """Массовая генерация миниатюр в пуле процессов на всех ядрах.
+
+    payload['user_id'] - чьи изображения обрабатывать (None - всех
+    пользователей). Изображения с актуальными миниатюрами пропускаются;
+    если у них еще нет сведений (размеров, цвета-заглушки), извлекаются
+    только сведения.
+    """
+    if not PIL_AVAILABLE:
+        raise RuntimeError('PIL/Pillow не установлен')
+
+    upload_folder = os.path.abspath(current_app.config['UPLOAD_FOLDER'])
+    query = db.session.query(File.id, File.file_path, File.image_width).filter(File.mime_type.like('image/%'))
+    if payload.get('user_id') is not None:
+        query = query.filter(File.user_id == payload['user_id'])
+
+    progress = {'total': query.count(), 'processed': 0, 'generated': 0, 'skipped': 0, 'failed': 0, 'metadata': 0}
+    save_bulk_progress(job, payload, progress)
+
+    # spawn: процессы не наследуют потоки и соединения с БД веб-процесса
+    workers = current_app.config['THUMBNAIL_PROCESSES'] or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        last_id = 0
+        while True:
+            rows = query.filter(File.id > last_id).order_by(File.id).limit(BULK_BATCH_SIZE).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            futures = []
+            for file_id, file_path, image_width in rows:
+                image_path = resolve_path(upload_folder, file_path)
+                if renditions_up_to_date(upload_folder, file_path, image_path):
+                    progress['skipped'] += 1
+                    if image_width is None:
+                        # Миниатюры есть, сведений нет (загружено до их появления)
+                        futures.append((file_id, 'metadata', executor.submit(extract_in_process, image_path)))
+                    continue
+                futures.append((file_id, 'generated', executor.submit(render_in_process, image_path, upload_folder, file_path)))
+
+            for file_id, counter, future in futures:
+                metadata, error = future.result()
+                if error is None:
+                    # Как в thumbnail_job; фиксируется вместе с прогрессом
+                    save_image_metadata(file_id, metadata)
+                    progress[counter] += 1
+                else:
+                    progress['failed'] += 1
+
+            progress['processed'] += len(rows)
+            save_bulk_progress(job, payload, progress)
+
+    print(f"Массовая генерация миниатюр: {progress}")
+
+@job_handler('thumbnail_gc')
+def thumbnail_gc_job(job, payload):
+    """Очистка миниатюр; результат сохраняется в payload задачи"""
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    stats = sweep_thumbnails(
+        upload_folder,
+        collect_thumbnail_sources(upload_folder),
+        current_app.config['THUMBNAIL_DISK_LIMIT']
+    )
+    job.payload = json.dumps(dict(payload, result=stats))
+    print(f"Очистка миниатюр: {stats}")
+
+    # Следующая периодическая очистка (эта задача уже не считается активной)
+    job.status = 'done'
+    schedule_thumbnail_gc()
@@ -0,0 +1,89 @@
+"""
+Cloud Storage Server - истечение брошенных сессий загрузки по частям
+
+Клиент может исчезнуть посреди загрузки и не отменить сессию. Каждая часть
+продлевает сессию на UPLOAD_SESSION_TTL секунд; периодическая задача
+'upload_session_gc' переводит просроченные сессии в статус 'expired',
+возвращает зарезервированное под них место в хранилище, удаляет записи их
+частей и временный файл в uploads/tmp.
+"""
+
+import os
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, or_
+from models import db, UploadSession, UploadChunk, Job
+from jobs import job_handler, enqueue
+from storage import release_quota
+
+# Сколько сессий истекает за одну транзакцию
+EXPIRE_BATCH_SIZE = 200
+
+def session_expires_at(now=None):
+    """Срок действия сессии, продлеваемый каждой полученной частью"""
+    return (now or datetime.utcnow()) + timedelta(seconds=current_app.config['UPLOAD_SESSION_TTL'])
+
+def is_session_expired(upload_session, now=None):
+    return upload_session.expires_at is not None and upload_session.expires_at <= (now or datetime.utcnow())
+
+def expire_upload_sessions(upload_folder, batch_size=EXPIRE_BATCH_SIZE):
+    """Завершает просроченные активные сессии: статус 'expired', резерв места
+    возвращается пользователю, части и временный файл удаляются.
+
+    Сессии, созданные до появления expires_at, истекают через
+    UPLOAD_SESSION_TTL после последней полученной части. Возвращает число
+    истекших сессий.
+    """
+    now = datetime.utcnow()
+    stale_before = now - timedelta(seconds=current_app.config['UPLOAD_SESSION_TTL'])
+    expired_count = 0
+    while True:
+        # Сессии, которые сейчас завершает или отменяет запрос, пропускаются
+        sessions = UploadSession.query.filter(
+            UploadSession.status == 'active',
+            or_(
+                UploadSession.expires_at <= now,
+                and_(UploadSession.expires_at.is_(None), UploadSession.updated_at <= stale_before)
+            )
+        ).order_by(UploadSession.expires_at).limit(batch_size).with_for_update(skip_locked=True).all()
+        if not sessions:
+            break
+
+        session_ids = [upload_session.id for upload_session in sessions]
+        UploadChunk.query.filter(UploadChunk.session_id.in_(session_ids)).delete(synchronize_session=False)
+        for upload_session in sessions:
+            upload_session.status = 'expired'
+            # Место резервировалось на весь файл при создании сессии
+            release_quota(upload_session.user_id, upload_session.total_size)
+        db.session.commit()
+
+        # Временные файлы удаляются после фиксации статуса
+        for upload_session in sessions:
+            full_file_path = os.path.join(upload_folder, upload_session.file_path)
+            if os.path.exists(full_file_path):
+                os.remove(full_file_path)
+        expired_count += len(sessions)
+    return expired_count
+
+def schedule_upload_session_gc(delay=None):
+    """Планирует истечение сессий, если оно еще не запланировано (commit делает вызывающий код)"""
+    interval = current_app.config['UPLOAD_SESSION_GC_INTERVAL']
+    if delay is None and not interval:
+        return None
+
+    active = Job.query.filter(
+        Job.kind == 'upload_session_gc',
+        Job.status.in_(('queued', 'running'))
+    ).first()
+    if active is not None:
+        return active
+    return enqueue('upload_session_gc', max_attempts=1, delay=interval if delay is None else delay)
+
+@job_handler('upload_session_gc')
+def upload_session_gc_job(job, payload):
+    """Периодическое истечение брошенных сессий загрузки"""
+    expired = expire_upload_sessions(current_app.config['UPLOAD_FOLDER'])
+    print(f"Истекло сессий загрузки: {expired}")
+    # Следующий запуск (эта задача уже не считается активной)
+    job.status = 'done'
+    schedule_upload_session_gc()